@@ -0,0 +1,67 @@
+"""
+Benchmark del recálculo en paralelo de pycalc.
+
+Genera un libro sintético de 500.000 fórmulas independientes (10.000 filas
+con datos en A:E y 50 columnas de fórmulas) y compara el recálculo completo
+en serie con el recálculo repartido entre procesos.
+
+Uso: python benchmarks/bench_parallel_recalc.py [--rows N] [--workers N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pycalc_engine import Sheet, column_name  # noqa: E402
+
+DATA_COLS = 5
+FORMULA_COLS = 50
+
+def build_sheet(rows):
+    sheet = Sheet(rows, DATA_COLS + FORMULA_COLS)
+    sheet.parallel = False
+    edits = []
+    for r in range(rows):
+        for c in range(DATA_COLS):
+            edits.append((r, c, str((r * 7 + c * 13) % 101)))
+        n = r + 1
+        for k in range(FORMULA_COLS):
+            edits.append((r, DATA_COLS + k,
+                          f"=PROMEDIO($A{n}:$E{n})+RAIZ($A{n})*{k}+SUMA($B{n}:$D{n})/{k + 1}"))
+    sheet.set_cells(edits)
+    return sheet
+
+def timed_recalc(sheet, parallel, workers):
+    sheet.parallel = parallel
+    sheet.workers = workers
+    dirty = set(sheet.formulas)
+    start = time.perf_counter()
+    sheet.recalculate(dirty)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    sheet = build_sheet(args.rows)
+    print(f"Libro: {len(sheet.formulas)} fórmulas, generado en {time.perf_counter() - start:.2f} s")
+
+    serial = timed_recalc(sheet, False, 1)
+    expected = dict(sheet.values)
+    print(f"Serie:    {serial:.2f} s")
+    if args.workers < 2:
+        print("Solo hay un núcleo disponible: no se mide el recálculo en paralelo.")
+        return
+    parallel = timed_recalc(sheet, True, args.workers)
+    print(f"Paralelo: {parallel:.2f} s ({args.workers} procesos)")
+    print(f"Aceleración: x{serial / parallel:.2f}")
+    last = f"{column_name(DATA_COLS + FORMULA_COLS - 1)}{args.rows}"
+    assert sheet.values == expected, f"resultados distintos (p. ej. {last})"
+
+if __name__ == '__main__':
+    main()
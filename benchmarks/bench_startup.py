@@ -0,0 +1,84 @@
+"""
+Benchmark de arranque de pycalc.
+
+Lanza la aplicación varias veces en procesos nuevos (con la plataforma Qt
+'offscreen' si no se indica otra) y mide:
+  - importación: tiempo de 'import pycalc';
+  - ventana: desde el inicio del proceso hasta que la tabla se pinta por
+    primera vez.
+También indica si matplotlib llegó a importarse durante el arranque.
+
+Uso: python benchmarks/bench_startup.py [--runs N] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Código que se ejecuta en cada proceso hijo; imprime una línea JSON con los tiempos
+PROBE = r'''
+import time
+start = time.perf_counter()
+import sys, json
+import pycalc
+imported = time.perf_counter()
+from PyQt5.QtCore import QObject, QEvent, QTimer
+
+class FirstPaint(QObject):
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint and not painted:
+            painted.append(time.perf_counter())
+            QTimer.singleShot(0, app.quit)
+        return False
+
+painted = []
+app = pycalc.QApplication(sys.argv)
+window = pycalc.ExcelClone()
+probe = FirstPaint()
+window.table.viewport().installEventFilter(probe)
+window.show()
+QTimer.singleShot(10000, app.quit)
+app.exec_()
+print(json.dumps({
+    'import': imported - start,
+    'window': (painted[0] if painted else float('nan')) - start,
+    'matplotlib': 'matplotlib' in sys.modules,
+}))
+'''
+
+def run_once():
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help="salida en JSON")
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    result = {
+        'runs': args.runs,
+        'import_median': statistics.median(r['import'] for r in runs),
+        'window_median': statistics.median(r['window'] for r in runs),
+        'window_min': min(r['window'] for r in runs),
+        'matplotlib_loaded': any(r['matplotlib'] for r in runs),
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"Importación (mediana): {result['import_median'] * 1000:.0f} ms")
+    print(f"Primera ventana pintada (mediana): {result['window_median'] * 1000:.0f} ms"
+          f" (mínimo {result['window_min'] * 1000:.0f} ms, {args.runs} ejecuciones)")
+    print(f"matplotlib importado al arrancar: {'sí' if result['matplotlib_loaded'] else 'no'}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+"""
+Batería de benchmarks sin interfaz visible de pycalc y pywrite.
+
+Ejecuta las operaciones de usuario más costosas sobre datos generados, con la
+plataforma Qt 'offscreen' si no se indica otra, y mide cada una varias veces:
+  - pycalc: abrir y guardar CSV (y libros .pycalc) de tamaño creciente,
+    evaluate_formula_direct sobre cadenas profundas y rangos anchos,
+    buscar/reemplazar, ordenar, pegar, autoajustar e insertar filas, y lo
+    que tarda una edición mientras se recalcula una cadena larga;
+  - pywrite: abrir y guardar textos grandes.
+Los diálogos de archivo se contestan solos; todo lo demás pasa por los mismos
+métodos que usa la interfaz.
+
+Con --json el resultado se imprime en JSON; --save guarda ese JSON como
+referencia y --compare lo compara con una referencia guardada: las medidas
+más lentas que la tolerancia se marcan como regresión y el proceso termina
+con código 1.
+
+Uso: python benchmarks/bench_suite.py [--sizes 10000,100000] [--repeat N]
+         [--only PATRÓN] [--json] [--save REF.json] [--compare REF.json]
+"""
+import argparse
+import contextlib
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np  # noqa: E402
+from PyQt5.QtCore import QItemSelection, QItemSelectionModel  # noqa: E402
+from PyQt5.QtWidgets import QApplication, QDialog  # noqa: E402
+
+import pycalc  # noqa: E402
+import pywrite  # noqa: E402
+
+DEFAULT_SIZES = [10000, 100000]
+DEFAULT_TOLERANCE = 0.15
+
+BENCHMARKS = []  # (nombre, función(bench, filas) o función(bench))
+
+def benchmark(name, sized=True):
+    """
+    Registra un benchmark. Con sized, se ejecuta una vez por tamaño de
+    --sizes y el nombre lleva el tamaño ("pycalc.abrir_csv[10000]").
+    """
+    def register(function):
+        BENCHMARKS.append((name, sized, function))
+        return function
+    return register
+
+@contextlib.contextmanager
+def answering(cls, name, value):
+    """
+    Sustituye un método de diálogo (getOpenFileName, exec_...) por uno que
+    devuelve 'value' sin mostrar nada.
+    """
+    original = cls.__dict__.get(name)
+    setattr(cls, name, staticmethod(lambda *args, **kwargs: value))
+    try:
+        yield
+    finally:
+        if original is None:
+            delattr(cls, name)
+        else:
+            setattr(cls, name, original)
+
+class Bench:
+    """
+    Contexto de los benchmarks: aplicación Qt, carpeta temporal, archivos
+    generados (se reutilizan entre repeticiones) y el cronómetro.
+    """
+    def __init__(self, directory):
+        self.app = QApplication.instance() or QApplication([])
+        self.directory = directory
+        self.files = {}
+        self.elapsed = None
+
+    @contextlib.contextmanager
+    def timed(self):
+        """
+        Mide el bloque; solo cuenta lo que se ejecuta dentro.
+        """
+        self.app.processEvents()
+        start = time.perf_counter()
+        yield
+        self.elapsed = time.perf_counter() - start
+
+    def wait(self, done, timeout=600):
+        """
+        Procesa eventos hasta que done() sea verdadero (hilos de importación
+        y exportación).
+        """
+        limit = time.perf_counter() + timeout
+        while not done():
+            if time.perf_counter() > limit:
+                raise TimeoutError("la operación no terminó a tiempo")
+            self.app.processEvents()
+            time.sleep(0.001)
+        self.app.processEvents()
+
+    def calculated(self, window):
+        """
+        Espera a que termine el recálculo en segundo plano de la ventana.
+        """
+        self.wait(lambda: window.model.recalc_thread is None and not window.model.outdated())
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def csv(self, rows):
+        """
+        CSV de 'rows' filas: identificador, categoría, tres números y un texto.
+        """
+        path = self.files.get(('csv', rows))
+        if path is None:
+            path = self.files[('csv', rows)] = self.path(f"datos_{rows}.csv")
+            rng = np.random.default_rng(rows)
+            numbers = rng.integers(0, 100000, size=(rows, 3))
+            with open(path, 'w', encoding='utf-8') as f:
+                for i in range(rows):
+                    a, b, c = numbers[i].tolist()
+                    f.write(f"{i},cat{a % 50},{a},{b / 100},{c},texto {b} fila {i}\n")
+        return path
+
+    def text(self, rows):
+        """
+        Texto plano de 'rows' líneas para pywrite.
+        """
+        path = self.files.get(('txt', rows))
+        if path is None:
+            path = self.files[('txt', rows)] = self.path(f"texto_{rows}.txt")
+            with open(path, 'w', encoding='utf-8') as f:
+                for i in range(rows):
+                    f.write(f"Línea {i}: el veloz murciélago hindú comía feliz cardillo y kiwi.\n")
+        return path
+
+    def window(self, rows=None):
+        """
+        Ventana nueva de pycalc, con el CSV de 'rows' filas ya cargado.
+        """
+        window = pycalc.ExcelClone()
+        if rows:
+            window.load_csv(self.csv(rows))
+            self.wait(lambda: window.import_thread is None)
+            self.calculated(window)
+        return window
+
+# --- pycalc ---
+@benchmark('pycalc.abrir_csv')
+def open_csv(bench, rows):
+    window = bench.window()
+    path = bench.csv(rows)
+    with bench.timed(), answering(pycalc.QFileDialog, 'getOpenFileName', (path, "")):
+        window.open_file()
+        bench.wait(lambda: window.import_thread is None)
+    assert window.sheet.row_count == rows
+
+@benchmark('pycalc.guardar_csv')
+def save_csv(bench, rows):
+    window = bench.window(rows)
+    target = bench.path("salida.csv")
+    with answering(pycalc.QFileDialog, 'getSaveFileName', (target, "CSV Files (*.csv)")), \
+            answering(pycalc.CsvExportDialog, 'exec_', QDialog.Accepted):
+        with bench.timed():
+            window.save_file()
+            bench.wait(lambda: window.export_thread is None)
+    assert os.path.getsize(target)
+
+@benchmark('pycalc.guardar_libro')
+def save_workbook(bench, rows):
+    window = bench.window(rows)
+    target = bench.path("salida.pycalc")
+    if os.path.exists(target):
+        os.remove(target)
+    with bench.timed(), answering(pycalc.QFileDialog, 'getSaveFileName', (target, "Libros de pycalc (*.pycalc)")):
+        window.save_file()
+    assert window.workbook_path == target
+
+@benchmark('pycalc.abrir_libro')
+def open_workbook(bench, rows):
+    window = bench.window(rows)
+    target = bench.path("entrada.pycalc")
+    window.save_workbook(target)
+    other = bench.window()
+    with bench.timed(), answering(pycalc.QFileDialog, 'getOpenFileName', (target, "")):
+        other.open_file()
+    assert other.sheet.row_count == rows
+
+@benchmark('pycalc.cadena_profunda')
+def deep_chain(bench, rows):
+    # A1 = 1 y cada celda suma 1 a la anterior: editar A1 recalcula toda la cadena
+    window = bench.window()
+    window.model.load_rows([["1"]] + [[f"=A{i}+1"] for i in range(1, rows)])
+    bench.calculated(window)
+    with bench.timed():
+        window.model.set_cells([(0, 0, "2")])
+        bench.calculated(window)
+        result = window.sheet.evaluate_formula_direct(f"A{rows}*1")
+    assert result == rows + 1
+
+@benchmark('pycalc.editar_calculando')
+def edit_while_calculating(bench, rows):
+    # Lo que tarda en volver una edición mientras se recalcula la cadena entera
+    window = bench.window()
+    window.model.load_rows([["1"]] + [[f"=A{i}+1"] for i in range(1, rows)])
+    bench.calculated(window)
+    window.model.set_cells([(0, 0, "2")])
+    bench.wait(lambda: window.model.recalc_thread is not None)
+    with bench.timed():
+        window.model.set_cells([(0, 1, "x")])
+    bench.calculated(window)
+    assert window.sheet.evaluate_formula_direct(f"A{rows}*1") == rows + 1
+
+@benchmark('pycalc.rango_ancho')
+def wide_range(bench, rows):
+    window = bench.window(rows)
+    formulas = [f"SUMA(C1:E{rows})", f"PROMEDIO(C1:C{rows})", f"MAX(A1:E{rows})",
+                f'SUMAR.SI(B1:B{rows};"cat7";C1:C{rows})', f'CONTAR.SI(C1:C{rows};">50000")']
+    with bench.timed():
+        for formula in formulas:
+            result = window.sheet.evaluate_formula_direct(formula)
+            assert not str(result).startswith('#'), result
+
+@benchmark('pycalc.buscar_reemplazar')
+def find_replace(bench, rows):
+    window = bench.window(rows)
+    with bench.timed():
+        window.find_replace()
+        dialog = window.find_dialog
+        dialog.find_edit.setText("fila 1")
+        dialog.replace_edit.setText("línea 1")
+        dialog.replace_all()
+    assert window.sheet.display(1, 5).endswith("línea 1")
+
+@benchmark('pycalc.ordenar')
+def sort_ascending(bench, rows):
+    window = bench.window(rows)
+    window.table.setCurrentIndex(window.model.index(0, 4))
+    with bench.timed():
+        window.sort_asc()
+        bench.calculated(window)
+    values = window.sheet.range_array(0, 4, rows - 1, 4)
+    assert (np.diff(values) >= 0).all()
+
+@benchmark('pycalc.pegar')
+def paste(bench, rows):
+    window = bench.window(rows)
+    selection = window.table.selectionModel()
+    selection.select(QItemSelection(window.model.index(0, 0), window.model.index(rows - 1, 5)),
+                     QItemSelectionModel.ClearAndSelect)
+    window.copy_cells()
+    expected = window.sheet.text(rows - 1, 0)
+    # Se pega dos columnas a la derecha: solapa el origen y amplía la hoja
+    window.table.setCurrentIndex(window.model.index(0, 2))
+    with bench.timed():
+        window.paste_cells()
+        bench.calculated(window)
+    assert window.sheet.text(rows - 1, 2) == expected
+
+@benchmark('pycalc.autoajustar')
+def auto_fit(bench, rows):
+    # El ajuste normal mide una muestra: debe tardar casi lo mismo con cualquier tamaño
+    window = bench.window(rows)
+    with bench.timed():
+        window.auto_resize_columns()
+        window.auto_resize_rows()
+    assert window.table.columnWidth(5) > window.table.columnWidth(1)
+
+@benchmark('pycalc.insertar_filas')
+def insert_rows(bench, rows):
+    # Un bloque de filas/10 filas insertado a mitad de la hoja: solo se
+    # reescriben las fórmulas que se mueven o que leen por debajo
+    window = bench.window(rows)
+    count = rows // 10
+    window.model.set_cells([(0, 6, f"=SUMA(C1:C{rows})"), (1, 6, f"=C{rows}*2")])
+    bench.calculated(window)
+    total = window.sheet.display(0, 6)
+    middle = rows // 2
+    window.table.setCurrentIndex(window.model.index(middle, 0))
+    window.table.selectionModel().select(
+        QItemSelection(window.model.index(middle, 0), window.model.index(middle + count - 1, 0)),
+        QItemSelectionModel.ClearAndSelect)
+    with bench.timed():
+        window.insert_row()
+        bench.calculated(window)
+    assert window.sheet.row_count == rows + count
+    assert window.sheet.text(0, 6) == f"=SUMA(C1:C{rows + count})"
+    assert window.sheet.display(0, 6) == total
+
+# --- pywrite ---
+@benchmark('pywrite.abrir')
+def open_text(bench, rows):
+    window = pywrite.WordApp()
+    path = bench.text(rows)
+    with bench.timed(), answering(pywrite.QFileDialog, 'getOpenFileName', (path, "")):
+        window.open_file()
+    assert window.current_tab().file_path == path
+
+@benchmark('pywrite.guardar')
+def save_text(bench, rows):
+    window = pywrite.WordApp()
+    with answering(pywrite.QFileDialog, 'getOpenFileName', (bench.text(rows), "")):
+        window.open_file()
+    tab = window.current_tab()
+    tab.file_path = bench.path("salida.txt")
+    with bench.timed():
+        window.save_file()
+    assert os.path.getsize(tab.file_path)
+
+# --- Ejecución y comparación ---
+def run(sizes, repeat, only):
+    """
+    Ejecuta los benchmarks y devuelve {nombre: medidas}.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='pycalc-bench-') as directory:
+        bench = Bench(directory)
+        for name, sized, function in BENCHMARKS:
+            for rows in sizes if sized else [None]:
+                full_name = f"{name}[{rows}]" if sized else name
+                if only and not any(fnmatch.fnmatch(full_name, pattern) for pattern in only):
+                    continue
+                runs = []
+                for _ in range(repeat):
+                    function(bench, rows) if sized else function(bench)
+                    runs.append(bench.elapsed)
+                    # Las ventanas de cada repetición se liberan antes de la siguiente
+                    for widget in QApplication.topLevelWidgets():
+                        widget.close()
+                        widget.deleteLater()
+                    bench.app.processEvents()
+                results[full_name] = {'min': min(runs), 'median': statistics.median(runs), 'runs': runs}
+                print(f"  {full_name}: {results[full_name]['median'] * 1000:.1f} ms", file=sys.stderr)
+    return results
+
+def metadata():
+    from PyQt5.QtCore import QT_VERSION_STR
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'qt': QT_VERSION_STR,
+        'numpy': np.__version__,
+        'cpus': os.cpu_count(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def compare(results, baseline, tolerance):
+    """
+    Compara las medianas con las de la referencia. Devuelve (líneas del
+    informe, número de regresiones).
+    """
+    lines = []
+    regressions = 0
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            lines.append(f"{name}: {result['median'] * 1000:.1f} ms (sin referencia)")
+            continue
+        ratio = result['median'] / reference['median'] if reference['median'] else float('inf')
+        if ratio > 1 + tolerance:
+            regressions += 1
+            verdict = "REGRESIÓN"
+        elif ratio < 1 - tolerance:
+            verdict = "mejora"
+        else:
+            verdict = "igual"
+        lines.append(f"{name}: {reference['median'] * 1000:.1f} -> {result['median'] * 1000:.1f} ms "
+                     f"(x{ratio:.2f}) {verdict}")
+    return lines, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default=",".join(map(str, DEFAULT_SIZES)),
+                        help="filas de los datos generados, separadas por comas")
+    parser.add_argument('--repeat', type=int, default=3, help="repeticiones de cada medida")
+    parser.add_argument('--only', action='append', metavar='PATRÓN',
+                        help="solo los benchmarks cuyo nombre coincide (p. ej. 'pycalc.abrir*')")
+    parser.add_argument('--json', action='store_true', help="salida en JSON")
+    parser.add_argument('--save', metavar='REF', help="guarda el resultado como referencia")
+    parser.add_argument('--compare', metavar='REF', help="compara con una referencia guardada")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="margen relativo antes de considerar una regresión (por defecto 0.15)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    output = {'meta': metadata(), 'results': run(sizes, args.repeat, args.only)}
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=2, ensure_ascii=False)
+    status = 0
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        lines, regressions = compare(output['results'], baseline, args.tolerance)
+        output['comparison'] = lines
+        status = 1 if regressions else 0
+    if args.json:
+        print(json.dumps(output, indent=2, ensure_ascii=False))
+    else:
+        for name, result in output['results'].items():
+            print(f"{name}: mediana {result['median'] * 1000:.1f} ms, mínimo {result['min'] * 1000:.1f} ms")
+        if args.compare:
+            print("\nComparación con la referencia:")
+            print("\n".join(output['comparison']))
+            print(f"{regressions} regresiones" if regressions else "Sin regresiones")
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
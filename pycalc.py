@@ -1,39 +1,1546 @@
 import sys
+import os
 import csv
 import re
-import math
+from bisect import bisect_right
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+# Motor de cálculo (sin Qt)
+from pycalc_engine import (
+    Sheet, ClipBlock, MinMaxDecimator, PivotTable, Recalculation, SheetStyles, PIVOT_FUNCTIONS, PROFILER,
+    STYLE_FIELDS,
+    column_name, format_number, line_counts, load_workbook, longest_texts, lttb, read_csv_blocks, save_workbook,
+    write_csv
+)
 
 # Importaciones de PyQt5 para la interfaz gráfica
 from PyQt5.QtWidgets import (
-    QApplication, QMainWindow, QTableWidget, QTableWidgetItem,
-    QAction, QFileDialog, QMessageBox, QInputDialog, QDialog, QVBoxLayout, QPushButton, QLabel,
-    QColorDialog, QFontDialog, QMenu, QStatusBar
+    QApplication, QMainWindow, QTableView,
+    QFileDialog, QMessageBox, QInputDialog, QDialog, QVBoxLayout, QPushButton, QLabel,
+    QColorDialog, QFontDialog, QMenu, QStatusBar, QProgressBar,
+    QFormLayout, QComboBox, QDialogButtonBox, QLineEdit, QCheckBox, QHBoxLayout,
+    QTabWidget, QTableWidget, QTableWidgetItem, QHeaderView, QStyle
+)
+from PyQt5.QtGui import QColor, QFont, QFontMetrics
+from PyQt5.QtCore import (
+    Qt, QAbstractTableModel, QModelIndex, QItemSelection, QItemSelectionModel, QThread, QTimer, pyqtSignal
 )
-from PyQt5.QtGui import QColor, QFont
-from PyQt5.QtCore import Qt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
+
+# Espera (ms) tras el último cambio de selección antes de calcular sus estadísticas
+STATS_DELAY_MS = 150
+# Espera (ms) tras la última edición del origen antes de actualizar las tablas dinámicas
+PIVOT_DELAY_MS = 300
+# Autoajuste: filas de muestra (además de las visibles y de los textos más
+# largos recordados) y textos más largos por columna que mide el ajuste exacto
+AUTOFIT_SAMPLE_ROWS = 500
+AUTOFIT_EXACT_CANDIDATES = 32
+# Celdas pendientes de recalcular: se muestra su último valor en gris o, si aún no tienen, esto
+CALCULATING_TEXT = "…"
+CALCULATING_COLOR = QColor("#9aa0a6")
+
+# --- Deshacer / rehacer ---
+# Memoria máxima aproximada del historial; se descartan primero los cambios más antiguos
+UNDO_BUDGET = 64 * 1024 * 1024
+
+def _texts_size(texts):
+    # Tamaño aproximado de una lista de textos (cabecera de str de CPython incluida)
+    return sum(map(len, texts)) + 56 * len(texts)
+
+class EditRecord:
+    """
+    Cambio de contenido de un lote de celdas (edición, pegar, borrar,
+    reemplazar): posiciones en arrays y textos anterior y nuevo.
+    """
+    def __init__(self, updates, old):
+        self.rows = np.fromiter((u[0] for u in updates), dtype=np.int32, count=len(updates))
+        self.cols = np.fromiter((u[1] for u in updates), dtype=np.int32, count=len(updates))
+        self.new = ["" if u[2] is None else str(u[2]) for u in updates]
+        self.old = old
+        self.size = 8 * len(updates) + _texts_size(self.new) + _texts_size(old)
+
+    def undo(self, model):
+        # En orden inverso, por si el lote escribía dos veces la misma celda
+        model.set_cells(list(zip(self.rows[::-1].tolist(), self.cols[::-1].tolist(), self.old[::-1])))
+
+    def redo(self, model):
+        model.set_cells(list(zip(self.rows.tolist(), self.cols.tolist(), self.new)))
+
+def _styles_size(state):
+    cells, runs = state
+    return 16 * len(cells) + 100 * len(runs)
+
+class FormatRecord:
+    """
+    Cambio de formato: estado anterior y nuevo de los tramos de estilo y de
+    las celdas con estilo propio afectadas (ver SheetStyles.state).
+    """
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.size = _styles_size(old) + _styles_size(new)
+
+    def undo(self, model):
+        model.restore_styles(*self.old)
+
+    def redo(self, model):
+        model.restore_styles(*self.new)
+
+class StructureRecord:
+    """
+    Inserción o eliminación de filas (axis=0) o columnas (axis=1). Al eliminar
+    se guarda el contenido y el formato de lo eliminado, y el texto anterior
+    de las fórmulas reescritas, para poder restaurarlo.
+    """
+    def __init__(self, axis, index, count, inserted, content=(), styles=None):
+        self.axis = axis
+        self.index = index
+        self.count = count
+        self.inserted = inserted
+        self.content = list(content)
+        self.styles = styles
+        self.size = 100 + 16 * len(self.content) + _texts_size([c[2] for c in self.content]) \
+            + (_styles_size(styles) if styles else 0)
+
+    def _insert(self, model):
+        model.insert_lines(self.axis, self.index, self.count)
+
+    def _remove(self, model):
+        model.remove_lines(self.axis, self.index, self.count)
+
+    def undo(self, model):
+        if self.inserted:
+            self._remove(model)
+            return
+        self._insert(model)
+        model.set_cells(self.content)
+        if self.styles:
+            model.restore_styles(*self.styles)
+
+    def redo(self, model):
+        if self.inserted:
+            self._insert(model)
+        else:
+            self._remove(model)
+
+def _block_size(block):
+    size = 0
+    for values, valid, texts, formulas in block.columns:
+        size += values.nbytes + valid.nbytes + _texts_size(list(texts.values())) \
+            + _texts_size(list(formulas.values()))
+    return size
+
+class BlockRecord:
+    """
+    Pegado de un bloque: el rectángulo anterior y el pegado, ambos como ClipBlock.
+    """
+    def __init__(self, row, col, old, new):
+        self.row = row
+        self.col = col
+        self.old = old
+        self.new = new
+        self.size = _block_size(old) + _block_size(new)
+
+    def undo(self, model):
+        model.paste_block(self.row, self.col, self.old)
+
+    def redo(self, model):
+        model.paste_block(self.row, self.col, self.new)
+
+class SortRecord:
+    """
+    Ordenación (o cualquier permutación de filas): basta con el orden aplicado
+    y, si la ordenación partió tramos de estilo, su estado anterior.
+    """
+    def __init__(self, order, styles=None):
+        self.order = np.asarray(order, dtype=np.int32)
+        self.styles = styles
+        self.size = self.order.nbytes + (_styles_size(styles) if styles else 0)
+
+    def undo(self, model):
+        inverse = np.empty_like(self.order)
+        inverse[self.order] = np.arange(len(self.order), dtype=np.int32)
+        model.permute_rows(inverse)
+        if self.styles:
+            model.restore_styles(*self.styles)
+
+    def redo(self, model):
+        model.permute_rows(self.order)
+
+class UndoHistory:
+    """
+    Historial de cambios con un presupuesto de memoria: cada operación guarda
+    solo su delta y, si se supera el presupuesto, se olvidan las más antiguas.
+    """
+    def __init__(self, budget=UNDO_BUDGET):
+        self.budget = budget
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.used = 0
+        self.replaying = False  # True mientras se deshace o rehace
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.used = 0
+
+    def push(self, record):
+        if self.replaying:
+            return
+        self.used -= sum(r.size for r in self.redo_stack)
+        self.redo_stack.clear()
+        self.undo_stack.append(record)
+        self.used += record.size
+        self._trim()
+
+    def _trim(self):
+        # Siempre se conserva al menos el último cambio
+        while self.used > self.budget and len(self.undo_stack) > 1:
+            self.used -= self.undo_stack.popleft().size
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self, model):
+        if not self.undo_stack:
+            return False
+        record = self.undo_stack.pop()
+        self._replay(record.undo, model)
+        self.redo_stack.append(record)
+        return True
+
+    def redo(self, model):
+        if not self.redo_stack:
+            return False
+        record = self.redo_stack.pop()
+        self._replay(record.redo, model)
+        self.undo_stack.append(record)
+        self._trim()
+        return True
+
+    def _replay(self, action, model):
+        self.replaying = True
+        try:
+            action(model)
+        finally:
+            self.replaying = False
+
+# Roles de Qt que salen del estilo de la celda
+STYLE_ROLES = frozenset((Qt.FontRole, Qt.BackgroundRole, Qt.ForegroundRole, Qt.TextAlignmentRole))
+
+def _pausing_recalc(method):
+    """
+    Decorador de los métodos del modelo que modifican la hoja: el recálculo
+    en segundo plano se detiene antes y se reanuda al terminar.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.paused():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class SheetModel(QAbstractTableModel):
+    """
+    Modelo Qt sobre una hoja: la vista solo materializa las celdas visibles a
+    través de data(), sin un item por celda. Las fórmulas se recalculan en un
+    RecalcThread: cada edición deja sus celdas pendientes y vuelve enseguida.
+    """
+    # Cambio en el estado del recálculo (empieza, avanza o termina)
+    recalc_state = pyqtSignal()
+    recalc_failed = pyqtSignal(str)
+
+    def __init__(self, sheet, parent=None):
+        super().__init__(parent)
+        self.sheet = sheet
+        self.sheet.deferred = True
+        self.styles = SheetStyles()
+        self.style_values = {}  # (número de estilo, rol) -> QFont/QColor/alineación
+        self.history = UndoHistory()
+        self.automatic = True      # cálculo automático; en manual solo se calcula con F9
+        self.recalc_thread = None  # RecalcThread en marcha
+        self.pauses = 0            # paused() anidados en curso
+        self.resume = False        # reanudar el recálculo al salir de paused()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.sheet.row_count
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.sheet.col_count
+
+    def data(self, index, role=Qt.DisplayRole):
+        row, col = index.row(), index.column()
+        if role == Qt.DisplayRole:
+            if self.calculating(row, col) and (row, col) not in self.sheet.values:
+                return CALCULATING_TEXT
+            return self.sheet.display(row, col)
+        if role == Qt.EditRole:
+            return self.sheet.text(row, col)
+        if role == Qt.ForegroundRole and self.calculating(row, col):
+            return CALCULATING_COLOR
+        if role in STYLE_ROLES:
+            sid = self.styles.style_id(row, col)
+            if sid:
+                return self.style_value(sid, role)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid():
+            return False
+        self.set_cells([(index.row(), index.column(), value)])
+        return True
+
+    def flags(self, index):
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsEditable
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return column_name(section)
+        return str(section + 1)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_by([(column, order == Qt.DescendingOrder)])
+
+    @_pausing_recalc
+    def sort_by(self, keys, start=0):
+        """
+        Ordena las filas desde 'start' por varias claves [(columna, descendente)];
+        los formatos se mueven con sus filas.
+        """
+        self.layoutAboutToBeChanged.emit()
+        order = self.sheet.sort_rows(keys, start)
+        styles = self.styles.permute_rows(order, self.sheet.col_count)
+        self.layoutChanged.emit()
+        self.refresh()
+        self.history.push(SortRecord(order, styles))
+
+    @_pausing_recalc
+    def permute_rows(self, order):
+        """
+        Aplica una permutación de filas (orden[fila_nueva] = fila_antigua).
+        """
+        self.layoutAboutToBeChanged.emit()
+        self.sheet.permute_rows(order)
+        self.styles.permute_rows(order, self.sheet.col_count)
+        self.layoutChanged.emit()
+        self.refresh()
+
+    # --- Recálculo en segundo plano ---
+    def outdated(self):
+        """
+        Indica si queda algo por recalcular (fórmulas pendientes o ediciones
+        cuyas dependientes aún no se han buscado).
+        """
+        return bool(self.sheet.pending or self.sheet.changed)
+
+    def calculating(self, row, col):
+        """
+        Indica si la celda es una fórmula pendiente de recalcular.
+        """
+        pending = self.sheet.pending
+        return bool(pending) and (row, col) in pending and (row, col) in self.sheet.formulas
+
+    def start_recalc(self):
+        """
+        Lanza el cálculo de las celdas pendientes en segundo plano, si no hay
+        ya uno en marcha.
+        """
+        if self.recalc_thread is not None or self.pauses or not self.outdated():
+            return
+        thread = RecalcThread(self.sheet, self)
+        thread.calculated.connect(self.on_calculated)
+        thread.failed.connect(self.recalc_failed)
+        thread.finished.connect(lambda: self.on_recalc_finished(thread))
+        self.recalc_thread = thread
+        thread.start()
+        self.recalc_state.emit()
+
+    def stop_recalc(self):
+        """
+        Cancela el recálculo en curso y espera a que suelte la hoja (como
+        mucho, lo que tarda una celda). Lo que faltaba sigue pendiente.
+        Devuelve True si había uno en marcha.
+        """
+        thread = self.recalc_thread
+        if thread is None:
+            return False
+        thread.cancel()
+        thread.wait()
+        self.recalc_thread = None
+        return True
+
+    @contextmanager
+    def paused(self):
+        """
+        Detiene el recálculo mientras se modifica o se copia la hoja y, al
+        salir, lo reanuda desde donde se quedó con lo que haya pendiente.
+        """
+        if not self.pauses:
+            self.resume = self.stop_recalc() or self.automatic
+        self.pauses += 1
+        try:
+            yield
+        finally:
+            self.pauses -= 1
+            if not self.pauses:
+                if self.resume:
+                    self.start_recalc()
+                self.recalc_state.emit()
+
+    def calculate_now(self):
+        """
+        Calcula las celdas pendientes, también en modo manual (F9).
+        """
+        self.start_recalc()
+
+    def set_automatic(self, automatic):
+        """
+        Cambia entre cálculo automático y manual; al volver al automático se
+        calcula lo que haya pendiente.
+        """
+        self.automatic = automatic
+        if automatic:
+            self.start_recalc()
+        self.recalc_state.emit()
+
+    def finish_recalc(self):
+        """
+        Termina aquí mismo el recálculo pendiente (antes de guardar), salvo
+        en modo manual, en el que se guardan los últimos resultados.
+        """
+        if not self.automatic or not self.outdated():
+            return
+        self.stop_recalc()
+        cells = []
+        Recalculation(self.sheet).run(cells.extend)
+        self.emit_changed(cells)
+        self.recalc_state.emit()
+
+    def on_calculated(self, cells):
+        # Los lotes llegan en cola: tras eliminar líneas pueden quedar fuera de la hoja
+        rows, cols = self.sheet.row_count, self.sheet.col_count
+        self.emit_changed([(row, col) for row, col in cells if row < rows and col < cols])
+        self.recalc_state.emit()
+
+    def on_recalc_finished(self, thread):
+        thread.deleteLater()
+        if thread is self.recalc_thread:
+            self.recalc_thread = None
+            self.recalc_state.emit()
+
+    # --- Escritura ---
+    @_pausing_recalc
+    def set_cells(self, updates, record=True):
+        """
+        Escribe varias celdas en la hoja y notifica a la vista una sola vez.
+        El lote se guarda como un único cambio en el historial, salvo con
+        record=False (resultados de tablas dinámicas, que se recalculan solos).
+        """
+        updates = list(updates)
+        if not updates:
+            return
+        self.ensure_size(max(u[0] for u in updates), max(u[1] for u in updates))
+        if record and not self.history.replaying:
+            old = [self.sheet.text(row, col) for row, col, _ in updates]
+            self.history.push(EditRecord(updates, old))
+        self.emit_changed(self.sheet.set_cells(updates))
+
+    @_pausing_recalc
+    def paste_block(self, row, col, block):
+        """
+        Pega un bloque con su esquina en (fila, columna) como una sola
+        operación: una escritura, un recálculo y un cambio en el historial.
+        """
+        if not block.cell_count():
+            return
+        r2, c2 = row + block.height - 1, col + block.width - 1
+        if not self.history.replaying:
+            old = self.sheet.copy_block(row, col, r2, c2)
+        self.ensure_size(r2, c2)
+        self.emit_changed(self.sheet.paste_block(row, col, block))
+        if not self.history.replaying:
+            self.history.push(BlockRecord(row, col, old, block))
+
+    def ensure_size(self, row, col):
+        """
+        Amplía la hoja para que incluya la celda (fila, columna).
+        """
+        if col >= self.sheet.col_count:
+            self.beginInsertColumns(QModelIndex(), self.sheet.col_count, col)
+            self.sheet.col_count = col + 1
+            self.endInsertColumns()
+        if row >= self.sheet.row_count:
+            self.beginInsertRows(QModelIndex(), self.sheet.row_count, row)
+            self.sheet.row_count = row + 1
+            self.endInsertRows()
+
+    def emit_changed(self, cells):
+        """
+        Notifica el cambio del rectángulo que contiene todas las celdas dadas.
+        """
+        if not cells:
+            return
+        rows = [row for row, col in cells]
+        cols = [col for row, col in cells]
+        self.dataChanged.emit(self.index(min(rows), min(cols)), self.index(max(rows), max(cols)))
+
+    def refresh(self):
+        """
+        Vuelve a pintar todas las celdas (tras un recálculo completo).
+        """
+        if self.sheet.row_count and self.sheet.col_count:
+            self.dataChanged.emit(self.index(0, 0),
+                                  self.index(self.sheet.row_count - 1, self.sheet.col_count - 1))
+
+    @_pausing_recalc
+    def load_rows(self, rows):
+        """
+        Sustituye el contenido de la hoja y de los formatos.
+        """
+        self.beginResetModel()
+        self.styles.clear()
+        self.history.clear()
+        self.sheet.load_rows(rows)
+        self.endResetModel()
+
+    @_pausing_recalc
+    def load_workbook(self, path):
+        """
+        Abre un archivo .pycalc (contenido, estilos y anchos de columna).
+        Devuelve los anchos guardados {columna: ancho}.
+        """
+        self.beginResetModel()
+        self.history.clear()
+        self.styles.clear()
+        self.style_values.clear()
+        try:
+            return load_workbook(path, self.sheet, self.styles)
+        finally:
+            self.endResetModel()
+
+    @_pausing_recalc
+    def begin_import(self):
+        """
+        Vacía la hoja antes de una importación por bloques.
+        """
+        self.beginResetModel()
+        self.styles.clear()
+        self.history.clear()
+        self.sheet.clear()
+        self.sheet.row_count = 0
+        self.sheet.col_count = 0
+        self.endResetModel()
+
+    @_pausing_recalc
+    def append_block(self, block):
+        """
+        Añade un bloque importado con una sola notificación de filas insertadas.
+        """
+        cols = self.sheet.col_count
+        if block.width > cols:
+            self.beginInsertColumns(QModelIndex(), cols, block.width - 1)
+            self.sheet.col_count = block.width
+            self.endInsertColumns()
+        rows = self.sheet.row_count
+        end = block.start + block.height
+        if end > rows:
+            self.beginInsertRows(QModelIndex(), rows, end - 1)
+            self.sheet.append_block(block)
+            self.endInsertRows()
+        else:
+            self.sheet.append_block(block)
+
+    @_pausing_recalc
+    def finish_import(self):
+        """
+        Deja pendientes todas las fórmulas importadas para calcularlas de una
+        vez en segundo plano.
+        """
+        self.sheet.recalculate(set(self.sheet.formulas))
+        self.refresh()
+
+    # --- Formato ---
+    def style_value(self, sid, role):
+        """
+        Valor Qt de un rol para un estilo; se construye una vez por estilo y
+        lo comparten todas las celdas que lo usan.
+        """
+        key = (sid, role)
+        try:
+            return self.style_values[key]
+        except KeyError:
+            pass
+        style = self.styles.table.styles[sid]
+        value = None
+        if role == Qt.FontRole:
+            if (style.font, style.bold, style.italic, style.underline) != (None,) * 4:
+                value = QFont()
+                if style.font is not None:
+                    value.fromString(style.font)
+                if style.bold is not None:
+                    value.setBold(style.bold)
+                if style.italic is not None:
+                    value.setItalic(style.italic)
+                if style.underline is not None:
+                    value.setUnderline(style.underline)
+        elif role == Qt.BackgroundRole:
+            if style.background is not None:
+                value = QColor.fromRgba(style.background)
+        elif role == Qt.ForegroundRole:
+            if style.foreground is not None:
+                value = QColor.fromRgba(style.foreground)
+        elif role == Qt.TextAlignmentRole:
+            value = style.alignment
+        self.style_values[key] = value
+        return value
+
+    def _open_range(self, r1, c1, r2, c2):
+        # Las filas o columnas seleccionadas enteras quedan abiertas hasta el final
+        if r1 == 0 and r2 >= self.sheet.row_count - 1:
+            r2 = None
+        if c1 == 0 and c2 >= self.sheet.col_count - 1:
+            c2 = None
+        return r1, c1, r2, c2
+
+    def set_style(self, ranges, **changes):
+        """
+        Aplica cambios de estilo a los rangos (fila1, col1, fila2, col2):
+        font (QFont.toString()), bold, italic, underline, background y
+        foreground (QColor.rgba()) y alignment. None vuelve al valor
+        predeterminado. Los rangos grandes o de filas/columnas enteras se
+        guardan como un solo tramo.
+        """
+        ranges = [self._open_range(*rng) for rng in ranges]
+        if not ranges:
+            return
+        old = self.styles.state(self.styles.affected(ranges))
+        self.styles.apply(ranges, changes)
+        self.history.push(FormatRecord(old, self.styles.state(old[0])))
+        r1 = min(rng[0] for rng in ranges)
+        c1 = min(rng[1] for rng in ranges)
+        r2 = max(self.sheet.row_count - 1 if rng[2] is None else rng[2] for rng in ranges)
+        c2 = max(self.sheet.col_count - 1 if rng[3] is None else rng[3] for rng in ranges)
+        self.dataChanged.emit(self.index(r1, c1), self.index(r2, c2))
+
+    def clear_style(self, ranges):
+        """
+        Restaura el formato predeterminado de los rangos.
+        """
+        self.set_style(ranges, **dict.fromkeys(STYLE_FIELDS))
+
+    def restore_styles(self, cells, runs):
+        """
+        Deja los tramos y las celdas dadas como en un estado guardado (ver SheetStyles.state).
+        """
+        self.styles.restore(cells, runs)
+        self.refresh()
+
+    # --- Cambios de estructura ---
+    @_pausing_recalc
+    def insert_lines(self, axis, index, count=1):
+        """
+        Inserta filas (axis=0) o columnas (axis=1).
+        """
+        if axis == 0:
+            self.beginInsertRows(QModelIndex(), index, index + count - 1)
+            self.sheet.insert_rows(index, count)
+        else:
+            self.beginInsertColumns(QModelIndex(), index, index + count - 1)
+            self.sheet.insert_cols(index, count)
+        self.styles.shift(axis, index, count)
+        if axis == 0:
+            self.endInsertRows()
+        else:
+            self.endInsertColumns()
+        self.refresh()
+        self.history.push(StructureRecord(axis, index, count, True))
+
+    @_pausing_recalc
+    def remove_lines(self, axis, index, count=1):
+        """
+        Elimina filas (axis=0) o columnas (axis=1), guardando en el historial
+        su contenido y formato, y el texto anterior de las fórmulas que pasan
+        a #REF! o cuyos rangos se recortan.
+        """
+        rows, cols = self.sheet.used_range()
+        if axis == 0:
+            bounds = (index, 0, index + count - 1, max(cols, 1) - 1)
+        else:
+            bounds = (0, index, max(rows, 1) - 1, index + count - 1)
+        content = [(r, c, self.sheet.text(r, c)) for r, c in self.sheet.cells_in_range(*bounds)]
+        styles = self.styles.lines_state(axis, index, count)
+        if axis == 0:
+            self.beginRemoveRows(QModelIndex(), index, index + count - 1)
+            rewritten = self.sheet.remove_rows(index, count)
+        else:
+            self.beginRemoveColumns(QModelIndex(), index, index + count - 1)
+            rewritten = self.sheet.remove_cols(index, count)
+        content += [(r, c, text) for (r, c), text in rewritten.items()]
+        self.styles.shift(axis, index, -count)
+        if axis == 0:
+            self.endRemoveRows()
+        else:
+            self.endRemoveColumns()
+        self.refresh()
+        self.history.push(StructureRecord(axis, index, count, False, content, styles))
+
+    def insert_rows(self, row, count=1):
+        self.insert_lines(0, row, count)
+
+    def remove_rows(self, row, count=1):
+        self.remove_lines(0, row, count)
+
+    def insert_cols(self, col, count=1):
+        self.insert_lines(1, col, count)
+
+    def remove_cols(self, col, count=1):
+        self.remove_lines(1, col, count)
+
+class CsvImportThread(QThread):
+    """
+    Lee un CSV por bloques en segundo plano y los envía a la ventana principal.
+    """
+    block_ready = pyqtSignal(object, float)
+    failed = pyqtSignal(str)
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            for block, progress in read_csv_blocks(self.path):
+                if self.cancelled:
+                    return
+                self.block_ready.emit(block, progress)
+        except Exception as e:
+            self.failed.emit(str(e))
+
+class CsvExportThread(QThread):
+    """
+    Escribe una copia de la hoja en CSV en segundo plano.
+    """
+    progress = pyqtSignal(float)
+    failed = pyqtSignal(str)
+
+    def __init__(self, sheet, path, options, parent=None):
+        super().__init__(parent)
+        self.sheet = sheet
+        self.path = path
+        self.options = options
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        writer = write_csv(self.sheet, self.path, **self.options)
+        try:
+            for fraction in writer:
+                if self.cancelled:
+                    writer.close()
+                    return
+                self.progress.emit(fraction)
+        except Exception as e:
+            self.failed.emit(str(e))
+
+class RecalcThread(QThread):
+    """
+    Recalcula las celdas pendientes de la hoja en segundo plano (ver
+    Recalculation) y envía las celdas calculadas por lotes.
+    """
+    calculated = pyqtSignal(list)
+    failed = pyqtSignal(str)
+
+    def __init__(self, sheet, parent=None):
+        super().__init__(parent)
+        self.job = Recalculation(sheet)
+        self.error = None
+
+    def cancel(self):
+        self.job.cancel()
+
+    def run(self):
+        try:
+            self.job.run(self.calculated.emit)
+        except Exception as e:
+            self.error = str(e)
+            self.failed.emit(self.error)
+
+class PivotThread(QThread):
+    """
+    Agrupa una tabla dinámica en segundo plano sobre una copia de la hoja.
+    """
+    failed = pyqtSignal(str)
+
+    def __init__(self, pivot, sheet, parent=None):
+        super().__init__(parent)
+        self.pivot = pivot
+        self.sheet = sheet
+        self.error = None
+
+    def run(self):
+        try:
+            self.pivot.rebuild(self.sheet)
+        except Exception as e:
+            self.error = str(e)
+            self.failed.emit(self.error)
+
+class AutoFitThread(QThread):
+    """
+    Recorre en segundo plano una copia de la hoja para el ajuste exacto:
+    los textos más largos de cada columna (axis=1) o las filas con textos
+    de varias líneas (axis=0).
+    """
+    failed = pyqtSignal(str)
+
+    def __init__(self, sheet, axis, cols=(), parent=None):
+        super().__init__(parent)
+        self.sheet = sheet
+        self.axis = axis
+        self.cols = cols
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            if self.axis == 1:
+                self.result = {col: longest_texts(self.sheet, col, AUTOFIT_EXACT_CANDIDATES) for col in self.cols}
+            else:
+                self.result = line_counts(self.sheet)
+        except Exception as e:
+            self.error = str(e)
+            self.failed.emit(self.error)
+
+class AutoFitter:
+    """
+    Ajusta anchos de columna y altos de fila al contenido sin medir todas las
+    celdas: se miden las filas visibles, una muestra aleatoria de filas y los
+    textos más largos de cada columna (los que la hoja recuerda al importar y
+    editar o, en el ajuste exacto, los que se buscan en segundo plano). Las
+    métricas de fuente se guardan por estilo.
+    """
+    def __init__(self, table, model):
+        self.table = table
+        self.model = model
+        self.metrics = {}  # campos de fuente del estilo -> QFontMetrics
+        self.rng = np.random.default_rng()
+
+    def font_metrics(self, sid):
+        """
+        Métricas de la fuente de un estilo; los estilos que solo cambian
+        colores o alineación comparten las de la fuente de la tabla.
+        """
+        key = None
+        if sid:
+            style = self.model.styles.table.styles[sid]
+            key = (style.font, style.bold, style.italic, style.underline)
+            if key == (None,) * 4:
+                key = None
+        metrics = self.metrics.get(key)
+        if metrics is None:
+            font = self.table.font()
+            if key is not None:
+                font = self.model.style_value(sid, Qt.FontRole).resolve(font)
+            metrics = self.metrics[key] = QFontMetrics(font)
+        return metrics
+
+    def margins(self):
+        # Márgenes que añade el delegado de la vista a cada lado del texto
+        style = self.table.style()
+        return (2 * (style.pixelMetric(QStyle.PM_FocusFrameHMargin, None, self.table) + 1),
+                2 * (style.pixelMetric(QStyle.PM_FocusFrameVMargin, None, self.table) + 1))
+
+    def visible(self, header, count):
+        """
+        Secciones visibles de una cabecera (filas o columnas).
+        """
+        if not count:
+            return range(0)
+        viewport = header.viewport()
+        extent = viewport.width() if header.orientation() == Qt.Horizontal else viewport.height()
+        first = header.logicalIndexAt(0)
+        last = header.logicalIndexAt(extent - 1)
+        return range(max(first, 0), (count - 1 if last < 0 else last) + 1)
+
+    def rows_to_measure(self, rows):
+        """
+        Filas visibles más una muestra aleatoria de las 'rows' primeras.
+        """
+        chosen = set(self.visible(self.table.verticalHeader(), self.model.rowCount()))
+        if rows <= AUTOFIT_SAMPLE_ROWS:
+            chosen.update(range(rows))
+        else:
+            chosen.update(self.rng.choice(rows, AUTOFIT_SAMPLE_ROWS, replace=False).tolist())
+        return chosen
+
+    def _measure(self, cells, sizes):
+        # Tamaño (ancho, alto) de cada texto [(fila, columna, texto)]; se
+        # mide una vez cada texto distinto por estilo
+        styles = self.model.styles
+        for row, col, text in cells:
+            sid = styles.style_id(row, col)
+            size = sizes.get((sid, text))
+            if size is None:
+                metrics = self.font_metrics(sid)
+                lines = text.split('\n')
+                size = sizes[(sid, text)] = (max(map(metrics.horizontalAdvance, lines)),
+                                             metrics.height() * len(lines))
+            yield row, col, size
+
+    def column_widths(self, cols, longest=None):
+        """
+        Anchos {columna: ancho} para las columnas dadas. 'longest' da los
+        textos más largos de cada columna {columna: [(fila, texto)]}; por
+        defecto, los que ha ido recordando la hoja. Las columnas en las que
+        no se ve ningún texto no se incluyen.
+        """
+        sheet = self.model.sheet
+        rows = self.rows_to_measure(sheet.used_range()[0])
+        header = self.table.horizontalHeader()
+        margin = self.margins()[0]
+        sizes = {}
+        widths = {}
+        for col in cols:
+            texts = {(row, sheet.display(row, col)) for row in rows}
+            texts.update(sheet.widths.candidates(sheet, col) if longest is None else longest.get(col, ()))
+            cells = [(row, col, text) for row, text in texts if text]
+            width = max((size[0] for row, col, size in self._measure(cells, sizes)), default=None)
+            if width is not None:
+                widths[col] = max(width + margin, header.sectionSizeHint(col))
+        return widths
+
+    def row_heights(self, rows):
+        """
+        Altos {fila: alto} de las filas dadas, midiendo todas sus celdas con contenido.
+        """
+        sheet = self.model.sheet
+        header = self.table.verticalHeader()
+        margin = self.margins()[1]
+        cols = sheet.used_range()[1]
+        sizes = {}
+        heights = {}
+        for row in rows:
+            cells = [(row, col, text) for col in range(cols) for text in (sheet.display(row, col),) if text]
+            height = max((size[1] for r, c, size in self._measure(cells, sizes)), default=0)
+            heights[row] = max(height + margin, header.sectionSizeHint(row))
+        return heights
+
+    def base_height(self):
+        """
+        Alto de una fila de una línea con la fuente de la tabla.
+        """
+        header = self.table.verticalHeader()
+        return max(self.font_metrics(0).height() + self.margins()[1],
+                   header.sectionSizeHint(0) if self.model.rowCount() else header.minimumSectionSize())
+
+    def apply(self, header, sizes):
+        # Solo se tocan las secciones que cambian: cada cambio recoloca la vista
+        for index, size in sizes.items():
+            if header.sectionSize(index) != size:
+                header.resizeSection(index, size)
+
+    def fit_columns(self, cols, longest=None):
+        self.apply(self.table.horizontalHeader(), self.column_widths(cols, longest))
+
+    def fit_rows(self, lines=None):
+        """
+        Ajusta el alto de las filas. Se miden las visibles y una muestra, y
+        el alto más repetido pasa a ser el de todas las demás. Con 'lines'
+        ({fila: líneas}, del ajuste exacto) las demás toman el alto de una
+        línea y se miden también las de varias líneas y las que tienen
+        estilo propio.
+        """
+        sheet = self.model.sheet
+        header = self.table.verticalHeader()
+        if lines is None:
+            heights = self.row_heights(self.rows_to_measure(sheet.used_range()[0]))
+            values, counts = np.unique(list(heights.values()) or [self.base_height()], return_counts=True)
+            default = int(values[np.argmax(counts)])
+        else:
+            rows = set(lines) | set(self.visible(header, self.model.rowCount()))
+            for column in self.model.styles.cells.values():
+                rows.update(column)
+            heights = self.row_heights(row for row in rows if row < sheet.row_count)
+            default = self.base_height()
+        # Cambiar el alto predeterminado cambia de una vez el de todas las filas
+        header.setDefaultSectionSize(default)
+        self.apply(header, heights)
+
+class CsvExportDialog(QDialog):
+    """
+    Opciones de exportación: separador, comillas, codificación y contenido.
+    """
+    DELIMITERS = [("Coma (,)", ','), ("Punto y coma (;)", ';'), ("Tabulador", '\t'), ("Barra (|)", '|')]
+    QUOTING = [("Solo cuando haga falta", csv.QUOTE_MINIMAL), ("Todos los campos", csv.QUOTE_ALL),
+               ("Textos (números sin comillas)", csv.QUOTE_NONNUMERIC)]
+    ENCODINGS = ['utf-8', 'utf-8-sig', 'latin-1', 'cp1252']
+    CONTENTS = [("Valores", False), ("Fórmulas", True)]
+
+    def __init__(self, tsv=False, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Opciones de exportación")
+        layout = QFormLayout(self)
+        self.delimiter = QComboBox()
+        self.delimiter.addItems([name for name, _ in self.DELIMITERS])
+        self.delimiter.setCurrentIndex(2 if tsv else 0)
+        self.quoting = QComboBox()
+        self.quoting.addItems([name for name, _ in self.QUOTING])
+        self.encoding = QComboBox()
+        self.encoding.addItems(self.ENCODINGS)
+        self.contents = QComboBox()
+        self.contents.addItems([name for name, _ in self.CONTENTS])
+        layout.addRow("Separador:", self.delimiter)
+        layout.addRow("Comillas:", self.quoting)
+        layout.addRow("Codificación:", self.encoding)
+        layout.addRow("Guardar:", self.contents)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+    def options(self):
+        """
+        Devuelve las opciones elegidas como argumentos de write_csv().
+        """
+        return {
+            'delimiter': self.DELIMITERS[self.delimiter.currentIndex()][1],
+            'quoting': self.QUOTING[self.quoting.currentIndex()][1],
+            'encoding': self.encoding.currentText(),
+            'formulas': self.CONTENTS[self.contents.currentIndex()][1],
+        }
+
+class FindReplaceDialog(QDialog):
+    """
+    Diálogo no modal de buscar y reemplazar. Las búsquedas usan el índice de
+    texto de la hoja y los reemplazos se aplican de una vez con set_cells
+    (un solo recálculo y una sola notificación a la vista).
+    """
+    def __init__(self, main):
+        super().__init__(main)
+        self.main = main
+        self.setWindowTitle("Buscar y reemplazar")
+        self.find_edit = QLineEdit()
+        self.replace_edit = QLineEdit()
+        self.regex_box = QCheckBox("Expresión regular")
+        self.case_box = QCheckBox("Coincidir mayúsculas y minúsculas")
+        self.whole_box = QCheckBox("Celda completa")
+        self.status = QLabel()
+        form = QFormLayout()
+        form.addRow("Buscar:", self.find_edit)
+        form.addRow("Reemplazar por:", self.replace_edit)
+        form.addRow(self.regex_box)
+        form.addRow(self.case_box)
+        form.addRow(self.whole_box)
+        buttons = QHBoxLayout()
+        for text, slot in (("Buscar siguiente", self.find_next), ("Buscar todo", self.find_all),
+                           ("Reemplazar", self.replace), ("Reemplazar todo", self.replace_all),
+                           ("Cerrar", self.close)):
+            btn = QPushButton(text)
+            btn.clicked.connect(slot)
+            buttons.addWidget(btn)
+        layout = QVBoxLayout(self)
+        layout.addLayout(form)
+        layout.addLayout(buttons)
+        layout.addWidget(self.status)
+        # Coincidencias de la última búsqueda; se descartan al cambiar el texto,
+        # las opciones o la hoja
+        self.matches = None
+        self.find_edit.textChanged.connect(self.invalidate)
+        for box in (self.regex_box, self.case_box, self.whole_box):
+            box.toggled.connect(self.invalidate)
+        model = main.model
+        model.dataChanged.connect(self.invalidate)
+        model.layoutChanged.connect(self.invalidate)
+        model.modelReset.connect(self.invalidate)
+        model.rowsInserted.connect(self.invalidate)
+        model.rowsRemoved.connect(self.invalidate)
+        model.columnsInserted.connect(self.invalidate)
+        model.columnsRemoved.connect(self.invalidate)
+
+    def invalidate(self, *args):
+        self.matches = None
+
+    def options(self):
+        return {'regex': self.regex_box.isChecked(), 'case': self.case_box.isChecked(),
+                'whole': self.whole_box.isChecked()}
+
+    def search(self):
+        """
+        Devuelve las celdas que coinciden (ordenadas por filas) o None si el
+        patrón no es válido.
+        """
+        if self.matches is None:
+            try:
+                self.matches = self.main.sheet.find(self.find_edit.text(), **self.options())
+            except re.error as e:
+                self.status.setText(f"Expresión regular no válida: {e}")
+                return None
+        return self.matches
+
+    def find_next(self):
+        """
+        Va a la siguiente coincidencia después de la celda actual (vuelve al
+        principio al llegar al final).
+        """
+        matches = self.search()
+        if matches is None:
+            return
+        if not matches:
+            self.status.setText("No se encontraron coincidencias.")
+            return
+        current = self.main.table.currentIndex()
+        pos = (current.row(), current.column()) if current.isValid() else (-1, -1)
+        i = bisect_right(matches, pos)
+        if i == len(matches):
+            i = 0
+        index = self.main.model.index(*matches[i])
+        self.main.table.setCurrentIndex(index)
+        self.main.table.scrollTo(index)
+        self.status.setText(f"Coincidencia {i + 1} de {len(matches)}.")
+
+    def find_all(self):
+        """
+        Selecciona todas las coincidencias; las filas seguidas de una misma
+        columna se seleccionan como un único rango.
+        """
+        matches = self.search()
+        if matches is None:
+            return
+        model = self.main.model
+        selection = QItemSelection()
+        start = prev = None
+        for cell in sorted(matches, key=lambda cell: (cell[1], cell[0])) + [None]:
+            if prev is not None and cell != (prev[0] + 1, prev[1]):
+                selection.select(model.index(*start), model.index(*prev))
+                start = None
+            if start is None:
+                start = cell
+            prev = cell
+        self.main.table.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect)
+        if matches:
+            self.main.table.scrollTo(model.index(*matches[0]))
+        self.status.setText(f"{len(matches)} coincidencias.")
+
+    def replace(self):
+        """
+        Reemplaza en la celda actual si coincide y pasa a la siguiente.
+        """
+        matches = self.search()
+        if matches is None:
+            return
+        current = self.main.table.currentIndex()
+        cell = (current.row(), current.column())
+        if current.isValid() and cell in set(matches):
+            self.main.model.set_cells(self.main.sheet.replacements(
+                self.find_edit.text(), self.replace_edit.text(), cells=[cell], **self.options()))
+        self.find_next()
+
+    def replace_all(self):
+        """
+        Reemplaza todas las coincidencias en un único lote.
+        """
+        try:
+            updates = self.main.sheet.replacements(self.find_edit.text(), self.replace_edit.text(),
+                                                   **self.options())
+        except re.error as e:
+            self.status.setText(f"Expresión regular no válida: {e}")
+            return
+        self.main.model.set_cells(updates)
+        self.status.setText(f"{len(updates)} celdas reemplazadas.")
+
+class SortDialog(QDialog):
+    """
+    Diálogo de ordenación por varias claves, cada una con su sentido.
+    """
+    LEVELS = 3
+
+    def __init__(self, columns, current=0, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Ordenar")
+        form = QFormLayout(self)
+        self.keys = []
+        for i in range(self.LEVELS):
+            column = QComboBox()
+            if i:
+                column.addItem("(ninguna)")
+            column.addItems(columns)
+            if not i:
+                column.setCurrentIndex(max(current, 0))
+            direction = QComboBox()
+            direction.addItems(["Ascendente", "Descendente"])
+            row = QHBoxLayout()
+            row.addWidget(column)
+            row.addWidget(direction)
+            form.addRow("Ordenar por:" if not i else "Luego por:", row)
+            self.keys.append((column, direction))
+        self.header = QCheckBox("La primera fila es un encabezado")
+        form.addRow(self.header)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+
+    def options(self):
+        """
+        Devuelve (claves [(columna, descendente)], fila inicial).
+        """
+        keys = []
+        for i, (column, direction) in enumerate(self.keys):
+            col = column.currentIndex() - (1 if i else 0)
+            if col >= 0 and col not in (k[0] for k in keys):
+                keys.append((col, direction.currentIndex() == 1))
+        return keys, 1 if self.header.isChecked() else 0
+
+class PivotDialog(QDialog):
+    """
+    Diálogo de tabla dinámica: campos que agrupan en filas y en columnas,
+    campos resumidos con su función y celda de destino.
+    """
+    ROW_LEVELS = 2
+    VALUE_LEVELS = 3
+
+    def __init__(self, fields, target, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Tabla dinámica")
+        self.fields = fields  # [(columna, nombre)]
+        names = [f"{column_name(col)}: {name}" if name else column_name(col) for col, name in fields]
+        form = QFormLayout(self)
+        self.row_fields = []
+        for i in range(self.ROW_LEVELS):
+            combo = QComboBox()
+            if i:
+                combo.addItem("(ninguno)")
+            combo.addItems(names)
+            form.addRow("Filas:" if not i else "Luego por:", combo)
+            self.row_fields.append(combo)
+        self.column_field = QComboBox()
+        self.column_field.addItem("(ninguno)")
+        self.column_field.addItems(names)
+        form.addRow("Columnas:", self.column_field)
+        self.value_fields = []
+        for i in range(self.VALUE_LEVELS):
+            field = QComboBox()
+            if i:
+                field.addItem("(ninguno)")
+            field.addItems(names)
+            if not i:
+                field.setCurrentIndex(len(names) - 1)
+            function = QComboBox()
+            function.addItems(PIVOT_FUNCTIONS)
+            row = QHBoxLayout()
+            row.addWidget(field)
+            row.addWidget(function)
+            form.addRow("Valores:" if not i else "", row)
+            self.value_fields.append((field, function))
+        self.header = QCheckBox("La primera fila es un encabezado")
+        self.header.setChecked(True)
+        form.addRow(self.header)
+        self.target = QLineEdit(target)
+        form.addRow("Destino:", self.target)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+
+    def _field(self, combo, optional):
+        i = combo.currentIndex() - (1 if optional else 0)
+        return self.fields[i][0] if i >= 0 else None
+
+    def options(self):
+        """
+        Devuelve (columnas de filas, columna de columnas o None,
+        [(columna, función)], encabezado, texto del destino).
+        """
+        rows = []
+        for i, combo in enumerate(self.row_fields):
+            col = self._field(combo, i > 0)
+            if col is not None and col not in rows:
+                rows.append(col)
+        column = self._field(self.column_field, True)
+        values = []
+        for i, (field, function) in enumerate(self.value_fields):
+            col = self._field(field, i > 0)
+            if col is not None:
+                values.append((col, function.currentText()))
+        return rows, column, values, self.header.isChecked(), self.target.text().strip()
+
+class ProfileDialog(QDialog):
+    """
+    Informe del perfilador: fórmulas y celdas con más tiempo de evaluación,
+    operaciones largas y aciertos de las cachés. Doble clic en una celda la
+    selecciona en la hoja.
+    """
+    ROWS = 200
+
+    def __init__(self, main):
+        super().__init__(main)
+        self.main = main
+        self.setWindowTitle("Rendimiento")
+        self.resize(700, 500)
+        layout = QVBoxLayout(self)
+        self.tabs = QTabWidget()
+        self.formulas = self._table(["Fórmula", "Evaluaciones", "Total (ms)", "Media (ms)"])
+        self.cells = self._table(["Celda", "Fórmula", "Evaluaciones", "Total (ms)"])
+        self.operations = self._table(["Operación", "Veces", "Total (ms)"])
+        self.caches = self._table(["Caché", "Aciertos", "Fallos"])
+        self.cells.cellDoubleClicked.connect(self.go_to_cell)
+        self.tabs.addTab(self.formulas, "Fórmulas")
+        self.tabs.addTab(self.cells, "Celdas")
+        self.tabs.addTab(self.operations, "Operaciones")
+        self.tabs.addTab(self.caches, "Cachés")
+        layout.addWidget(self.tabs)
+        self.status = QLabel()
+        layout.addWidget(self.status)
+        buttons = QHBoxLayout()
+        for text, slot in (("Actualizar", self.update_report), ("Reiniciar", self.reset),
+                           ("Exportar traza...", self.export_trace), ("Cerrar", self.close)):
+            button = QPushButton(text)
+            button.clicked.connect(slot)
+            buttons.addWidget(button)
+        layout.addLayout(buttons)
+        self.update_report()
+
+    def _table(self, headers):
+        table = QTableWidget(0, len(headers))
+        table.setHorizontalHeaderLabels(headers)
+        table.setEditTriggers(QTableWidget.NoEditTriggers)
+        table.setSelectionBehavior(QTableWidget.SelectRows)
+        table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        table.verticalHeader().hide()
+        return table
+
+    def _fill(self, table, rows):
+        table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row):
+                table.setItem(i, j, QTableWidgetItem(value))
+
+    def update_report(self):
+        """
+        Vuelve a leer lo medido por el perfilador.
+        """
+        sheet = self.main.sheet
+        self._fill(self.formulas, [(formula, str(count), f"{seconds * 1000:.3f}", f"{seconds * 1000 / count:.4f}")
+                                   for formula, count, seconds in PROFILER.slowest_formulas(self.ROWS)])
+        self._fill(self.cells, [(f"{column_name(col)}{row + 1}", sheet.formulas.get((row, col), ""),
+                                 str(count), f"{seconds * 1000:.3f}")
+                                for (row, col), count, seconds in PROFILER.slowest(self.ROWS)])
+        self._fill(self.operations, [(name, str(count), f"{seconds * 1000:.1f}")
+                                     for name, (count, seconds)
+                                     in sorted(PROFILER.spans.items(), key=lambda item: -item[1][1])])
+        self._fill(self.caches, [(name, str(hits), str(misses))
+                                 for name, (hits, misses) in sorted(PROFILER.cache_stats().items())])
+        state = "activado" if PROFILER.enabled else "desactivado (Ver > Perfilar rendimiento)"
+        self.status.setText(f"Perfilador {state}. {len(PROFILER.events)} eventos en la traza"
+                            + (f", {PROFILER.dropped} descartados." if PROFILER.dropped else "."))
+
+    def reset(self):
+        PROFILER.reset()
+        self.update_report()
+
+    def export_trace(self):
+        """
+        Guarda la traza en JSON para chrome://tracing o Perfetto.
+        """
+        path, _ = QFileDialog.getSaveFileName(self, "Exportar traza", "traza.json", "Traza JSON (*.json)")
+        if not path:
+            return
+        try:
+            PROFILER.write_trace(path)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"No se pudo guardar la traza:\n{e}")
+
+    def go_to_cell(self, row, column):
+        pos = self.main.sheet.cell_to_pos(self.cells.item(row, 0).text())
+        if pos is not None:
+            index = self.main.model.index(*pos)
+            self.main.table.setCurrentIndex(index)
+            self.main.table.scrollTo(index)
 
 class ChartDialog(QDialog):
     """
-    Diálogo para mostrar gráficos de barras o pastel usando matplotlib.
+    Diálogo no modal con un gráfico de un rango de la hoja usando matplotlib.
+    matplotlib se importa la primera vez que se abre un gráfico, no al arrancar.
+    Las series grandes se reducen antes de dibujarlas (mínimo/máximo por grupo
+    en las líneas, LTTB en la dispersión) y el gráfico se actualiza solo cuando
+    cambian celdas de su rango, redibujando las líneas con blitting.
     """
-    def __init__(self, data, chart_type, parent=None):
+    TYPES = ["Barras", "Pastel", "Línea", "Dispersión"]
+    MAX_POINTS = 2000  # puntos dibujados por serie en línea y dispersión
+    MAX_BARS = 500
+    MAX_SLICES = 20
+
+    def __init__(self, sheet, bounds, chart_type, parent=None):
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.figure import Figure
         super().__init__(parent)
-        self.setWindowTitle("Gráfico")
+        self.sheet = sheet
+        self.bounds = bounds
+        self.chart_type = chart_type
+        r1, c1, r2, c2 = bounds
+        self.setWindowTitle(f"Gráfico {column_name(c1)}{r1 + 1}:{column_name(c2)}{r2 + 1}")
         layout = QVBoxLayout(self)
-        fig = Figure(figsize=(5, 3))
-        self.canvas = FigureCanvas(fig)
-        ax = fig.add_subplot(111)
-        # Selección del tipo de gráfico
-        if chart_type == 'Barras':
-            ax.bar(range(len(data)), data)
-        elif chart_type == 'Pastel':
-            ax.pie(data, labels=[str(i + 1) for i in range(len(data))], autopct='%1.1f%%')
+        self.figure = Figure(figsize=(5, 3))
+        self.canvas = FigureCanvas(self.figure)
+        self.ax = self.figure.add_subplot(111)
+        self.lines = []
+        self.decimators = []
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
         layout.addWidget(self.canvas)
         btn = QPushButton("Cerrar")
         btn.clicked.connect(self.accept)
         layout.addWidget(btn)
+        # Los cambios de celdas se agrupan y se aplican juntos
+        self.pending = None  # (fila1, col1, fila2, col2) pendiente de actualizar
+        self.update_timer = QTimer(self)
+        self.update_timer.setSingleShot(True)
+        self.update_timer.setInterval(50)
+        self.update_timer.timeout.connect(self.apply_updates)
+        self.redraw()
+
+    @property
+    def blitted(self):
+        return self.chart_type in ("Línea", "Dispersión")
+
+    def series(self, col):
+        """
+        Devuelve (x, y) de una columna del rango; x es el número de fila.
+        """
+        r1, c1, r2, c2 = self.bounds
+        y = self.sheet.range_matrix(r1, col, r2, col)[:, 0]
+        return np.arange(r1 + 1, r2 + 2), y
+
+    def redraw(self):
+        """
+        Vuelve a construir el gráfico completo.
+        """
+        ax = self.ax
+        ax.clear()
+        self.lines = []
+        self.decimators = []
+        r1, c1, r2, c2 = self.bounds
+        if self.chart_type == "Línea":
+            for col in range(c1, c2 + 1):
+                x, y = self.series(col)
+                decimator = MinMaxDecimator(y, self.MAX_POINTS)
+                idx, points = decimator.points()
+                line, = ax.plot(x[idx], points, animated=True, label=column_name(col))
+                self.lines.append(line)
+                self.decimators.append(decimator)
+        elif self.chart_type == "Dispersión":
+            for col in range(c1, c2 + 1):
+                x, y = lttb(*self.series(col), self.MAX_POINTS)
+                line, = ax.plot(x, y, '.', markersize=3, animated=True, label=column_name(col))
+                self.lines.append(line)
+        elif self.chart_type == "Barras":
+            data = self.sheet.range_array(*self.bounds)
+            if len(data) > self.MAX_BARS:
+                # Una barra por grupo de valores consecutivos, con su promedio
+                size = -(-len(data) // self.MAX_BARS)
+                padded = np.full(-(-len(data) // size) * size, np.nan)
+                padded[:len(data)] = data
+                means = np.nanmean(padded.reshape(-1, size), axis=1)
+                ax.bar(np.arange(len(means)) * size, means, width=size, align='edge')
+                ax.set_title(f"Promedio por grupos de {size} valores", fontsize=9)
+            else:
+                ax.bar(range(len(data)), data)
+        elif self.chart_type == "Pastel":
+            data = self.sheet.range_array(*self.bounds)
+            labels = np.arange(1, len(data) + 1).astype(str)
+            # Solo los valores positivos tienen porción
+            labels, data = labels[data > 0], data[data > 0]
+            if len(data) > self.MAX_SLICES:
+                # Las porciones más pequeñas se agrupan en "Otros"
+                order = np.argsort(data)[::-1]
+                top = order[:self.MAX_SLICES - 1]
+                labels = list(labels[top]) + ["Otros"]
+                data = np.append(data[top], data[order[self.MAX_SLICES - 1:]].sum())
+            ax.pie(data, labels=labels, autopct='%1.1f%%')
+        if self.lines:
+            ax.relim()
+            ax.autoscale_view()
+            if len(self.lines) > 1:
+                ax.legend(loc='best', fontsize=8)
+        self.canvas.draw_idle()
+
+    def on_draw(self, event):
+        """
+        Tras un dibujado completo guarda el fondo y pinta encima las series
+        animadas, que así pueden actualizarse después sin redibujar los ejes.
+        """
+        if not self.blitted:
+            return
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_lines()
+
+    def draw_lines(self):
+        for line in self.lines:
+            self.ax.draw_artist(line)
+        self.canvas.blit(self.ax.bbox)
+
+    def on_data_changed(self, top_left, bottom_right, roles=None):
+        """
+        Recibe los cambios del modelo; si tocan el rango del gráfico, programa
+        la actualización de la parte afectada.
+        """
+        r1, c1, r2, c2 = self.bounds
+        rows = max(r1, top_left.row()), min(r2, bottom_right.row())
+        cols = max(c1, top_left.column()), min(c2, bottom_right.column())
+        if rows[0] > rows[1] or cols[0] > cols[1]:
+            return
+        if self.pending:
+            p1, q1, p2, q2 = self.pending
+            rows = min(rows[0], p1), max(rows[1], p2)
+            cols = min(cols[0], q1), max(cols[1], q2)
+        self.pending = (rows[0], cols[0], rows[1], cols[1])
+        self.update_timer.start()
+
+    def apply_updates(self):
+        """
+        Aplica los cambios pendientes: en las líneas solo se recalculan los
+        grupos afectados y se redibujan las series sobre el fondo guardado.
+        """
+        if not self.pending:
+            return
+        p1, q1, p2, q2 = self.pending
+        self.pending = None
+        r1, c1, r2, c2 = self.bounds
+        if not self.blitted:
+            self.redraw()
+            return
+        for col in range(q1, q2 + 1):
+            line = self.lines[col - c1]
+            if self.chart_type == "Línea":
+                decimator = self.decimators[col - c1]
+                decimator.update(p1 - r1, self.sheet.range_matrix(p1, col, p2, col)[:, 0])
+                idx, points = decimator.points()
+                line.set_data(idx + r1 + 1, points)
+            else:
+                line.set_data(*lttb(*self.series(col), self.MAX_POINTS))
+        # Si los datos se salen de los ejes hace falta un dibujado completo
+        low, high = self.ax.get_ylim()
+        ys = np.concatenate([line.get_ydata() for line in self.lines])
+        ys = ys[~np.isnan(ys)]
+        if self.background is None or (len(ys) and (ys.min() < low or ys.max() > high)):
+            self.ax.relim()
+            self.ax.autoscale_view()
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_lines()
 
 class ExcelClone(QMainWindow):
     """
@@ -45,37 +1552,57 @@ class ExcelClone(QMainWindow):
         self.resize(1400, 900)
         # --- Generar nombres de columnas estilo Excel (A, B, ..., Z, AA, AB, ..., ZZ) ---
         self.column_names = self.generate_excel_columns(80)  # 80 columnas: A...CB
-        self.table = QTableWidget(100, len(self.column_names))
-        self.table.setHorizontalHeaderLabels(self.column_names)
+        # Hoja (datos y fórmulas) y modelo virtual: la vista solo pide las celdas visibles
+        self.sheet = Sheet(100, len(self.column_names))
+        self.model = SheetModel(self.sheet, self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
         self.setCentralWidget(self.table)
         self.apply_stylesheet()
         self.create_menu()
         self.create_statusbar()
         # Conexiones de señales y slots
-        self.table.cellChanged.connect(self.evaluate_formula)
         self.table.setContextMenuPolicy(Qt.CustomContextMenu)
         self.table.customContextMenuRequested.connect(self.show_context_menu)
-        self.table.itemSelectionChanged.connect(self.update_statusbar)
+        self.table.selectionModel().selectionChanged.connect(self.update_statusbar)
+        self.table.selectionModel().currentChanged.connect(self.update_statusbar)
+        self.table.selectionModel().selectionChanged.connect(self.schedule_stats)
+        self.model.dataChanged.connect(self.schedule_stats)
+        self.model.modelReset.connect(self.schedule_stats)
+        # Las tablas dinámicas siguen los cambios de su rango de origen
+        self.model.dataChanged.connect(self.mark_pivots)
+        for signal in (self.model.rowsInserted, self.model.rowsRemoved):
+            signal.connect(lambda parent, first, last: self.mark_pivot_lines(0, first))
+        for signal in (self.model.columnsInserted, self.model.columnsRemoved):
+            signal.connect(lambda parent, first, last: self.mark_pivot_lines(1, first))
+        self.model.layoutChanged.connect(self.mark_all_pivots)
+        self.model.modelReset.connect(self.drop_pivots)
+        # Estado del recálculo en segundo plano
+        self.model.recalc_state.connect(self.update_calc_state)
+        self.model.recalc_failed.connect(lambda message: QMessageBox.critical(
+            self, "Error", f"No se pudo recalcular la hoja:\n{message}"))
         # Variables auxiliares
-        self.clipboard = None
-        self.undo_stack = []
-        self.redo_stack = []
+        self.import_thread = None
+        self.export_thread = None
+        self.workbook_path = None  # libro .pycalc abierto, donde guarda "Guardar"
+        self.find_dialog = None
+        self.profile_dialog = None
+        self.clipboard = None       # último bloque copiado (ClipBlock)
+        self.clipboard_text = None  # su texto TSV, para reconocerlo en el portapapeles
+        self.pivots = []            # tablas dinámicas de la hoja
+        self.pivot_threads = {}     # tabla dinámica -> PivotThread que la está agrupando
+        self.pivot_timer = QTimer(self)
+        self.pivot_timer.setSingleShot(True)
+        self.pivot_timer.setInterval(PIVOT_DELAY_MS)
+        self.pivot_timer.timeout.connect(self.refresh_pivots)
+        self.autofit = AutoFitter(self.table, self.model)
+        self.autofit_thread = None  # AutoFitThread del ajuste exacto en curso
 
     def generate_excel_columns(self, n):
         """
         Genera nombres de columnas estilo Excel hasta n columnas.
         """
-        cols = []
-        for i in range(n):
-            name = ''
-            j = i
-            while True:
-                name = chr(65 + (j % 26)) + name
-                j = j // 26 - 1
-                if j < 0:
-                    break
-            cols.append(name)
-        return cols
+        return [column_name(i) for i in range(n)]
 
     def apply_stylesheet(self):
         """
@@ -85,7 +1612,7 @@ class ExcelClone(QMainWindow):
             QMainWindow {
                 background: #f5f6fa;
             }
-            QTableWidget {
+            QTableView {
                 background: #ffffff;
                 alternate-background-color: #f0f0f0;
                 gridline-color: #d1d8e6;
@@ -126,20 +1653,95 @@ class ExcelClone(QMainWindow):
         """
         self.statusbar = QStatusBar()
         self.setStatusBar(self.statusbar)
+        # Estadísticas de la selección; se calculan cuando la selección deja
+        # de cambiar durante STATS_DELAY_MS para no frenar el arrastre
+        self.stats_label = QLabel()
+        self.statusbar.addPermanentWidget(self.stats_label)
+        self.stats_timer = QTimer(self)
+        self.stats_timer.setSingleShot(True)
+        self.stats_timer.setInterval(STATS_DELAY_MS)
+        self.stats_timer.timeout.connect(self.update_selection_stats)
+        # Progreso y cancelación de las tareas largas (importación y exportación)
+        self.progress = QProgressBar()
+        self.progress.setMaximumWidth(200)
+        self.progress.setRange(0, 100)
+        self.cancel_button = QPushButton("Cancelar")
+        self.cancel_button.clicked.connect(self.cancel_tasks)
+        self.statusbar.addPermanentWidget(self.progress)
+        self.statusbar.addPermanentWidget(self.cancel_button)
+        self.progress.hide()
+        self.cancel_button.hide()
+        # Recálculo: progreso en automático o aviso de celdas sin calcular en manual
+        self.calc_label = QLabel()
+        self.statusbar.addPermanentWidget(self.calc_label)
+        self.calc_label.hide()
         self.update_statusbar()
 
     def update_statusbar(self):
         """
         Muestra información de la celda seleccionada en la barra de estado.
         """
-        items = self.table.selectedItems()
-        if items:
-            row = items[0].row() + 1
-            col = chr(items[0].column() + 65)
-            self.statusbar.showMessage(f"Celda: {col}{row} | Valor: {items[0].text()}")
+        index = self.table.currentIndex()
+        if index.isValid():
+            row, col = index.row(), index.column()
+            value = self.sheet.display(row, col)
+            self.statusbar.showMessage(f"Celda: {column_name(col)}{row + 1} | Valor: {value}")
         else:
             self.statusbar.showMessage("")
 
+    def update_calc_state(self):
+        """
+        Muestra en la barra de estado si se está recalculando (y cuánto
+        falta) o si, en modo manual, hay celdas sin calcular.
+        """
+        thread = self.model.recalc_thread
+        if thread is not None:
+            job = thread.job
+            percent = int(100 * job.done / job.total) if job.total else 0
+            self.calc_label.setText(f"Calculando... {percent} %")
+        elif self.model.outdated():
+            self.calc_label.setText("Calcular (F9)")
+        else:
+            self.calc_label.hide()
+            return
+        self.calc_label.show()
+
+    def schedule_stats(self, *args):
+        """
+        Reinicia la espera antes de recalcular las estadísticas de la selección.
+        """
+        self.stats_timer.start()
+
+    def update_selection_stats(self):
+        """
+        Muestra suma, promedio, recuento, mínimo y máximo de los números
+        seleccionados, como la barra de estado de Excel.
+        """
+        stats = self.sheet.selection_stats(self.selected_ranges())
+        if stats is None:
+            self.stats_label.clear()
+            return
+        count, total, low, high = stats
+        self.stats_label.setText(
+            f"Suma: {format_number(total)} | Promedio: {format_number(total / count)} | "
+            f"Recuento: {count} | Mín: {format_number(low)} | Máx: {format_number(high)}")
+
+    def selected_ranges(self):
+        """
+        Devuelve los rangos seleccionados como (fila1, col1, fila2, col2).
+        """
+        return [(r.top(), r.left(), r.bottom(), r.right())
+                for r in self.table.selectionModel().selection()]
+
+    def selected_cells(self):
+        """
+        Devuelve todas las celdas seleccionadas como (fila, columna).
+        """
+        cells = []
+        for r1, c1, r2, c2 in self.selected_ranges():
+            cells.extend((row, col) for row in range(r1, r2 + 1) for col in range(c1, c2 + 1))
+        return cells
+
     def show_context_menu(self, pos):
         """
         Muestra el menú contextual al hacer clic derecho en la tabla.
@@ -179,59 +1781,107 @@ class ExcelClone(QMainWindow):
         self.copy_cells()
         self.clear_cells()
 
+    def undo(self):
+        """
+        Deshace el último cambio de la hoja.
+        """
+        with self.model.paused():
+            done = self.model.history.undo(self.model)
+        if not done:
+            self.statusbar.showMessage("No hay nada que deshacer.", 3000)
+
+    def redo(self):
+        """
+        Rehace el último cambio deshecho.
+        """
+        with self.model.paused():
+            done = self.model.history.redo(self.model)
+        if not done:
+            self.statusbar.showMessage("No hay nada que rehacer.", 3000)
+
     def copy_cells(self):
         """
-        Copia las celdas seleccionadas al portapapeles interno.
+        Copia el rango seleccionado como bloque y, como texto separado por
+        tabuladores, al portapapeles del sistema.
         """
-        items = self.table.selectedItems()
-        if items:
-            self.clipboard = [(i.row(), i.column(), i.text()) for i in items]
+        ranges = self.selected_ranges()
+        if not ranges:
+            return
+        r1, c1, r2, c2 = ranges[0]
+        self.clipboard = self.sheet.copy_block(r1, c1, r2, c2)
+        self.clipboard_text = self.sheet.range_tsv(r1, c1, r2, c2)
+        QApplication.clipboard().setText(self.clipboard_text)
 
     def paste_cells(self):
         """
-        Pega el contenido del portapapeles en las celdas correspondientes.
+        Pega en la celda actual el bloque copiado o, si el portapapeles del
+        sistema tiene otro texto, el TSV de otra aplicación.
         """
-        if self.clipboard:
-            for r, c, val in self.clipboard:
-                self.table.setItem(r, c, QTableWidgetItem(val))
+        index = self.table.currentIndex()
+        row, col = (index.row(), index.column()) if index.isValid() else (0, 0)
+        text = QApplication.clipboard().text()
+        if self.clipboard is not None and text == self.clipboard_text:
+            block = self.clipboard
+        elif text:
+            block = ClipBlock.from_tsv(text)
+        else:
+            return
+        self.model.paste_block(row, col, block)
 
     def clear_cells(self):
         """
         Borra el contenido de las celdas seleccionadas.
         """
-        for i in self.table.selectedItems():
-            i.setText("")
+        cells = [cell for rng in self.selected_ranges() for cell in self.sheet.cells_in_range(*rng)]
+        self.model.set_cells([(r, c, "") for r, c in cells])
 
     # --- Funciones de filas y columnas ---
+    def selected_lines(self, axis):
+        """
+        Filas (axis=0) o columnas (axis=1) del bloque seleccionado que
+        contiene la celda actual, como (primera, cantidad); sin selección,
+        solo la de la celda actual. (-1, 0) si no hay celda actual.
+        """
+        current = self.table.currentIndex()
+        index = current.row() if axis == 0 else current.column()
+        if index < 0:
+            return -1, 0
+        for r1, c1, r2, c2 in self.selected_ranges():
+            if r1 <= current.row() <= r2 and c1 <= current.column() <= c2:
+                return (r1, r2 - r1 + 1) if axis == 0 else (c1, c2 - c1 + 1)
+        return index, 1
+
     def insert_row(self):
         """
-        Inserta una fila en la posición actual.
+        Inserta tantas filas como tenga el bloque seleccionado, encima de él,
+        en una sola operación.
         """
-        row = self.table.currentRow()
-        self.table.insertRow(row if row >= 0 else 0)
+        row, count = self.selected_lines(0)
+        self.model.insert_rows(max(row, 0), max(count, 1))
 
     def delete_row(self):
         """
-        Elimina la fila actual.
+        Elimina las filas del bloque seleccionado en una sola operación.
         """
-        row = self.table.currentRow()
+        row, count = self.selected_lines(0)
         if row >= 0:
-            self.table.removeRow(row)
+            self.model.remove_rows(row, count)
 
     def insert_col(self):
         """
-        Inserta una columna en la posición actual.
+        Inserta tantas columnas como tenga el bloque seleccionado, a su
+        izquierda, en una sola operación.
         """
-        col = self.table.currentColumn()
-        self.table.insertColumn(col if col >= 0 else 0)
+        col, count = self.selected_lines(1)
+        self.model.insert_cols(max(col, 0), max(count, 1))
 
     def delete_col(self):
         """
-        Elimina la columna actual.
+        Elimina las columnas del bloque seleccionado en una sola operación.
         """
-        col = self.table.currentColumn()
+        col, count = self.selected_lines(1)
         if col >= 0:
-            self.table.removeColumn(col)
+            self.model.remove_cols(col, count)
 
     # --- Funciones de formato ---
     def set_bg_color(self):
@@ -240,8 +1890,7 @@ class ExcelClone(QMainWindow):
         """
         color = QColorDialog.getColor()
         if color.isValid():
-            for i in self.table.selectedItems():
-                i.setBackground(color)
+            self.model.set_style(self.selected_ranges(), background=color.rgba())
 
     def set_fg_color(self):
         """
@@ -249,8 +1898,7 @@ class ExcelClone(QMainWindow):
         """
         color = QColorDialog.getColor()
         if color.isValid():
-            for i in self.table.selectedItems():
-                i.setForeground(color)
+            self.model.set_style(self.selected_ranges(), foreground=color.rgba())
 
     def set_font(self):
         """
@@ -258,42 +1906,32 @@ class ExcelClone(QMainWindow):
         """
         font, ok = QFontDialog.getFont()
         if ok:
-            for i in self.table.selectedItems():
-                i.setFont(font)
+            self.model.set_style(self.selected_ranges(), font=font.toString(),
+                                 bold=None, italic=None, underline=None)
 
     def set_bold(self):
         """
         Aplica negrita al texto de las celdas seleccionadas.
         """
-        for i in self.table.selectedItems():
-            f = i.font()
-            f.setBold(True)
-            i.setFont(f)
+        self.model.set_style(self.selected_ranges(), bold=True)
 
     def set_italic(self):
         """
         Aplica cursiva al texto de las celdas seleccionadas.
         """
-        for i in self.table.selectedItems():
-            f = i.font()
-            f.setItalic(True)
-            i.setFont(f)
+        self.model.set_style(self.selected_ranges(), italic=True)
 
     def set_underline(self):
         """
         Aplica subrayado al texto de las celdas seleccionadas.
         """
-        for i in self.table.selectedItems():
-            f = i.font()
-            f.setUnderline(True)
-            i.setFont(f)
+        self.model.set_style(self.selected_ranges(), underline=True)
 
     def set_alignment(self, align):
         """
         Cambia la alineación del texto en las celdas seleccionadas.
         """
-        for i in self.table.selectedItems():
-            i.setTextAlignment(align)
+        self.model.set_style(self.selected_ranges(), alignment=int(align | Qt.AlignVCenter))
 
     def insert_datetime(self):
         """
@@ -301,245 +1939,311 @@ class ExcelClone(QMainWindow):
         """
         import datetime
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        for i in self.table.selectedItems():
-            i.setText(now)
+        self.model.set_cells([(r, c, now) for r, c in self.selected_cells()])
 
     def clear_format(self):
         """
         Restaura el formato predeterminado de las celdas seleccionadas.
         """
-        for i in self.table.selectedItems():
-            i.setBackground(QColor(Qt.white))
-            i.setForeground(QColor(Qt.black))
-            f = i.font()
-            f.setBold(False)
-            f.setItalic(False)
-            f.setUnderline(False)
-            i.setFont(f)
-            i.setTextAlignment(Qt.AlignLeft)
+        self.model.clear_style(self.selected_ranges())
 
     # --- Menú principal ---
     def create_menu(self):
         """
-        Crea la barra de menús principal con todas las acciones.
+        Crea la barra de menús principal con todas las acciones. Los iconos no
+        se cargan aquí: cada menú carga los suyos la primera vez que se abre.
         """
-        from PyQt5.QtGui import QIcon
         menubar = self.menuBar()
+        self.pending_icons = {}  # menú -> [(acción, nombre del icono)]
         # Menú Archivo
-        file_menu = menubar.addMenu("Archivo")
-        open_action = QAction(QIcon.fromTheme("document-open"), "Abrir", self)
-        open_action.triggered.connect(self.open_file)
-        file_menu.addAction(open_action)
-        save_action = QAction(QIcon.fromTheme("document-save"), "Guardar", self)
-        save_action.triggered.connect(self.save_file)
-        file_menu.addAction(save_action)
-        exit_action = QAction(QIcon.fromTheme("application-exit"), "Salir", self)
-        exit_action.triggered.connect(self.close)
-        file_menu.addAction(exit_action)
+        file_menu = self.add_menu(menubar, "Archivo")
+        self.add_menu_action(file_menu, "document-open", "Abrir", self.open_file)
+        self.add_menu_action(file_menu, "document-save", "Guardar", self.save_file).setShortcut("Ctrl+S")
+        self.add_menu_action(file_menu, "document-save-as", "Guardar como...", self.save_file_as)
+        self.add_menu_action(file_menu, "application-exit", "Salir", self.close)
         # Menú Inicio
-        home_menu = menubar.addMenu("Inicio")
-        home_menu.addAction(QIcon.fromTheme("edit-copy"), "Copiar", self.copy_cells)
-        home_menu.addAction(QIcon.fromTheme("edit-cut"), "Cortar", self.cut_cells)
-        home_menu.addAction(QIcon.fromTheme("edit-paste"), "Pegar", self.paste_cells)
-        home_menu.addAction(QIcon.fromTheme("edit-clear"), "Borrar contenido", self.clear_cells)
+        home_menu = self.add_menu(menubar, "Inicio")
+        self.add_menu_action(home_menu, "edit-undo", "Deshacer", self.undo).setShortcut("Ctrl+Z")
+        self.add_menu_action(home_menu, "edit-redo", "Rehacer", self.redo).setShortcut("Ctrl+Y")
+        home_menu.addSeparator()
+        self.add_menu_action(home_menu, "edit-copy", "Copiar", self.copy_cells)
+        self.add_menu_action(home_menu, "edit-cut", "Cortar", self.cut_cells)
+        self.add_menu_action(home_menu, "edit-paste", "Pegar", self.paste_cells)
+        self.add_menu_action(home_menu, "edit-clear", "Borrar contenido", self.clear_cells)
         home_menu.addSeparator()
-        home_menu.addAction(QIcon.fromTheme("format-text-bold"), "Negrita", self.set_bold)
-        home_menu.addAction(QIcon.fromTheme("format-text-italic"), "Cursiva", self.set_italic)
-        home_menu.addAction(QIcon.fromTheme("format-text-underline"), "Subrayado", self.set_underline)
+        self.add_menu_action(home_menu, "format-text-bold", "Negrita", self.set_bold)
+        self.add_menu_action(home_menu, "format-text-italic", "Cursiva", self.set_italic)
+        self.add_menu_action(home_menu, "format-text-underline", "Subrayado", self.set_underline)
         home_menu.addSeparator()
-        home_menu.addAction(QIcon.fromTheme("format-fill-color"), "Color de fondo", self.set_bg_color)
-        home_menu.addAction(QIcon.fromTheme("format-text-color"), "Color de texto", self.set_fg_color)
-        home_menu.addAction(QIcon.fromTheme("preferences-desktop-font"), "Fuente...", self.set_font)
+        self.add_menu_action(home_menu, "format-fill-color", "Color de fondo", self.set_bg_color)
+        self.add_menu_action(home_menu, "format-text-color", "Color de texto", self.set_fg_color)
+        self.add_menu_action(home_menu, "preferences-desktop-font", "Fuente...", self.set_font)
         home_menu.addSeparator()
-        home_menu.addAction(QIcon.fromTheme("format-justify-left"), "Alinear izquierda", lambda: self.set_alignment(Qt.AlignLeft))
-        home_menu.addAction(QIcon.fromTheme("format-justify-center"), "Alinear centro", lambda: self.set_alignment(Qt.AlignCenter))
-        home_menu.addAction(QIcon.fromTheme("format-justify-right"), "Alinear derecha", lambda: self.set_alignment(Qt.AlignRight))
+        self.add_menu_action(home_menu, "format-justify-left", "Alinear izquierda", lambda: self.set_alignment(Qt.AlignLeft))
+        self.add_menu_action(home_menu, "format-justify-center", "Alinear centro", lambda: self.set_alignment(Qt.AlignCenter))
+        self.add_menu_action(home_menu, "format-justify-right", "Alinear derecha", lambda: self.set_alignment(Qt.AlignRight))
         # Menú Insertar con iconos y separadores visuales
-        insert_menu = menubar.addMenu(QIcon.fromTheme("list-add"), "Insertar")
-        insert_menu.addAction(QIcon.fromTheme("view-statistics"), "Gráfico...", self.insert_chart)
+        insert_menu = self.add_menu(menubar, "Insertar", "list-add")
+        self.add_menu_action(insert_menu, "view-statistics", "Gráfico...", self.insert_chart)
+        self.add_menu_action(insert_menu, "view-list-tree", "Tabla dinámica...", self.insert_pivot)
         insert_menu.addSeparator()
-        insert_menu.addAction(QIcon.fromTheme("list-add"), "Insertar fila", self.insert_row)
-        insert_menu.addAction(QIcon.fromTheme("list-add"), "Insertar columna", self.insert_col)
+        self.add_menu_action(insert_menu, "list-add", "Insertar fila", self.insert_row)
+        self.add_menu_action(insert_menu, "list-add", "Insertar columna", self.insert_col)
         insert_menu.addSeparator()
-        insert_menu.addAction(QIcon.fromTheme("insert-date"), "Insertar fecha/hora", self.insert_datetime)
+        self.add_menu_action(insert_menu, "insert-date", "Insertar fecha/hora", self.insert_datetime)
         # Menú Datos
-        data_menu = menubar.addMenu(QIcon.fromTheme("view-sort-ascending"), "Datos")
-        data_menu.addAction(QIcon.fromTheme("edit-find-replace"), "Buscar/Reemplazar", self.find_replace)
-        data_menu.addAction(QIcon.fromTheme("view-sort-ascending"), "Ordenar ascendente", self.sort_asc)
-        data_menu.addAction(QIcon.fromTheme("view-sort-descending"), "Ordenar descendente", self.sort_desc)
+        data_menu = self.add_menu(menubar, "Datos", "view-sort-ascending")
+        self.add_menu_action(data_menu, "edit-find-replace", "Buscar/Reemplazar", self.find_replace).setShortcut("Ctrl+F")
+        self.add_menu_action(data_menu, "view-sort-ascending", "Ordenar ascendente", self.sort_asc)
+        self.add_menu_action(data_menu, "view-sort-descending", "Ordenar descendente", self.sort_desc)
+        self.add_menu_action(data_menu, "view-sort-ascending", "Ordenar...", self.sort_dialog)
+        data_menu.addSeparator()
+        self.add_menu_action(data_menu, "view-refresh", "Actualizar tablas dinámicas",
+                             self.update_pivots).setShortcut("Alt+F5")
+        data_menu.addSeparator()
+        self.add_menu_action(data_menu, "view-refresh", "Calcular ahora", self.model.calculate_now).setShortcut("F9")
+        auto_action = self.add_menu_action(data_menu, "system-run", "Cálculo automático", self.model.set_automatic)
+        auto_action.setCheckable(True)
+        auto_action.setChecked(True)
         # Menú Ver
-        view_menu = menubar.addMenu(QIcon.fromTheme("view-list-details"), "Ver")
-        view_menu.addAction(QIcon.fromTheme("edit-select-all"), "Seleccionar todo", self.select_all)
-        view_menu.addAction(QIcon.fromTheme("zoom-fit-best"), "Ajustar ancho de columna", self.auto_resize_columns)
-        view_menu.addAction(QIcon.fromTheme("zoom-fit-best"), "Ajustar alto de fila", self.auto_resize_rows)
+        view_menu = self.add_menu(menubar, "Ver", "view-list-details")
+        self.add_menu_action(view_menu, "edit-select-all", "Seleccionar todo", self.select_all)
+        self.add_menu_action(view_menu, "zoom-fit-best", "Ajustar ancho de columna", self.auto_resize_columns)
+        self.add_menu_action(view_menu, "zoom-fit-best", "Ajustar ancho de columna (exacto)",
+                             lambda: self.auto_resize_columns(exact=True))
+        self.add_menu_action(view_menu, "zoom-fit-best", "Ajustar alto de fila", self.auto_resize_rows)
+        self.add_menu_action(view_menu, "zoom-fit-best", "Ajustar alto de fila (exacto)",
+                             lambda: self.auto_resize_rows(exact=True))
+        view_menu.addSeparator()
+        profile_action = self.add_menu_action(view_menu, "utilities-system-monitor", "Perfilar rendimiento",
+                                              self.toggle_profiler)
+        profile_action.setCheckable(True)
+        self.add_menu_action(view_menu, "utilities-system-monitor", "Informe de rendimiento...", self.show_profile)
         # Menú Ayuda
-        help_menu = menubar.addMenu(QIcon.fromTheme("help-about"), "Ayuda")
-        help_menu.addAction(QIcon.fromTheme("help-about"), "Acerca de", self.show_about)
+        help_menu = self.add_menu(menubar, "Ayuda", "help-about")
+        self.add_menu_action(help_menu, "help-about", "Acerca de", self.show_about)
+        # Los iconos de la barra de menús se cargan justo después de mostrar la ventana
+        QTimer.singleShot(0, lambda: self.load_menu_icons(menubar))
+
+    def add_menu(self, parent, title, icon=None):
+        """
+        Añade un menú cuyo icono (si tiene) y los de sus acciones se cargan más tarde.
+        """
+        menu = parent.addMenu(title)
+        if icon:
+            self.pending_icons.setdefault(parent, []).append((menu.menuAction(), icon))
+        menu.aboutToShow.connect(lambda: self.load_menu_icons(menu))
+        return menu
+
+    def add_menu_action(self, menu, icon, text, slot):
+        """
+        Añade una acción al menú; su icono se carga al abrir el menú por primera vez.
+        """
+        action = menu.addAction(text, slot)
+        self.pending_icons.setdefault(menu, []).append((action, icon))
+        return action
+
+    def load_menu_icons(self, menu):
+        """
+        Carga los iconos del tema pendientes de un menú (solo la primera vez).
+        """
+        pending = self.pending_icons.pop(menu, None)
+        if not pending:
+            return
+        from PyQt5.QtGui import QIcon
+        for action, name in pending:
+            action.setIcon(QIcon.fromTheme(name))
 
     # --- Funciones de archivo ---
     def open_file(self):
         """
-        Abre un archivo CSV y carga su contenido en la tabla.
+        Abre un libro .pycalc o un archivo CSV y carga su contenido en la tabla.
         """
-        path, _ = QFileDialog.getOpenFileName(self, "Abrir archivo CSV", "", "CSV Files (*.csv)")
-        if path:
-            try:
-                with open(path, newline='', encoding='utf-8') as f:
-                    reader = csv.reader(f)
-                    data = list(reader)
-                    self.table.setRowCount(len(data))
-                    self.table.setColumnCount(max(len(row) for row in data))
-                    for i, row in enumerate(data):
-                        for j, cell in enumerate(row):
-                            self.table.setItem(i, j, QTableWidgetItem(cell))
-            except Exception as e:
-                QMessageBox.critical(self, "Error", f"No se pudo abrir el archivo:\n{e}")
+        path, _ = QFileDialog.getOpenFileName(self, "Abrir archivo", "",
+                                              "Archivos de hoja (*.pycalc *.csv);;"
+                                              "Libros de pycalc (*.pycalc);;CSV Files (*.csv)")
+        if not path:
+            return
+        if path.lower().endswith('.pycalc'):
+            self.open_workbook(path)
+        else:
+            self.load_csv(path)
 
-    def save_file(self):
+    def open_workbook(self, path):
         """
-        Guarda el contenido de la tabla en un archivo CSV.
+        Abre un libro .pycalc. Solo se leen la estructura, los números y las
+        fórmulas con su último resultado; los textos se leen al mostrarse.
         """
-        path, _ = QFileDialog.getSaveFileName(self, "Guardar archivo CSV", "", "CSV Files (*.csv)")
-        if path:
-            try:
-                with open(path, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.writer(f)
-                    for row in range(self.table.rowCount()):
-                        row_data = []
-                        for col in range(self.table.columnCount()):
-                            item = self.table.item(row, col)
-                            row_data.append(item.text() if item else "")
-                        writer.writerow(row_data)
-            except Exception as e:
-                QMessageBox.critical(self, "Error", f"No se pudo guardar el archivo:\n{e}")
-
-    # --- Utilidades para fórmulas ---
-    def cell_to_pos(self, ref):
-        """
-        Convierte una referencia de celda tipo 'A1' en coordenadas (fila, columna).
-        """
-        match = re.match(r"([A-Za-z]+)([0-9]+)", ref)
-        if not match:
-            return None
-        # Calcula la columna considerando letras múltiples (AA, AB, etc.)
-        col = sum([(ord(c.upper()) - 65 + 1) * 26 ** i for i, c in enumerate(match.group(1)[::-1])]) - 1
-        row = int(match.group(2)) - 1
-        return row, col
+        self.cancel_import()
+        try:
+            widths = self.model.load_workbook(path)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"No se pudo abrir el archivo:\n{e}")
+            return
+        default = self.table.horizontalHeader().defaultSectionSize()
+        for col in range(self.sheet.col_count):
+            self.table.setColumnWidth(col, widths.get(col, default))
+        self.workbook_path = path
+        self.statusbar.showMessage(f"Archivo abierto: {self.sheet.row_count} filas")
+
+    def load_csv(self, path):
+        """
+        Importa un CSV en segundo plano: las filas se añaden por bloques y la
+        ventana sigue respondiendo; se puede cancelar desde la barra de estado.
+        """
+        self.cancel_import()
+        self.workbook_path = None
+        self.model.begin_import()
+        self.import_thread = CsvImportThread(path, self)
+        self.import_thread.block_ready.connect(self.on_import_block)
+        self.import_thread.failed.connect(self.on_import_failed)
+        self.import_thread.finished.connect(self.on_import_finished)
+        self.progress.setValue(0)
+        self.progress.show()
+        self.cancel_button.show()
+        self.statusbar.showMessage(f"Abriendo {os.path.basename(path)}...")
+        self.import_thread.start()
 
-    def get_cell_value(self, row, col):
+    def on_import_block(self, block, progress):
+        # Descarta bloques de una importación anterior ya cancelada
+        if self.sender() is not self.import_thread or self.import_thread.cancelled:
+            return
+        self.model.append_block(block)
+        self.progress.setValue(int(progress * 100))
+
+    def on_import_failed(self, message):
+        QMessageBox.critical(self, "Error", f"No se pudo abrir el archivo:\n{message}")
+
+    def on_import_finished(self):
+        thread = self.import_thread
+        if thread is None or thread.isRunning():
+            return
+        self.import_thread = None
+        self.progress.hide()
+        self.cancel_button.hide()
+        self.model.finish_import()
+        if thread.cancelled:
+            self.statusbar.showMessage(f"Importación cancelada ({self.sheet.row_count} filas cargadas)")
+        else:
+            self.statusbar.showMessage(f"Archivo abierto: {self.sheet.row_count} filas")
+
+    def cancel_import(self):
         """
-        Devuelve el valor de una celda, evaluando la fórmula si es necesario.
+        Cancela la importación en curso, conservando las filas ya cargadas.
         """
-        item = self.table.item(row, col)
-        if item:
-            val = item.text()
-            if val.startswith("="):
-                return self.evaluate_formula_direct(val[1:])
-            return val
-        return ""
+        thread = self.import_thread
+        if thread is not None:
+            thread.cancel()
+            thread.wait()
+            if self.import_thread is thread:
+                self.on_import_finished()
 
-    def evaluate_formula(self, row, col):
+    def cancel_tasks(self):
         """
-        Evalúa la fórmula de una celda si comienza con '='.
+        Cancela la importación o exportación en curso.
         """
-        item = self.table.item(row, col)
-        if not item:
-            return
-        text = item.text()
-        if text.startswith("="):
-            try:
-                result = self.evaluate_formula_direct(text[1:])
-                item.setText(str(result))
-            except Exception as e:
-                item.setText(f"#ERROR: {e}")
-
-    def evaluate_formula_direct(self, formula):
-        """
-        Evalúa una fórmula simple (SUMA, PROMEDIO, RAIZ, operaciones básicas y referencias).
-        """
-        formula = formula.upper().replace(" ", "")
-        if formula.startswith("SUMA(") and formula.endswith(")"):
-            rng = formula[5:-1]
-            vals = self.get_range_values(rng)
-            return sum(vals)
-        elif formula.startswith("PROMEDIO(") and formula.endswith(")"):
-            rng = formula[9:-1]
-            vals = self.get_range_values(rng)
-            return sum(vals) / len(vals) if vals else 0
-        elif formula.startswith("RAIZ(") and formula.endswith(")"):
-            ref = formula[5:-1]
-            val = self.get_single_value(ref)
-            return math.sqrt(val)
+        self.cancel_import()
+        self.cancel_export()
+
+    def closeEvent(self, event):
+        self.cancel_import()
+        self.model.stop_recalc()
+        for thread in list(self.pivot_threads.values()):
+            thread.wait()
+        if self.autofit_thread is not None:
+            self.autofit_thread.wait()
+        # Un guardado en curso se deja terminar para no perder el archivo
+        if self.export_thread is not None:
+            self.export_thread.wait()
+        super().closeEvent(event)
+
+    def save_file(self):
+        """
+        Guarda el libro .pycalc abierto o, si no lo hay, pide dónde guardar.
+        """
+        if self.workbook_path:
+            self.save_workbook(self.workbook_path)
         else:
-            # Soporta operaciones simples como =A1+B2
-            tokens = re.split(r'([+\-*/])', formula)
-            result = None
-            op = None
-            for t in tokens:
-                t = t.strip()
-                if not t:
-                    continue
-                if t in '+-*/':
-                    op = t
-                else:
-                    v = None
-                    if re.match(r'^[A-Z]+[0-9]+$', t):
-                        v = self.get_single_value(t)
-                    else:
-                        try:
-                            v = float(t)
-                        except Exception:
-                            v = 0
-                    if result is None:
-                        result = v
-                    else:
-                        if op == '+':
-                            result += v
-                        elif op == '-':
-                            result -= v
-                        elif op == '*':
-                            result *= v
-                        elif op == '/':
-                            result /= v if v != 0 else 0
-            return result if result is not None else ''
-
-    def get_range_values(self, rng):
-        """
-        Devuelve una lista de valores numéricos de un rango (ejemplo: 'A1:A5').
-        """
-        if ':' in rng:
-            start, end = rng.split(':')
-            r1, c1 = self.cell_to_pos(start)
-            r2, c2 = self.cell_to_pos(end)
-            vals = []
-            for row in range(min(r1, r2), max(r1, r2) + 1):
-                for col in range(min(c1, c2), max(c1, c2) + 1):
-                    v = self.get_cell_value(row, col)
-                    try:
-                        vals.append(float(v))
-                    except Exception:
-                        pass
-            return vals
+            self.save_file_as()
+
+    def save_file_as(self):
+        """
+        Guarda la hoja como libro .pycalc o exporta su contenido a CSV o TSV.
+        """
+        path, selected = QFileDialog.getSaveFileName(self, "Guardar archivo", "",
+                                                     "Libros de pycalc (*.pycalc);;"
+                                                     "CSV Files (*.csv);;TSV Files (*.tsv *.txt)")
+        if not path:
+            return
+        if selected.startswith("Libros") or path.lower().endswith('.pycalc'):
+            if not path.lower().endswith('.pycalc'):
+                path += '.pycalc'
+            self.save_workbook(path)
+            return
+        tsv = selected.startswith("TSV") or path.lower().endswith(('.tsv', '.txt'))
+        dialog = CsvExportDialog(tsv, self)
+        if dialog.exec_() == QDialog.Accepted:
+            self.export_csv(path, dialog.options())
+
+    def save_workbook(self, path):
+        """
+        Guarda la hoja, sus estilos y los anchos de columna en un libro
+        .pycalc. Al guardar sobre el libro abierto solo se escriben los trozos
+        que han cambiado.
+        """
+        default = self.table.horizontalHeader().defaultSectionSize()
+        widths = {col: self.table.columnWidth(col) for col in range(self.sheet.col_count)
+                  if self.table.columnWidth(col) != default}
+        try:
+            with self.model.paused():
+                self.model.finish_recalc()
+                save_workbook(path, self.sheet, self.model.styles, widths)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"No se pudo guardar el archivo:\n{e}")
+            return
+        self.workbook_path = path
+        self.statusbar.showMessage(f"Archivo guardado: {os.path.basename(path)}")
+
+    def export_csv(self, path, options):
+        """
+        Guarda una copia de la hoja en segundo plano; se puede seguir editando mientras tanto.
+        """
+        self.cancel_export()
+        with self.model.paused():
+            self.model.finish_recalc()
+            snapshot = self.sheet.snapshot()
+        self.export_thread = CsvExportThread(snapshot, path, options, self)
+        self.export_thread.progress.connect(lambda fraction: self.progress.setValue(int(fraction * 100)))
+        self.export_thread.failed.connect(
+            lambda message: QMessageBox.critical(self, "Error", f"No se pudo guardar el archivo:\n{message}"))
+        self.export_thread.finished.connect(self.on_export_finished)
+        self.progress.setValue(0)
+        self.progress.show()
+        self.cancel_button.show()
+        self.statusbar.showMessage(f"Guardando {os.path.basename(path)}...")
+        self.export_thread.start()
+
+    def on_export_finished(self):
+        thread = self.export_thread
+        if thread is None or thread.isRunning():
+            return
+        self.export_thread = None
+        self.progress.hide()
+        self.cancel_button.hide()
+        if thread.cancelled:
+            self.statusbar.showMessage("Guardado cancelado")
         else:
-            r, c = self.cell_to_pos(rng)
-            v = self.get_cell_value(r, c)
-            try:
-                return [float(v)]
-            except Exception:
-                return [0]
+            self.statusbar.showMessage(f"Archivo guardado: {os.path.basename(thread.path)}")
 
-    def get_single_value(self, ref):
+    def cancel_export(self):
         """
-        Devuelve el valor numérico de una celda referenciada.
+        Cancela el guardado en curso; el archivo de destino no se modifica.
         """
-        pos = self.cell_to_pos(ref)
-        if pos:
-            v = self.get_cell_value(*pos)
-            try:
-                return float(v)
-            except Exception:
-                return 0
-        return 0
+        thread = self.export_thread
+        if thread is not None:
+            thread.cancel()
+            thread.wait()
+            self.on_export_finished()
 
     # --- Funciones de gráficos ---
     def insert_chart(self):
@@ -549,47 +2253,179 @@ class ExcelClone(QMainWindow):
         rng, ok = QInputDialog.getText(self, "Rango de datos", "Introduce el rango (ej: A1:A5):")
         if not ok or not rng:
             return
-        data = self.get_range_values(rng.upper())
-        if not data:
+        bounds = self.sheet.parse_range(rng.upper())
+        if bounds is None:
+            QMessageBox.warning(self, "Datos", "El rango no es válido.")
+            return
+        if not len(self.sheet.range_array(*bounds)):
             QMessageBox.warning(self, "Datos", "No se encontraron datos numéricos en el rango.")
             return
-        chart_type, ok = QInputDialog.getItem(self, "Tipo de gráfico", "Selecciona tipo:", ["Barras", "Pastel"], 0, False)
+        chart_type, ok = QInputDialog.getItem(self, "Tipo de gráfico", "Selecciona tipo:",
+                                              ChartDialog.TYPES, 0, False)
         if not ok:
             return
-        dlg = ChartDialog(data, chart_type, self)
-        dlg.exec_()
+        # El gráfico queda abierto y se actualiza al editar las celdas de su rango
+        dlg = ChartDialog(self.sheet, bounds, chart_type, self)
+        dlg.setAttribute(Qt.WA_DeleteOnClose)
+        self.model.dataChanged.connect(dlg.on_data_changed)
+        dlg.show()
 
-    # --- Buscar y reemplazar ---
-    def find_replace(self):
+    # --- Tablas dinámicas ---
+    def insert_pivot(self):
         """
-        Busca y reemplaza texto en todas las celdas de la tabla.
+        Crea una tabla dinámica sobre el rango seleccionado (o el que se
+        indique) y la escribe en la celda de destino. La tabla se agrupa en
+        segundo plano y se actualiza sola al editar su rango de origen.
         """
-        find, ok = QInputDialog.getText(self, "Buscar", "Texto a buscar:")
-        if not ok or not find:
+        ranges = self.selected_ranges()
+        if ranges and (ranges[0][0] != ranges[0][2] or ranges[0][1] != ranges[0][3]):
+            bounds = ranges[0]
+        else:
+            rng, ok = QInputDialog.getText(self, "Tabla dinámica", "Rango de origen (ej: A1:D1000):")
+            if not ok or not rng:
+                return
+            bounds = self.sheet.parse_range(rng.upper())
+            if bounds is None:
+                QMessageBox.warning(self, "Tabla dinámica", "El rango no es válido.")
+                return
+        r1, c1, r2, c2 = bounds
+        fields = [(col, self.sheet.display(r1, col)) for col in range(c1, c2 + 1)]
+        dialog = PivotDialog(fields, f"{column_name(c2 + 2)}{r1 + 1}", self)
+        if dialog.exec_() != QDialog.Accepted:
             return
-        replace, ok = QInputDialog.getText(self, "Reemplazar", f"Reemplazar '{find}' por:")
-        if not ok:
+        rows, column, values, header, target = dialog.options()
+        anchor = self.sheet.cell_to_pos(target.upper())
+        if anchor is None:
+            QMessageBox.warning(self, "Tabla dinámica", "La celda de destino no es válida.")
+            return
+        if anchor[0] <= r2 and anchor[1] <= c2:
+            QMessageBox.warning(self, "Tabla dinámica", "El destino debe quedar a la derecha o debajo del origen.")
+            return
+        if not rows or not values:
+            QMessageBox.warning(self, "Tabla dinámica", "Elige al menos un campo de filas y uno de valores.")
+            return
+        pivot = PivotTable(bounds, rows, column, values, header)
+        pivot.anchor = anchor
+        self.pivots.append(pivot)
+        self.refresh_pivot(pivot)
+
+    def mark_pivots(self, top_left, bottom_right, roles=None):
+        """
+        Anota las filas editadas en las tablas dinámicas cuyo origen tocan.
+        """
+        touched = False
+        for pivot in self.pivots:
+            touched |= pivot.mark(top_left.row(), top_left.column(), bottom_right.row(), bottom_right.column())
+        if touched:
+            self.pivot_timer.start()
+
+    def mark_pivot_lines(self, axis, first):
+        """
+        Tras insertar o eliminar filas (axis=0) o columnas (axis=1) desde
+        'first' se reagrupan las tablas cuyo origen llega a esa posición.
+        """
+        for pivot in self.pivots:
+            if first <= pivot.source[2 + axis]:
+                pivot.mark_all()
+                self.pivot_timer.start()
+
+    def mark_all_pivots(self, *args):
+        for pivot in self.pivots:
+            pivot.mark_all()
+        if self.pivots:
+            self.pivot_timer.start()
+
+    def drop_pivots(self):
+        # Otra hoja: las tablas en curso terminan, pero su resultado se descarta
+        self.pivots = []
+
+    def update_pivots(self):
+        """
+        Vuelve a agrupar todas las tablas dinámicas desde cero.
+        """
+        self.mark_all_pivots()
+        self.refresh_pivots()
+
+    def refresh_pivots(self):
+        self.pivot_timer.stop()
+        for pivot in self.pivots:
+            if pivot.pending:
+                self.refresh_pivot(pivot)
+
+    def refresh_pivot(self, pivot):
+        """
+        Actualiza una tabla dinámica. Con pocas filas editadas solo se mueven
+        esas filas de grupo; si hay que agruparlo todo, se hace en un hilo
+        sobre una copia de la hoja y las ediciones hechas mientras tanto se
+        aplican al terminar.
+        """
+        if pivot in self.pivot_threads:
+            return
+        if pivot.stale or pivot.group_of is None:
+            pivot.pending = pivot.stale = False
+            pivot.dirty_rows.clear()
+            with self.model.paused():
+                snapshot = self.sheet.snapshot()
+            thread = PivotThread(pivot, snapshot, self)
+            thread.failed.connect(lambda message: QMessageBox.critical(
+                self, "Error", f"No se pudo calcular la tabla dinámica:\n{message}"))
+            thread.finished.connect(lambda: self.on_pivot_built(pivot))
+            self.pivot_threads[pivot] = thread
+            self.statusbar.showMessage("Calculando tabla dinámica...")
+            thread.start()
+            return
+        pivot.update(self.sheet)
+        self.model.set_cells(pivot.updates(self.sheet), record=False)
+
+    def on_pivot_built(self, pivot):
+        thread = self.pivot_threads.pop(pivot, None)
+        if pivot not in self.pivots:
+            return
+        if thread is not None and thread.error is not None:
+            self.pivots.remove(pivot)
             return
-        for r in range(self.table.rowCount()):
-            for c in range(self.table.columnCount()):
-                item = self.table.item(r, c)
-                if item and find in item.text():
-                    item.setText(item.text().replace(find, replace))
+        self.refresh_pivot(pivot)
+        self.statusbar.showMessage(f"Tabla dinámica actualizada: {len(pivot.keys)} grupos", 3000)
+
+    # --- Buscar y reemplazar ---
+    def find_replace(self):
+        """
+        Abre el diálogo de buscar y reemplazar (se crea la primera vez).
+        """
+        if self.find_dialog is None:
+            self.find_dialog = FindReplaceDialog(self)
+        self.find_dialog.show()
+        self.find_dialog.raise_()
+        self.find_dialog.activateWindow()
+        self.find_dialog.find_edit.setFocus()
 
     # --- Ordenar y selección ---
     def sort_asc(self):
         """
         Ordena la columna actual de forma ascendente.
         """
-        col = self.table.currentColumn()
-        self.table.sortItems(col, Qt.AscendingOrder)
+        col = self.table.currentIndex().column()
+        if col >= 0:
+            self.model.sort(col, Qt.AscendingOrder)
 
     def sort_desc(self):
         """
         Ordena la columna actual de forma descendente.
         """
-        col = self.table.currentColumn()
-        self.table.sortItems(col, Qt.DescendingOrder)
+        col = self.table.currentIndex().column()
+        if col >= 0:
+            self.model.sort(col, Qt.DescendingOrder)
+
+    def sort_dialog(self):
+        """
+        Ordena por varias columnas elegidas en un diálogo.
+        """
+        dialog = SortDialog([column_name(c) for c in range(self.sheet.col_count)], self.table.currentIndex().column(), self)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        keys, start = dialog.options()
+        if keys:
+            self.model.sort_by(keys, start)
 
     def select_all(self):
         """
@@ -597,17 +2433,76 @@ class ExcelClone(QMainWindow):
         """
         self.table.selectAll()
 
-    def auto_resize_columns(self):
+    def auto_resize_columns(self, exact=False):
+        """
+        Ajusta el ancho de las columnas seleccionadas (o de todas las usadas)
+        a su contenido. El ajuste normal mide una muestra y tarda lo mismo
+        con cualquier número de filas; el exacto busca antes en segundo plano
+        los textos más largos de cada columna.
+        """
+        cols = sorted({index.column() for index in self.table.selectionModel().selectedColumns()})
+        if not cols:
+            cols = range(self.sheet.used_range()[1])
+        if exact:
+            self.start_autofit(1, list(cols))
+        else:
+            self.autofit.fit_columns(cols)
+
+    def auto_resize_rows(self, exact=False):
         """
-        Ajusta automáticamente el ancho de las columnas.
+        Ajusta el alto de las filas a su contenido: las visibles y una
+        muestra o, con el ajuste exacto, todas (las de varias líneas se
+        buscan en segundo plano).
         """
-        self.table.resizeColumnsToContents()
+        if exact:
+            self.start_autofit(0)
+        else:
+            self.autofit.fit_rows()
+
+    def start_autofit(self, axis, cols=()):
+        """
+        Lanza la búsqueda del ajuste exacto sobre una copia de la hoja.
+        """
+        if self.autofit_thread is not None:
+            self.statusbar.showMessage("Ya hay un ajuste en curso.", 3000)
+            return
+        with self.model.paused():
+            snapshot = self.sheet.snapshot()
+        thread = AutoFitThread(snapshot, axis, cols, self)
+        thread.failed.connect(lambda message: QMessageBox.critical(
+            self, "Error", f"No se pudo ajustar el tamaño:\n{message}"))
+        thread.finished.connect(self.on_autofit_finished)
+        self.autofit_thread = thread
+        self.statusbar.showMessage("Ajustando al contenido...")
+        thread.start()
+
+    def on_autofit_finished(self):
+        thread, self.autofit_thread = self.autofit_thread, None
+        if thread is None or thread.error is not None:
+            return
+        if thread.axis == 1:
+            self.autofit.fit_columns(thread.cols, thread.result)
+        else:
+            self.autofit.fit_rows(thread.result)
+        self.statusbar.showMessage("Tamaño ajustado al contenido", 3000)
+
+    def toggle_profiler(self, enabled):
+        """
+        Activa o desactiva el perfilador del motor; al activarlo se empieza de cero.
+        """
+        PROFILER.enable(enabled)
+        self.statusbar.showMessage("Perfilador activado" if enabled else "Perfilador desactivado", 3000)
 
-    def auto_resize_rows(self):
+    def show_profile(self):
         """
-        Ajusta automáticamente el alto de las filas.
+        Abre el informe de rendimiento (se crea la primera vez).
         """
-        self.table.resizeRowsToContents()
+        if self.profile_dialog is None:
+            self.profile_dialog = ProfileDialog(self)
+        else:
+            self.profile_dialog.update_report()
+        self.profile_dialog.show()
+        self.profile_dialog.raise_()
 
     def show_about(self):
         """
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Línea de órdenes de pycalc: recalcula hojas CSV sin interfaz gráfica.
+
+    python pycalc_cli.py recalc entrada.csv -o salida.csv
+    python pycalc_cli.py recalc carpeta/ -o carpeta_salida/ -j 4
+    python pycalc_cli.py eval entrada.csv "SUMA(A1:A10)"
+    python pycalc_cli.py recalc lenta.csv -o /dev/null --profile traza.json
+
+Con una carpeta se procesan en paralelo todos sus .csv y .tsv. No importa Qt
+ni matplotlib, solo el motor de cálculo. Con --profile se perfila el trabajo
+(en este proceso): se guarda una traza para chrome://tracing o Perfetto y se
+muestra un resumen de las operaciones y fórmulas más lentas.
+"""
+import sys
+import os
+import argparse
+
+from pycalc_engine import PROFILER, load_csv, write_csv
+
+EXTENSIONS = ('.csv', '.tsv')
+
+def _delimiter(path):
+    return '\t' if path.lower().endswith('.tsv') else ','
+
+def _input_files(path):
+    """
+    Devuelve los archivos a procesar: el propio archivo o los CSV/TSV de la carpeta.
+    """
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.lower().endswith(EXTENSIONS) and os.path.isfile(os.path.join(path, name)))
+
+def recalc_file(source, target):
+    """
+    Carga un CSV, evalúa sus fórmulas y escribe los valores resultantes.
+    """
+    sheet = load_csv(source, _delimiter(source))
+    for _ in write_csv(sheet, target, delimiter=_delimiter(target)):
+        pass
+    return target
+
+def eval_file(source, formula):
+    """
+    Evalúa una fórmula sobre la hoja cargada desde un CSV.
+    """
+    sheet = load_csv(source, _delimiter(source))
+    try:
+        return sheet.evaluate_formula_direct(formula.lstrip('='))
+    except Exception as e:
+        return f"#ERROR: {e}"
+
+def _run(jobs, function, tasks):
+    """
+    Ejecuta las tareas en paralelo (varios archivos) o en este mismo proceso
+    (un solo archivo, sin coste de arrancar procesos). Devuelve los resultados
+    en el orden de las tareas; los fallos se devuelven como excepciones.
+    """
+    if len(tasks) <= 1 or jobs == 1:
+        results = []
+        for args in tasks:
+            try:
+                results.append(function(*args))
+            except Exception as e:
+                results.append(e)
+        return results
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(function, *args) for args in tasks]
+        return [future.exception() or future.result() for future in futures]
+
+def cmd_recalc(args):
+    files = _input_files(args.input)
+    if os.path.isdir(args.input):
+        targets = [os.path.join(args.output, os.path.basename(f)) for f in files]
+    else:
+        targets = [args.output]
+    # La salida solo lleva valores: escribirla sobre la entrada borraría sus fórmulas
+    for source, target in zip(files, targets):
+        if os.path.exists(target) and os.path.samefile(source, target):
+            print(f"{source}: la salida no puede ser el propio archivo de entrada", file=sys.stderr)
+            return 2
+    if os.path.isdir(args.input):
+        os.makedirs(args.output, exist_ok=True)
+    status = 0
+    for source, result in zip(files, _run(args.jobs, recalc_file, list(zip(files, targets)))):
+        if isinstance(result, Exception):
+            print(f"{source}: no se pudo recalcular: {result}", file=sys.stderr)
+            status = 1
+        elif not args.quiet:
+            print(f"{source} -> {result}")
+    return status
+
+def cmd_eval(args):
+    files = _input_files(args.input)
+    results = _run(args.jobs, eval_file, [(f, args.formula) for f in files])
+    status = 0
+    for source, result in zip(files, results):
+        if isinstance(result, Exception):
+            print(f"{source}: no se pudo leer: {result}", file=sys.stderr)
+            status = 1
+            continue
+        if isinstance(result, str) and result.startswith('#'):
+            status = 1
+        print(f"{source}: {result}" if len(files) > 1 else result)
+    return status
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-j', '--jobs', type=int, default=None,
+                        help="procesos para las carpetas (por defecto, uno por núcleo)")
+    common.add_argument('--profile', metavar='TRAZA',
+                        help="perfila el trabajo y guarda la traza (JSON de Chrome) en este archivo")
+    parser = argparse.ArgumentParser(prog='pycalc', description="Recálculo de hojas CSV sin interfaz gráfica.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    recalc = sub.add_parser('recalc', parents=[common], help="evalúa las fórmulas y guarda los valores")
+    recalc.add_argument('input', help="archivo CSV/TSV o carpeta")
+    recalc.add_argument('-o', '--output', required=True,
+                        help="archivo o carpeta de salida (no puede ser la entrada)")
+    recalc.add_argument('-q', '--quiet', action='store_true', help="no mostrar los archivos procesados")
+    recalc.set_defaults(func=cmd_recalc)
+
+    evaluate = sub.add_parser('eval', parents=[common], help="evalúa una fórmula sobre la hoja")
+    evaluate.add_argument('input', help="archivo CSV/TSV o carpeta")
+    evaluate.add_argument('formula', help='fórmula, por ejemplo "SUMA(A1:A10)"')
+    evaluate.set_defaults(func=cmd_eval)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not os.path.exists(args.input):
+        print(f"No existe: {args.input}", file=sys.stderr)
+        return 2
+    if not args.profile:
+        return args.func(args)
+    # Los procesos auxiliares no se perfilan: todo se hace en este
+    args.jobs = 1
+    PROFILER.enable()
+    try:
+        return args.func(args)
+    finally:
+        PROFILER.write_trace(args.profile)
+        print(PROFILER.report(), file=sys.stderr)
+
+if __name__ == '__main__':
+    sys.exit(main())
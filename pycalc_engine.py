@@ -0,0 +1,4477 @@
+"""
+Motor de cálculo de pycalc sin dependencias de Qt: hoja, fórmulas, grafo de
+dependencias, recálculo e importación/exportación de CSV. Lo usan la interfaz
+gráfica (pycalc.py) y la línea de órdenes (pycalc_cli.py).
+"""
+import sys
+import os
+import csv
+import re
+import math
+import locale
+import datetime
+import mmap
+import shutil
+import tempfile
+import operator
+import json
+import zlib
+import struct
+import hashlib
+import heapq
+import gc
+import time
+import threading
+import contextlib
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from itertools import zip_longest
+from functools import lru_cache, wraps
+
+import numpy as np
+
+# --- Perfilado ---
+# Límite de eventos de la traza; los siguientes solo se cuentan
+TRACE_MAX_EVENTS = 200000
+
+_NO_SPAN = contextlib.nullcontext()
+
+class Profiler:
+    """
+    Perfilador del motor: recuentos y tiempo acumulado por celda y por
+    fórmula, aciertos y fallos de las cachés, tiempo de las operaciones
+    largas (importar, exportar, ordenar, buscar...) y una traza en el formato
+    de Chrome (chrome://tracing o Perfetto).
+
+    Desactivado solo cuesta comprobar 'enabled': una vez por recálculo (no
+    por celda) y una vez por operación o consulta de caché.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        """
+        Descarta lo medido hasta ahora.
+        """
+        self.cells = {}     # (fila, columna) -> [evaluaciones, segundos]
+        self.formulas = {}  # plantilla -> [evaluaciones, segundos, última celda]
+        self.counters = {}  # nombre -> recuento
+        self.spans = {}     # operación -> [veces, segundos]
+        self.events = []    # eventos "X" de la traza
+        self.dropped = 0
+        self.origin = time.perf_counter()
+        # Estado de la caché de compilación al empezar a medir
+        self._compiled = compile_template.cache_info() if self.enabled else None
+
+    def enable(self, enabled=True):
+        if enabled and not self.enabled:
+            self.enabled = True
+            self.reset()
+        self.enabled = enabled
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def span(self, name, **args):
+        """
+        Contexto que mide una operación: with PROFILER.span('ordenar'): ...
+        """
+        return self._span(name, args) if self.enabled else _NO_SPAN
+
+    @contextlib.contextmanager
+    def _span(self, name, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            total = self.spans.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+            self._event(name, 'operación', start, seconds, args)
+
+    def cell(self, cell, template, start, seconds):
+        """
+        Anota la evaluación de la fórmula de una celda.
+        """
+        total = self.cells.get(cell)
+        if total is None:
+            self.cells[cell] = [1, seconds]
+        else:
+            total[0] += 1
+            total[1] += seconds
+        total = self.formulas.get(template)
+        if total is None:
+            self.formulas[template] = [1, seconds, cell]
+        else:
+            total[0] += 1
+            total[1] += seconds
+            total[2] = cell
+        self._event(f"{column_name(cell[1])}{cell[0] + 1}", 'fórmula', start, seconds, None)
+
+    def _event(self, name, category, start, seconds, args):
+        if len(self.events) >= TRACE_MAX_EVENTS:
+            self.dropped += 1
+            return
+        self.events.append((name, category, start, seconds, threading.get_ident(), args))
+
+    def cache_stats(self):
+        """
+        {caché: (aciertos, fallos)} desde que se activó el perfilado.
+        """
+        info = compile_template.cache_info()
+        base = self._compiled or info
+        stats = {'compilación': (info.hits - base.hits, info.misses - base.misses)}
+        for name, n in self.counters.items():
+            cache, _, kind = name.rpartition('.')
+            if kind in ('acierto', 'fallo'):
+                hits, misses = stats.get(cache, (0, 0))
+                stats[cache] = (hits + n, misses) if kind == 'acierto' else (hits, misses + n)
+        return stats
+
+    def slowest(self, n=50):
+        """
+        [(celda, evaluaciones, segundos)] de las celdas con más tiempo acumulado.
+        """
+        cells = sorted(self.cells.items(), key=lambda item: item[1][1], reverse=True)[:n]
+        return [(cell, count, seconds) for cell, (count, seconds) in cells]
+
+    def slowest_formulas(self, n=50):
+        """
+        [(fórmula, evaluaciones, segundos)] agrupando las celdas que comparten
+        plantilla (fórmulas copiadas); la fórmula se escribe como en la última
+        celda evaluada.
+        """
+        formulas = sorted(self.formulas.items(), key=lambda item: item[1][1], reverse=True)[:n]
+        return [("=" + template_to_formula(template, *cell), count, seconds)
+                for template, (count, seconds, cell) in formulas]
+
+    def trace(self):
+        """
+        Traza en el formato de eventos de Chrome (tiempos en microsegundos).
+        """
+        pid = os.getpid()
+        events = []
+        for name, category, start, seconds, tid, args in self.events:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': round((start - self.origin) * 1e6, 3), 'dur': round(seconds * 1e6, 3)}
+            if args:
+                event['args'] = args
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'eventos descartados': self.dropped}}
+
+    def write_trace(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.trace(), f, ensure_ascii=False)
+
+    def report(self, n=20):
+        """
+        Resumen en texto: operaciones, cachés y fórmulas más lentas.
+        """
+        lines = ["Operaciones:"]
+        for name, (count, seconds) in sorted(self.spans.items(), key=lambda item: -item[1][1]):
+            lines.append(f"  {name}: {count} veces, {seconds * 1000:.1f} ms")
+        lines.append("Cachés (aciertos/fallos):")
+        for name, (hits, misses) in sorted(self.cache_stats().items()):
+            lines.append(f"  {name}: {hits}/{misses}")
+        lines.append("Fórmulas más lentas:")
+        for formula, count, seconds in self.slowest_formulas(n):
+            lines.append(f"  {formula}: {count} veces, {seconds * 1000:.3f} ms")
+        lines.append("Celdas más lentas:")
+        for (row, col), count, seconds in self.slowest(n):
+            lines.append(f"  {column_name(col)}{row + 1}: {count} veces, {seconds * 1000:.3f} ms")
+        return "\n".join(lines)
+
+# Perfilador global del motor (desactivado salvo que se pida)
+PROFILER = Profiler()
+
+def profiled(name):
+    """
+    Decorador que mide la función como una operación del perfilador.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            with PROFILER.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# --- Compilador de fórmulas ---
+# Cada fórmula se reduce a una plantilla relativa a su celda (las fórmulas
+# copiadas hacia abajo comparten plantilla), que se analiza una sola vez y se
+# convierte en un árbol de closures fn(calc, fila, columna).
+
+_TOKEN_RE = re.compile(r'\s*(?:(?P<str>"(?:[^"]|"")*")|(?P<ref>\{[$+-]\d+,[$+-]\d+\})|(?P<num>(?:\d+\.?\d*|\.\d+)(?:E[+-]?\d+)?)|(?P<err>#REF!)|(?P<name>[A-Z_][A-Z0-9_.]*)|(?P<op>[-+*/():,;]))', re.IGNORECASE)
+_REF_RE = re.compile(r"^([A-Z]+)([0-9]+)$")
+# Referencias A1 dentro del texto de una fórmula (se saltan los textos entre comillas)
+_TEMPLATE_RE = re.compile(r'("(?:[^"]|"")*")|(?<![A-Za-z0-9_.$])(\$?)([A-Za-z]+)(\$?)([0-9]+)(?![A-Za-z0-9_.(])')
+
+class FormulaError(Exception):
+    """
+    Error de sintaxis o de nombre en una fórmula.
+    """
+
+class CellError(FormulaError):
+    """
+    Error leído de otra celda (#REF!, #N/A, #CICLO, #ERROR...): la fórmula
+    que lo lee se evalúa a ese mismo error, como en Excel.
+    """
+
+class InvalidReference(CellError):
+    """
+    Referencia a celdas eliminadas (#REF!): la fórmula se evalúa a #REF!.
+    """
+
+@lru_cache(maxsize=65536)
+def ref_to_pos(ref):
+    """
+    Convierte una referencia tipo 'A1' en (fila, columna), o None si no es válida.
+    """
+    match = _REF_RE.match(ref.upper())
+    if not match or int(match.group(2)) < 1:
+        return None
+    col = 0
+    for c in match.group(1):
+        col = col * 26 + ord(c) - 64
+    return int(match.group(2)) - 1, col - 1
+
+def formula_template(formula, row=0, col=0):
+    """
+    Forma relativa de una fórmula escrita en (fila, columna): cada referencia
+    se escribe como {fila,columna}, con '$n' para posiciones absolutas y '+n'/'-n'
+    para desplazamientos respecto a la celda. '=A1*2' en B1 y '=A2*2' en B2
+    producen la misma plantilla.
+    """
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        pos = ref_to_pos(match.group(3) + match.group(5))
+        if pos is None:
+            return match.group(0)
+        r, c = pos
+        row_spec = f"${r}" if match.group(4) else f"{r - row:+d}"
+        col_spec = f"${c}" if match.group(2) else f"{c - col:+d}"
+        return "{" + row_spec + "," + col_spec + "}"
+    return _TEMPLATE_RE.sub(replace, formula)
+
+_SPEC_RE = re.compile(r'("(?:[^"]|"")*")|\{([$+-]\d+),([$+-]\d+)\}(?::\{([$+-]\d+),([$+-]\d+)\})?')
+
+def template_to_formula(template, row, col):
+    """
+    Inversa de formula_template: escribe la plantilla como fórmula A1 en
+    (fila, columna). Las referencias relativas que quedarían fuera de la
+    hoja se escriben como #REF! (un rango entero, si lo hace uno de sus extremos).
+    """
+    def write(row_spec, col_spec):
+        r, fr = _parse_spec(row_spec)
+        c, fc = _parse_spec(col_spec)
+        r, c = r + fr * row, c + fc * col
+        if r < 0 or c < 0:
+            return None
+        return f"{'' if fc else '$'}{column_name(c)}{'' if fr else '$'}{r + 1}"
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        first = write(match.group(2), match.group(3))
+        if match.group(4) is None:
+            return "#REF!" if first is None else first
+        last = write(match.group(4), match.group(5))
+        return "#REF!" if first is None or last is None else f"{first}:{last}"
+    return _SPEC_RE.sub(replace, template)
+
+def tokenize_formula(formula):
+    """
+    Divide una fórmula en una lista de tokens (tipo, texto). Los nombres se
+    pasan a mayúsculas; los textos entre comillas se conservan tal cual.
+    """
+    tokens = []
+    pos = 0
+    formula = formula.rstrip()
+    while pos < len(formula):
+        match = _TOKEN_RE.match(formula, pos)
+        if not match:
+            raise FormulaError(f"carácter inesperado: {formula[pos:].strip()[:1]}")
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'str':
+            value = value[1:-1].replace('""', '"')
+        elif kind != 'ref':
+            value = value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+# Valores lógicos, como números (Excel trata VERDADERO como 1 y FALSO como 0)
+_CONSTANTS = {'VERDADERO': 1.0, 'FALSO': 0.0}
+
+def _parse_spec(text):
+    # '$5' -> (5, 0) absoluta; '+3' -> (3, 1) relativa a la celda
+    return (int(text[1:]), 0) if text[0] == '$' else (int(text), 1)
+
+class FormulaParser:
+    """
+    Analizador descendente recursivo con precedencia de operadores:
+    expr := term (('+'|'-') term)*
+    term := unary (('*'|'/') unary)*
+    unary := ('+'|'-') unary | primary
+    primary := número | "texto" | VERDADERO | FALSO | celda | FUNCION '(' args ')' | '(' expr ')'
+    Las celdas son posiciones (valor, relativa): absoluta = valor + relativa * ancla.
+    """
+    def __init__(self, formula):
+        self.tokens = tokenize_formula(formula)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def next(self):
+        tok = self.peek()
+        self.pos += 1
+        return tok
+
+    def expect(self, text):
+        kind, value = self.next()
+        if value != text:
+            raise FormulaError(f"se esperaba '{text}'")
+
+    def parse(self):
+        if not self.tokens:
+            return ('const', '')
+        node = self.parse_expr()
+        if self.pos < len(self.tokens):
+            raise FormulaError(f"token inesperado: {self.peek()[1]}")
+        return node
+
+    def parse_expr(self):
+        node = self.parse_term()
+        while self.peek()[1] in ('+', '-'):
+            op = self.next()[1]
+            node = ('bin', op, node, self.parse_term())
+        return node
+
+    def parse_term(self):
+        node = self.parse_unary()
+        while self.peek()[1] in ('*', '/'):
+            op = self.next()[1]
+            node = ('bin', op, node, self.parse_unary())
+        return node
+
+    def parse_unary(self):
+        if self.peek()[1] in ('+', '-'):
+            op = self.next()[1]
+            node = self.parse_unary()
+            return ('neg', node) if op == '-' else node
+        return self.parse_primary()
+
+    def parse_cell(self, kind, value):
+        """
+        Devuelve ((fila, relativa), (columna, relativa)) de un token de celda, o None.
+        """
+        if kind == 'ref':
+            row_spec, col_spec = value[1:-1].split(',')
+            return _parse_spec(row_spec), _parse_spec(col_spec)
+        pos = ref_to_pos(value) if kind == 'name' else None
+        if pos is None:
+            return None
+        return (pos[0], 0), (pos[1], 0)
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind == 'num':
+            return ('const', float(value))
+        if kind == 'str':
+            return ('const', value)
+        if kind == 'err':
+            return ('error', value)
+        if kind == 'name' and value in _CONSTANTS and self.peek()[1] != '(':
+            return ('const', _CONSTANTS[value])
+        if kind == 'name' and self.peek()[1] == '(':
+            self.next()
+            args = []
+            if self.peek()[1] != ')':
+                args.append(self.parse_arg())
+                while self.peek()[1] in (',', ';'):
+                    self.next()
+                    args.append(self.parse_arg())
+            self.expect(')')
+            return ('call', value, args)
+        if kind in ('ref', 'name'):
+            cell = self.parse_cell(kind, value)
+            if cell is None:
+                raise FormulaError(f"nombre desconocido: {value}")
+            return ('ref',) + cell
+        if value == '(':
+            node = self.parse_expr()
+            self.expect(')')
+            return node
+        raise FormulaError("fórmula incompleta" if kind is None else f"token inesperado: {value}")
+
+    def parse_arg(self):
+        # Un argumento puede ser un rango (A1:B5) o cualquier expresión
+        kind, value = self.peek()
+        if kind in ('ref', 'name') and self.pos + 1 < len(self.tokens) and self.tokens[self.pos + 1][1] == ':':
+            start = self.parse_cell(kind, value)
+            self.pos += 2
+            end = self.parse_cell(*self.next())
+            if start is None or end is None:
+                raise FormulaError("rango no válido")
+            return ('range',) + start + end
+        return self.parse_expr()
+
+def _divide(a, b):
+    if b == 0:
+        raise ZeroDivisionError("división por cero")
+    return a / b
+
+_BINARY_OPS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': _divide}
+
+def _range_bounds(node):
+    """
+    Función (fila, columna) -> (fila1, col1, fila2, col2) de un nodo de rango.
+    """
+    (r1, fr1), (c1, fc1), (r2, fr2), (c2, fc2) = node[1:]
+    def bounds(row, col):
+        a, b = r1 + fr1 * row, r2 + fr2 * row
+        c, d = c1 + fc1 * col, c2 + fc2 * col
+        return min(a, b), min(c, d), max(a, b), max(c, d)
+    return bounds
+
+def _build_numbers(node, errors=True):
+    """
+    Closure que devuelve el array de números de un argumento de función de
+    agregado. Con errors, un error dentro del rango se propaga (CellError).
+    """
+    if node[0] == 'range':
+        bounds = _range_bounds(node)
+        if errors:
+            return lambda calc, row, col: calc.range_values(*bounds(row, col))
+        return lambda calc, row, col: calc.range_array(*bounds(row, col))
+    fn = _build(node)
+    return lambda calc, row, col: np.array([fn(calc, row, col)], dtype=np.float64)
+
+def _aggregate(reduce, errors=True):
+    """
+    Crea el constructor de una función de agregado que reduce con NumPy todos
+    sus argumentos. Sin errors (CONTAR), los errores de los rangos se ignoran.
+    """
+    def builder(args):
+        parts = [_build_numbers(a, errors) for a in args]
+        if len(parts) == 1:
+            part = parts[0]
+            return lambda calc, row, col: reduce(part(calc, row, col))
+        return lambda calc, row, col: reduce(np.concatenate([p(calc, row, col) for p in parts]))
+    return builder
+
+def _sum(vals):
+    return float(vals.sum())
+
+def _mean(vals):
+    return float(vals.mean()) if vals.size else 0
+
+def _min(vals):
+    return float(vals.min()) if vals.size else 0
+
+def _max(vals):
+    return float(vals.max()) if vals.size else 0
+
+def _count(vals):
+    return int(vals.size)
+
+def _build_raiz(args):
+    if len(args) != 1:
+        raise FormulaError("RAIZ espera un argumento")
+    fn = _build(args[0])
+    return lambda calc, row, col: math.sqrt(fn(calc, row, col))
+
+def _lookup_bounds(node):
+    """
+    Función (fila, columna) -> (fila1, col1, fila2, col2) de un argumento
+    que debe ser un rango (una celda suelta cuenta como rango de 1x1).
+    """
+    if node[0] == 'range':
+        return _range_bounds(node)
+    if node[0] == 'ref':
+        (r, fr), (c, fc) = node[1], node[2]
+        def bounds(row, col):
+            a, b = r + fr * row, c + fc * col
+            return a, b, a, b
+        return bounds
+    raise FormulaError("se esperaba un rango")
+
+def _build_value(node):
+    """
+    Closure del valor buscado: una celda se lee como número o como texto.
+    """
+    if node[0] == 'ref':
+        (r, fr), (c, fc) = node[1], node[2]
+        return lambda calc, row, col: calc.value_at(r + fr * row, c + fc * col)
+    return _build(node)
+
+def _lookup_key(value):
+    # Clave de búsqueda: los textos no distinguen mayúsculas
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        return value.casefold()
+    return float(value)
+
+def _find(lookup, key, match):
+    # match: 0 exacta, 1 el mayor <= clave, -1 el menor >= clave
+    if key is None:
+        return None
+    if match == 0:
+        return lookup.exact(key)
+    return lookup.approximate(key, match < 0)
+
+def _cell_result(value):
+    # Una celda vacía devuelve 0, como en Excel
+    return 0.0 if value is None else value
+
+def _build_table_lookup(vertical):
+    """
+    Constructor de BUSCARV (vertical) o BUSCARH: busca en la primera columna
+    (o fila) del rango y devuelve la celda de la columna (o fila) indicada.
+    El cuarto argumento, VERDADERO por defecto, pide coincidencia aproximada.
+    """
+    name = 'BUSCARV' if vertical else 'BUSCARH'
+    def builder(args):
+        if len(args) not in (3, 4):
+            raise FormulaError(f"{name} espera 3 o 4 argumentos")
+        value = _build_value(args[0])
+        bounds = _lookup_bounds(args[1])
+        index = _build(args[2])
+        approximate = _build(args[3]) if len(args) == 4 else None
+        def evaluate(calc, row, col):
+            r1, c1, r2, c2 = bounds(row, col)
+            offset = int(index(calc, row, col)) - 1
+            if not 0 <= offset <= (c2 - c1 if vertical else r2 - r1):
+                return "#REF!"
+            match = 1 if approximate is None or approximate(calc, row, col) else 0
+            if vertical:
+                pos = _find(calc.lookup_index(r1, c1, r2, c1), _lookup_key(value(calc, row, col)), match)
+                return "#N/A" if pos is None else _cell_result(calc.value_at(r1 + pos, c1 + offset))
+            pos = _find(calc.lookup_index(r1, c1, r1, c2), _lookup_key(value(calc, row, col)), match)
+            return "#N/A" if pos is None else _cell_result(calc.value_at(r1 + offset, c1 + pos))
+        return evaluate
+    return builder
+
+def _build_coincidir(args):
+    """
+    COINCIDIR(valor, rango, [tipo]): posición (desde 1) del valor en una fila
+    o columna. tipo 1 (por defecto): el mayor <= valor; 0: exacta; -1: el menor >= valor.
+    """
+    if len(args) not in (2, 3):
+        raise FormulaError("COINCIDIR espera 2 o 3 argumentos")
+    value = _build_value(args[0])
+    bounds = _lookup_bounds(args[1])
+    kind = _build(args[2]) if len(args) == 3 else None
+    def evaluate(calc, row, col):
+        r1, c1, r2, c2 = bounds(row, col)
+        if r1 != r2 and c1 != c2:
+            return "#N/A"
+        match = 1 if kind is None else int(kind(calc, row, col))
+        pos = _find(calc.lookup_index(r1, c1, r2, c2), _lookup_key(value(calc, row, col)),
+                    (match > 0) - (match < 0))
+        return "#N/A" if pos is None else float(pos + 1)
+    return evaluate
+
+def _build_indice(args):
+    """
+    INDICE(rango, fila, [columna]): valor de la celda en esa posición del
+    rango. Con un rango de una sola fila o columna basta un índice.
+    """
+    if len(args) not in (2, 3):
+        raise FormulaError("INDICE espera 2 o 3 argumentos")
+    bounds = _lookup_bounds(args[0])
+    first = _build(args[1])
+    second = _build(args[2]) if len(args) == 3 else None
+    def evaluate(calc, row, col):
+        r1, c1, r2, c2 = bounds(row, col)
+        i = int(first(calc, row, col)) - 1
+        if second is not None:
+            j = int(second(calc, row, col)) - 1
+        elif r1 == r2:
+            i, j = 0, i
+        else:
+            j = 0
+        if not (0 <= i <= r2 - r1 and 0 <= j <= c2 - c1):
+            return "#REF!"
+        return _cell_result(calc.value_at(r1 + i, c1 + j))
+    return evaluate
+
+# --- Agregados condicionales ---
+_CRITERION_RE = re.compile(r'(<=|>=|<>|<|>|=)?(.*)', re.DOTALL)
+_COMPARISONS = {'=': operator.eq, '<>': operator.ne, '<': operator.lt, '<=': operator.le,
+                '>': operator.gt, '>=': operator.ge}
+
+def _wildcard_regex(text):
+    # Comodines de Excel: * cualquier texto, ? un carácter, ~ escapa el siguiente
+    parts = []
+    escaped = False
+    for ch in text:
+        if escaped:
+            parts.append(re.escape(ch))
+            escaped = False
+        elif ch == '~':
+            escaped = True
+        elif ch == '*':
+            parts.append('.*')
+        elif ch == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(ch))
+    return re.compile(''.join(parts), re.DOTALL)
+
+@lru_cache(maxsize=4096)
+def parse_criterion(criterion):
+    """
+    Convierte un criterio de SUMAR.SI ('>100', 'a*', 5, '<>', '') en
+    (operador, tipo, operando). El tipo es 'num', 'text' (en minúsculas),
+    'pattern' (expresión regular de los comodines) o 'empty'.
+    """
+    if not isinstance(criterion, str):
+        return '=', 'num', float(criterion)
+    op, rest = _CRITERION_RE.fullmatch(criterion).groups()
+    op = op or '='
+    if rest == '':
+        return op, 'empty', None
+    number = parse_number(rest)
+    if number is not None:
+        return op, 'num', number
+    rest = rest.casefold()
+    if op in ('=', '<>') and ('*' in rest or '?' in rest):
+        return op, 'pattern', _wildcard_regex(rest)
+    return op, 'text', rest
+
+def criterion_mask(data, criterion):
+    """
+    Máscara booleana (filas x columnas) de las celdas de un rango que cumplen
+    el criterio. 'data' es (valores, máscara numérica, posiciones de texto,
+    textos en minúsculas) tal como lo devuelve Sheet.criteria_data.
+    """
+    values, valid, text_index, texts = data
+    op, kind, operand = parse_criterion(criterion)
+    if kind == 'num':
+        with np.errstate(invalid='ignore'):
+            mask = _COMPARISONS[op](values, operand)
+        return mask | ~valid if op == '<>' else mask & valid
+    has_text = np.zeros(values.size, dtype=bool)
+    has_text[text_index] = True
+    has_text = has_text.reshape(values.shape)
+    if kind == 'empty':
+        empty = ~valid & ~has_text
+        if op == '=':
+            return empty
+        return ~empty if op == '<>' else np.zeros(values.shape, dtype=bool)
+    if kind == 'pattern':
+        hits = [operand.fullmatch(text) is not None for text in texts]
+    else:
+        compare = _COMPARISONS[op]
+        hits = [compare(text, operand) for text in texts] if op != '<>' else \
+            [text == operand for text in texts]
+    mask = np.zeros(values.size, dtype=bool)
+    mask[text_index[np.array(hits, dtype=bool)]] = True
+    mask = mask.reshape(values.shape)
+    return ~mask if op == '<>' else mask
+
+def _criteria_args(args, start, name):
+    """
+    Pares (límites del rango, closure del criterio) desde el argumento 'start'.
+    """
+    if len(args) < start + 2 or (len(args) - start) % 2:
+        raise FormulaError(f"{name} espera pares de rango y criterio")
+    return [(_lookup_bounds(args[i]), _build_value(args[i + 1])) for i in range(start, len(args), 2)]
+
+def _conditions(calc, row, col, pairs):
+    """
+    ((límites, criterio), ...) evaluados en la celda; todos los rangos deben
+    tener el mismo tamaño.
+    """
+    conditions = []
+    for bounds, criterion in pairs:
+        rng = bounds(row, col)
+        if conditions and not _same_shape(rng, conditions[0][0]):
+            raise FormulaError("los rangos deben tener el mismo tamaño")
+        value = criterion(calc, row, col)
+        conditions.append((rng, "" if value is None else value))
+    return tuple(conditions)
+
+def _same_shape(a, b):
+    return (a[2] - a[0], a[3] - a[1]) == (b[2] - b[0], b[3] - b[1])
+
+def _target(bounds, shape, row, col):
+    # Rango de suma con el tamaño del rango de criterios, desde su esquina
+    r1, c1 = bounds(row, col)[:2]
+    return r1, c1, r1 + shape[2] - shape[0], c1 + shape[3] - shape[1]
+
+def _build_conditional(kind):
+    """
+    Constructor de SUMAR.SI, CONTAR.SI y PROMEDIO.SI (rango, criterio,
+    [rango de suma]). Con un solo criterio de igualdad se usan los totales
+    por valor del rango, calculados una vez por recálculo.
+    """
+    name = {'sum': 'SUMAR.SI', 'count': 'CONTAR.SI', 'mean': 'PROMEDIO.SI'}[kind]
+    def builder(args):
+        if len(args) not in ((2,) if kind == 'count' else (2, 3)):
+            raise FormulaError(f"{name} espera {'2' if kind == 'count' else '2 o 3'} argumentos")
+        bounds = _lookup_bounds(args[0])
+        criterion = _build_value(args[1])
+        target = _lookup_bounds(args[2]) if len(args) == 3 else bounds
+        def evaluate(calc, row, col):
+            rng = bounds(row, col)
+            value = criterion(calc, row, col)
+            total, numbers, matches = calc.criterion_totals(rng, "" if value is None else value,
+                                                            _target(target, rng, row, col))
+            if kind == 'count':
+                return float(matches)
+            if kind == 'sum':
+                return total
+            return _divide(total, numbers)
+        return evaluate
+    return builder
+
+def _build_conditional_set(kind):
+    """
+    Constructor de SUMAR.SI.CONJUNTO y PROMEDIO.SI.CONJUNTO (rango de suma,
+    rango1, criterio1, ...) y de CONTAR.SI.CONJUNTO (rango1, criterio1, ...):
+    las máscaras de cada criterio se combinan con AND.
+    """
+    name = {'sum': 'SUMAR.SI.CONJUNTO', 'count': 'CONTAR.SI.CONJUNTO', 'mean': 'PROMEDIO.SI.CONJUNTO'}[kind]
+    def builder(args):
+        start = 0 if kind == 'count' else 1
+        pairs = _criteria_args(args, start, name)
+        target = None if kind == 'count' else _lookup_bounds(args[0])
+        def evaluate(calc, row, col):
+            conditions = _conditions(calc, row, col, pairs)
+            if kind == 'count':
+                return float(calc.criteria_set_totals(conditions, None)[2])
+            tr = target(row, col)
+            if not _same_shape(tr, conditions[0][0]):
+                raise FormulaError("los rangos deben tener el mismo tamaño")
+            total, numbers, matches = calc.criteria_set_totals(conditions, tr)
+            return total if kind == 'sum' else _divide(total, numbers)
+        return evaluate
+    return builder
+
+# Funciones disponibles en las fórmulas: nombre -> constructor de closure
+FORMULA_FUNCTIONS = {
+    'SUMA': _aggregate(_sum),
+    'PROMEDIO': _aggregate(_mean),
+    'MIN': _aggregate(_min),
+    'MAX': _aggregate(_max),
+    'CONTAR': _aggregate(_count, errors=False),
+    'RAIZ': _build_raiz,
+    'BUSCARV': _build_table_lookup(True),
+    'BUSCARH': _build_table_lookup(False),
+    'COINCIDIR': _build_coincidir,
+    'INDICE': _build_indice,
+    'SUMAR.SI': _build_conditional('sum'),
+    'CONTAR.SI': _build_conditional('count'),
+    'PROMEDIO.SI': _build_conditional('mean'),
+    'SUMAR.SI.CONJUNTO': _build_conditional_set('sum'),
+    'CONTAR.SI.CONJUNTO': _build_conditional_set('count'),
+    'PROMEDIO.SI.CONJUNTO': _build_conditional_set('mean'),
+}
+
+# Funciones que solo leen valores numéricos: sus fórmulas pueden evaluarse
+# en procesos auxiliares sobre la copia de la hoja en memoria compartida
+NUMERIC_FUNCTIONS = frozenset(['SUMA', 'PROMEDIO', 'MIN', 'MAX', 'CONTAR', 'RAIZ'])
+
+def _build(node):
+    """
+    Convierte un nodo del árbol sintáctico en una closure fn(calc, fila, columna).
+    """
+    kind = node[0]
+    if kind == 'const':
+        value = node[1]
+        return lambda calc, row, col: value
+    if kind == 'ref':
+        (r, fr), (c, fc) = node[1], node[2]
+        return lambda calc, row, col: calc.number_at(r + fr * row, c + fc * col)
+    if kind == 'error':
+        message = node[1]
+        def fail(calc, row, col):
+            raise InvalidReference(message)
+        return fail
+    if kind == 'neg':
+        fn = _build(node[1])
+        return lambda calc, row, col: -fn(calc, row, col)
+    if kind == 'bin':
+        op = _BINARY_OPS[node[1]]
+        left, right = _build(node[2]), _build(node[3])
+        return lambda calc, row, col: op(left(calc, row, col), right(calc, row, col))
+    if kind == 'call':
+        builder = FORMULA_FUNCTIONS.get(node[1])
+        if builder is None:
+            raise FormulaError(f"función desconocida: {node[1]}")
+        return builder(node[2])
+    raise FormulaError("rango fuera de una función")
+
+def _collect(node, cells, ranges, functions):
+    kind = node[0]
+    if kind == 'ref':
+        cells.append(node[1:])
+    elif kind == 'range':
+        ranges.append(node)
+    elif kind == 'neg':
+        _collect(node[1], cells, ranges, functions)
+    elif kind == 'bin':
+        _collect(node[2], cells, ranges, functions)
+        _collect(node[3], cells, ranges, functions)
+    elif kind == 'call':
+        functions.add(node[1])
+        for arg in node[2]:
+            _collect(arg, cells, ranges, functions)
+
+class CompiledFormula:
+    """
+    Fórmula compilada a partir de su plantilla: closure de evaluación
+    evaluate(calc, fila, columna) y referencias relativas que lee.
+    """
+    __slots__ = ('template', 'evaluate', 'cell_specs', 'range_bounds', 'numeric_only')
+
+    def __init__(self, template, evaluate, cell_specs, range_bounds, numeric_only):
+        self.template = template
+        self.evaluate = evaluate
+        self.cell_specs = cell_specs
+        self.range_bounds = range_bounds
+        self.numeric_only = numeric_only
+
+    def references(self, row, col):
+        """
+        Referencias absolutas de la fórmula escrita en (fila, columna):
+        celdas sueltas y rangos (fila1, col1, fila2, col2).
+        """
+        cells = {(r + fr * row, c + fc * col) for (r, fr), (c, fc) in self.cell_specs}
+        return cells, [bounds(row, col) for bounds in self.range_bounds]
+
+def _failing_formula(template, error):
+    message = str(error)
+    def fail(calc, row, col):
+        raise FormulaError(message)
+    return CompiledFormula(template, fail, (), (), False)
+
+@lru_cache(maxsize=16384)
+def compile_template(template):
+    """
+    Compila una plantilla de fórmula. El resultado se guarda en una caché LRU
+    indexada por la plantilla, de modo que las fórmulas idénticas o copiadas
+    solo se analizan una vez. Las fórmulas con errores de sintaxis se compilan
+    a una closure que lanza el error al evaluarse.
+    """
+    try:
+        tree = FormulaParser(template).parse()
+        cells, ranges, functions = [], [], set()
+        _collect(tree, cells, ranges, functions)
+        return CompiledFormula(template, _build(tree), tuple(cells),
+                               tuple(_range_bounds(node) for node in ranges),
+                               functions <= NUMERIC_FUNCTIONS)
+    except FormulaError as e:
+        return _failing_formula(template, e)
+
+def compile_formula(formula, row=0, col=0):
+    """
+    Compila el texto de una fórmula (sin el '=' inicial) escrita en (fila, columna).
+    """
+    return compile_template(formula_template(formula, row, col))
+
+def column_name(col):
+    """
+    Devuelve el nombre de columna estilo Excel de un índice (0 -> A, 26 -> AA).
+    """
+    name = ''
+    while True:
+        name = chr(65 + (col % 26)) + name
+        col = col // 26 - 1
+        if col < 0:
+            return name
+
+def format_number(value):
+    """
+    Forma canónica de un número tal como se muestra en la hoja.
+    """
+    if value.is_integer() and abs(value) < 1e16:
+        return str(int(value))
+    return repr(value)
+
+def move_index(index, start, delta):
+    """
+    Nueva posición de una fila/columna tras insertar (delta > 0) o eliminar
+    (delta < 0) en 'start'; None si la posición se elimina.
+    """
+    if index < start:
+        return index
+    if delta < 0 and index < start - delta:
+        return None
+    return index + delta
+
+# Referencias A1 y rangos A1:B5 dentro del texto de una fórmula
+_SHIFT_RE = re.compile(r'("(?:[^"]|"")*")|(?<![A-Za-z0-9_.$])(\$?)([A-Za-z]+)(\$?)([0-9]+)'
+                       r'(?::(\$?)([A-Za-z]+)(\$?)([0-9]+))?(?![A-Za-z0-9_.(])')
+
+def move_span(first, last, start, delta):
+    """
+    Nuevos extremos de un tramo de filas/columnas [first, last] tras insertar
+    o eliminar en 'start', como Excel: una inserción dentro del tramo lo
+    alarga, una eliminación lo recorta y, si se elimina entero, devuelve None.
+    """
+    if delta > 0:
+        return (first + delta if first >= start else first,
+                last + delta if last >= start else last)
+    end = start - delta
+    first = first if first < start else (start if first < end else first + delta)
+    last = last if last < start else (start - 1 if last < end else last + delta)
+    return (first, last) if first <= last else None
+
+def shift_references(formula, axis, start, delta):
+    """
+    Reescribe las referencias A1 de una fórmula tras insertar (delta > 0) o
+    eliminar (delta < 0) filas (axis=0) o columnas (axis=1) en 'start': se
+    mueven con sus celdas (también las absolutas), los rangos se alargan o
+    recortan y lo eliminado pasa a #REF!. Devuelve (fórmula, cambia), con
+    'cambia' a True si alguna referencia apunta ahora a otras celdas (un
+    rango de otro tamaño o #REF!) y no solo a las mismas en otro sitio.
+    """
+    changed = False
+    def write(pos, col_abs, row_abs):
+        return f"{col_abs}{column_name(pos[1])}{row_abs}{pos[0] + 1}"
+    def replace(match):
+        nonlocal changed
+        if match.group(1):
+            return match.group(1)
+        first = ref_to_pos(match.group(3) + match.group(5))
+        last = ref_to_pos(match.group(7) + match.group(9)) if match.group(7) else None
+        if first is None or (match.group(7) and last is None):
+            return match.group(0)
+        first = list(first)
+        if last is None:
+            first[axis] = move_index(first[axis], start, delta)
+            if first[axis] is None:
+                changed = True
+                return "#REF!"
+            return write(first, match.group(2), match.group(4))
+        last = list(last)
+        swap = first[axis] > last[axis]
+        lo, hi = (last[axis], first[axis]) if swap else (first[axis], last[axis])
+        span = move_span(lo, hi, start, delta)
+        if span is None or span[1] - span[0] != hi - lo:
+            changed = True
+            if span is None:
+                return "#REF!"
+        first[axis], last[axis] = span[::-1] if swap else span
+        return (write(first, match.group(2), match.group(4)) + ":" +
+                write(last, match.group(6), match.group(8)))
+    return _SHIFT_RE.sub(replace, formula), changed
+
+def _is_error(result):
+    # Resultado de error de una fórmula (#REF!, #N/A, #CICLO, #ERROR...)
+    return isinstance(result, str) and result.startswith('#')
+
+def parse_number(value):
+    """
+    Devuelve el valor numérico de un texto o de un resultado, o None si no es un número.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# Filas por bloque de los mínimos y máximos precalculados de cada columna
+STATS_BLOCK = 1024
+
+class NumericStore:
+    """
+    Almacén columnar de los valores numéricos de la hoja: por cada columna, un
+    array float64 y una máscara de validez, al lado del texto mostrado.
+    Permite reducir rangos grandes con NumPy sin tocar los items de la tabla.
+
+    Para las estadísticas de la selección se guardan, por columna, sumas y
+    recuentos acumulados y el mínimo y máximo de cada bloque de STATS_BLOCK
+    filas. Se calculan al pedirlos y, tras una edición, solo se rehacen desde
+    la primera fila modificada.
+    """
+    def __init__(self):
+        self.columns = {}  # columna -> (valores, máscara)
+        self.prefix = {}   # columna -> (sumas, recuentos, mínimos, máximos)
+        self.dirty = {}    # columna -> primera fila modificada desde el último cálculo
+
+    def clear(self):
+        self.columns = {}
+        self.prefix.clear()
+        self.dirty.clear()
+
+    def _touch(self, col, row):
+        if col in self.prefix:
+            first = self.dirty.get(col)
+            if first is None or row < first:
+                self.dirty[col] = row
+
+    def _column(self, col, min_rows):
+        column = self.columns.get(col)
+        if column is None or len(column[0]) < min_rows:
+            old_size = len(column[0]) if column is not None else 0
+            size = max(min_rows, 2 * old_size, 64)
+            values = np.zeros(size, dtype=np.float64)
+            valid = np.zeros(size, dtype=bool)
+            if column is not None:
+                values[:old_size] = column[0]
+                valid[:old_size] = column[1]
+            column = self.columns[col] = (values, valid)
+        return column
+
+    def set(self, row, col, value):
+        """
+        Guarda el número de una celda; None la marca como no numérica.
+        """
+        if value is None:
+            column = self.columns.get(col)
+            if column is not None and row < len(column[1]):
+                column[1][row] = False
+                if self.prefix:
+                    self._touch(col, row)
+            return
+        values, valid = self._column(col, row + 1)
+        values[row] = value
+        valid[row] = True
+        if self.prefix:
+            self._touch(col, row)
+
+    def get(self, row, col):
+        """
+        Devuelve el número de una celda, o None si no es numérica.
+        """
+        column = self.columns.get(col)
+        if column is None or not 0 <= row < len(column[1]) or not column[1][row]:
+            return None
+        return float(column[0][row])
+
+    def set_block(self, col, start, values, valid):
+        """
+        Copia un bloque de filas consecutivas de una columna.
+        """
+        end = start + len(values)
+        column_values, column_valid = self._column(col, end)
+        column_values[start:end] = values
+        column_valid[start:end] = valid
+        self._touch(col, start)
+
+    def occupied_rows(self, col, r1, r2):
+        """
+        Devuelve las filas con número válido de una columna entre r1 y r2.
+        """
+        column = self.columns.get(col)
+        if column is None:
+            return np.empty(0, dtype=np.intp)
+        return np.flatnonzero(column[1][r1:r2 + 1]) + r1
+
+    def insert_rows(self, row, count):
+        for col, (values, valid) in list(self.columns.items()):
+            if row < len(values):
+                self.columns[col] = (np.insert(values, row, np.zeros(count)),
+                                     np.insert(valid, row, np.zeros(count, dtype=bool)))
+                self._touch(col, row)
+
+    def remove_rows(self, row, count):
+        for col, (values, valid) in list(self.columns.items()):
+            if row < len(values):
+                removed = slice(row, row + count)
+                self.columns[col] = (np.delete(values, removed), np.delete(valid, removed))
+                self._touch(col, row)
+
+    def shift_cols(self, col, delta):
+        """
+        Desplaza las columnas desde 'col' (inserción si delta > 0, borrado si delta < 0).
+        """
+        columns = {}
+        for c, column in self.columns.items():
+            new_col = move_index(c, col, delta)
+            if new_col is not None:
+                columns[new_col] = column
+        self.columns = columns
+        self.prefix.clear()
+        self.dirty.clear()
+
+    def permute_rows(self, order):
+        """
+        Reordena las primeras len(order) filas: la fila nueva i toma la antigua order[i].
+        """
+        order = np.asarray(order, dtype=np.intp)
+        for col in list(self.columns):
+            values, valid = self._column(col, len(order))
+            values[:len(order)] = values[order]
+            valid[:len(order)] = valid[order]
+            self._touch(col, 0)
+
+    def _prefix(self, col, values, valid):
+        # Acumulados de una columna, rehechos desde la primera fila modificada
+        n = len(values)
+        start = self.dirty.pop(col, None)
+        cached = self.prefix.get(col)
+        if cached is None or len(cached[0]) != n + 1:
+            blocks = -(-n // STATS_BLOCK)
+            cached = self.prefix[col] = (np.zeros(n + 1), np.zeros(n + 1, dtype=np.int64),
+                                         np.empty(blocks), np.empty(blocks))
+            start = 0
+        elif start is None:
+            return cached
+        sums, counts, mins, maxs = cached
+        np.cumsum(np.where(valid[start:], values[start:], 0.0), out=sums[start + 1:])
+        sums[start + 1:] += sums[start]
+        np.cumsum(valid[start:], out=counts[start + 1:])
+        counts[start + 1:] += counts[start]
+        first = start // STATS_BLOCK
+        lo = first * STATS_BLOCK
+        padded = np.full((len(mins) - first) * STATS_BLOCK, np.inf)
+        padded[:n - lo] = np.where(valid[lo:], values[lo:], np.inf)
+        mins[first:] = padded.reshape(-1, STATS_BLOCK).min(axis=1)
+        padded[:] = -np.inf
+        padded[:n - lo] = np.where(valid[lo:], values[lo:], -np.inf)
+        maxs[first:] = padded.reshape(-1, STATS_BLOCK).max(axis=1)
+        return cached
+
+    def range_stats(self, r1, c1, r2, c2):
+        """
+        Devuelve (recuento, suma, mínimo, máximo) de los números de un rango.
+        El coste depende del número de columnas, no del de celdas. Se puede
+        llamar mientras un Recalculation escribe resultados desde otro hilo:
+        se recorre una copia de las columnas (al crecer, una columna se
+        sustituye por otra, nunca se redimensiona en su sitio).
+        """
+        count, total, low, high = 0, 0.0, np.inf, -np.inf
+        r1 = max(r1, 0)
+        for col, (values, valid) in list(self.columns.items()):
+            if not c1 <= col <= c2:
+                continue
+            last = min(r2, len(values) - 1)
+            if last < r1:
+                continue
+            sums, counts, mins, maxs = self._prefix(col, values, valid)
+            n = int(counts[last + 1] - counts[r1])
+            if not n:
+                continue
+            count += n
+            total += sums[last + 1] - sums[r1]
+            b1, b2 = -(-r1 // STATS_BLOCK), (last + 1) // STATS_BLOCK
+            if b1 < b2:
+                low = min(low, mins[b1:b2].min())
+                high = max(high, maxs[b1:b2].max())
+                edges = ((r1, b1 * STATS_BLOCK), (b2 * STATS_BLOCK, last + 1))
+            else:
+                edges = ((r1, last + 1),)
+            for a, b in edges:
+                part = values[a:b][valid[a:b]]
+                if len(part):
+                    low = min(low, part.min())
+                    high = max(high, part.max())
+        return count, float(total), float(low), float(high)
+
+    def range_array(self, r1, c1, r2, c2):
+        """
+        Devuelve los números válidos de un rango, recorrido por filas.
+        """
+        r1, c1 = max(r1, 0), max(c1, 0)
+        if r2 < r1 or c2 < c1:
+            return np.empty(0)
+        if c1 == c2:
+            column = self.columns.get(c1)
+            if column is None:
+                return np.empty(0)
+            values, valid = column
+            return values[r1:r2 + 1][valid[r1:r2 + 1]]
+        if r1 == r2:
+            # Rango de una sola fila (caso típico de las fórmulas copiadas hacia abajo)
+            row = []
+            for col in range(c1, c2 + 1):
+                column = self.columns.get(col)
+                if column is not None and r1 < len(column[1]) and column[1][r1]:
+                    row.append(column[0][r1])
+            return np.array(row)
+        height = r2 - r1 + 1
+        values = np.zeros((height, c2 - c1 + 1))
+        valid = np.zeros((height, c2 - c1 + 1), dtype=bool)
+        for j, col in enumerate(range(c1, c2 + 1)):
+            column = self.columns.get(col)
+            if column is not None:
+                part = column[0][r1:r2 + 1]
+                values[:len(part), j] = part
+                valid[:len(part), j] = column[1][r1:r2 + 1]
+        return values[valid]
+
+# Tamaño de los tramos de filas del índice de rangos del grafo de dependencias
+RANGE_BUCKET = 32
+RANGE_WIDE_BUCKETS = 64
+
+# Cada cuántas celdas se comprueba si hay que abandonar una ordenación cancelable
+STOP_CHECK_CELLS = 4096
+
+class DependencyGraph:
+    """
+    Grafo de precedentes/dependientes entre celdas con fórmulas.
+    Las referencias a celdas sueltas se guardan por celda y las de rangos
+    por columna, para no expandir rangos grandes celda a celda.
+    """
+    def __init__(self):
+        self.precedents = {}        # celda -> (celdas, rangos) que lee su fórmula
+        self.dependents = {}        # celda -> celdas con fórmula que la leen
+        # (columna, tipo, fila o tramo) -> {celda con fórmula: [(fila1, fila2), ...]}
+        self.range_dependents = {}
+
+    def set_precedents(self, cell, cells, ranges):
+        """
+        Sustituye los precedentes de una celda con fórmula.
+        """
+        self.remove(cell)
+        self.precedents[cell] = (cells, ranges)
+        for ref in cells:
+            self.dependents.setdefault(ref, set()).add(cell)
+        for r1, c1, r2, c2 in ranges:
+            for key in self._range_keys(r1, c1, r2, c2):
+                self.range_dependents.setdefault(key, {}).setdefault(cell, []).append((r1, r2))
+
+    def build(self, formulas):
+        """
+        Construye de golpe el grafo vacío a partir de pares (celda, fórmula
+        compilada), sin pasar por remove(). El recolector de basura se pausa
+        mientras tanto: crear cientos de miles de conjuntos pequeños lo
+        dispara una y otra vez sin que haya nada que recoger.
+        """
+        dependents, range_dependents = self.dependents, self.range_dependents
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for cell, compiled in formulas:
+                cells, ranges = compiled.references(*cell)
+                self.precedents[cell] = (cells, ranges)
+                for ref in cells:
+                    dependents.setdefault(ref, set()).add(cell)
+                for r1, c1, r2, c2 in ranges:
+                    for key in self._range_keys(r1, c1, r2, c2):
+                        range_dependents.setdefault(key, {}).setdefault(cell, []).append((r1, r2))
+        finally:
+            if enabled:
+                gc.enable()
+
+    @staticmethod
+    def _range_keys(r1, c1, r2, c2):
+        """
+        Claves del índice de rangos. Los rangos cortos se apuntan fila a fila,
+        los medianos en cada tramo de RANGE_BUCKET filas que tocan y los muy
+        largos una sola vez por columna, de modo que buscar quién lee una celda
+        solo revisa tres entradas pequeñas.
+        """
+        if r2 - r1 < RANGE_BUCKET:
+            spans = [(0, row) for row in range(r1, r2 + 1)]
+        elif r2 // RANGE_BUCKET - r1 // RANGE_BUCKET < RANGE_WIDE_BUCKETS:
+            spans = [(1, bucket) for bucket in range(r1 // RANGE_BUCKET, r2 // RANGE_BUCKET + 1)]
+        else:
+            spans = [(2, 0)]
+        return [(col, kind, n) for col in range(c1, c2 + 1) for kind, n in spans]
+
+    def remove(self, cell):
+        """
+        Elimina la celda del grafo (deja de ser una fórmula).
+        """
+        old = self.precedents.pop(cell, None)
+        if not old:
+            return
+        cells, ranges = old
+        for ref in cells:
+            deps = self.dependents.get(ref)
+            if deps:
+                deps.discard(cell)
+                if not deps:
+                    del self.dependents[ref]
+        for r1, c1, r2, c2 in ranges:
+            for key in self._range_keys(r1, c1, r2, c2):
+                key_deps = self.range_dependents.get(key)
+                if key_deps:
+                    key_deps.pop(cell, None)
+                    if not key_deps:
+                        del self.range_dependents[key]
+
+    def clear(self):
+        """
+        Vacía el grafo por completo.
+        """
+        self.precedents.clear()
+        self.dependents.clear()
+        self.range_dependents.clear()
+
+    def direct_dependents(self, cell):
+        """
+        Devuelve las celdas con fórmula que leen directamente la celda dada.
+        """
+        deps = set(self.dependents.get(cell, ()))
+        row, col = cell
+        for key in ((col, 0, row), (col, 1, row // RANGE_BUCKET), (col, 2, 0)):
+            for dep, spans in self.range_dependents.get(key, {}).items():
+                for r1, r2 in spans:
+                    if r1 <= row <= r2:
+                        deps.add(dep)
+                        break
+        return deps
+
+    def affected(self, cells, stop=None):
+        """
+        Devuelve todas las celdas que dependen (directa o indirectamente) de
+        las dadas. Como en topological_levels, 'stop' permite abandonar (None).
+        """
+        seen = set()
+        stack = list(cells)
+        checked = 0
+        while stack:
+            if stop is not None:
+                checked += 1
+                if not checked % STOP_CHECK_CELLS and stop():
+                    return None
+            for dep in self.direct_dependents(stack.pop()):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+        return seen
+
+    def range_affected(self, r1, c1, r2, c2):
+        """
+        Devuelve las celdas con fórmula que dependen (directa o indirectamente)
+        de alguna celda del rango, sin consultar el rango celda a celda.
+        """
+        seeds = set()
+        if (r2 - r1 + 1) * (c2 - c1 + 1) < len(self.dependents):
+            for row in range(r1, r2 + 1):
+                for col in range(c1, c2 + 1):
+                    seeds.update(self.dependents.get((row, col), ()))
+        else:
+            for (row, col), deps in self.dependents.items():
+                if r1 <= row <= r2 and c1 <= col <= c2:
+                    seeds.update(deps)
+        for (col, kind, n), deps in self.range_dependents.items():
+            if c1 <= col <= c2:
+                for dep, spans in deps.items():
+                    if any(a <= r2 and r1 <= b for a, b in spans):
+                        seeds.add(dep)
+        return seeds | self.affected(seeds)
+
+    def referencing(self, axis, start):
+        """
+        Celdas con fórmula que leen alguna celda, suelta o dentro de un rango,
+        desde la fila (axis=0) o columna (axis=1) 'start' en adelante: las que
+        hay que reescribir al insertar o eliminar ahí.
+        """
+        found = set()
+        for ref, deps in self.dependents.items():
+            if ref[axis] >= start:
+                found |= deps
+        for (col, kind, n), deps in self.range_dependents.items():
+            if axis == 1 or kind == 0:
+                if (col if axis == 1 else n) >= start:
+                    found.update(deps)
+                continue
+            for dep, spans in deps.items():
+                if dep not in found and any(r2 >= start for r1, r2 in spans):
+                    found.add(dep)
+        return found
+
+    def topological_levels(self, dirty, stop=None):
+        """
+        Agrupa las celdas sucias por nivel de dependencia: las celdas de un
+        mismo nivel no dependen entre sí y solo leen niveles anteriores.
+        Devuelve (niveles, celdas_en_ciclo). Si se da 'stop', se consulta cada
+        STOP_CHECK_CELLS celdas y, cuando devuelve True, se abandona y se devuelve None.
+        """
+        indegree = dict.fromkeys(dirty, 0)
+        edges = {}
+        for i, cell in enumerate(dirty):
+            if stop is not None and not i % STOP_CHECK_CELLS and stop():
+                return None
+            deps = [d for d in self.direct_dependents(cell) if d in indegree]
+            edges[cell] = deps
+            for dep in deps:
+                indegree[dep] += 1
+        level = [cell for cell, n in indegree.items() if n == 0]
+        levels = []
+        while level:
+            if stop is not None and stop():
+                return None
+            levels.append(level)
+            following = []
+            for cell in level:
+                for dep in edges[cell]:
+                    indegree[dep] -= 1
+                    if indegree[dep] == 0:
+                        following.append(dep)
+            level = following
+        cyclic = [cell for cell, n in indegree.items() if n > 0]
+        return levels, cyclic
+
+    def topological_order(self, dirty):
+        """
+        Ordena las celdas sucias para evaluarlas después de sus precedentes.
+        Devuelve (orden, celdas_en_ciclo).
+        """
+        levels, cyclic = self.topological_levels(dirty)
+        return [cell for level in levels for cell in level], cyclic
+
+# --- Recálculo en paralelo ---
+# Número mínimo de celdas sucias para repartir el recálculo entre procesos;
+# por debajo, arrancar el pool cuesta más de lo que se gana.
+PARALLEL_MIN_CELLS = 20000
+PARALLEL_CHUNK = 5000
+
+class DenseSheetView:
+    """
+    Vista de solo lectura de los números de la hoja sobre dos arrays densos
+    (filas x columnas): valores y máscara de validez. Los procesos auxiliares
+    la crean sobre memoria compartida.
+    """
+    def __init__(self, values, valid):
+        self.values = values
+        self.valid = valid
+        self.rows, self.cols = values.shape
+
+    def number_at(self, row, col):
+        if 0 <= row < self.rows and 0 <= col < self.cols and self.valid[row, col]:
+            return float(self.values[row, col])
+        return 0
+
+    def range_array(self, r1, c1, r2, c2):
+        block = np.s_[max(r1, 0):r2 + 1, max(c1, 0):c2 + 1]
+        return self.values[block][self.valid[block]]
+
+    # Las fórmulas que leen errores no llegan a los procesos auxiliares
+    range_values = range_array
+
+    def get_cell_value(self, row, col):
+        if 0 <= row < self.rows and 0 <= col < self.cols and self.valid[row, col]:
+            return float(self.values[row, col])
+        return ""
+
+_worker_state = {}
+
+def _init_recalc_worker(values_name, valid_name, shape):
+    """
+    Inicializa un proceso auxiliar: se conecta a la memoria compartida de la hoja.
+    """
+    from multiprocessing import shared_memory
+    values_shm = shared_memory.SharedMemory(name=values_name)
+    valid_shm = shared_memory.SharedMemory(name=valid_name)
+    _worker_state['shm'] = (values_shm, valid_shm)
+    _worker_state['view'] = DenseSheetView(np.ndarray(shape, np.float64, buffer=values_shm.buf),
+                                           np.ndarray(shape, bool, buffer=valid_shm.buf))
+
+def _evaluate_chunk(cells, view=None):
+    """
+    Evalúa una lista de (fila, columna, plantilla). Devuelve (números, máscara,
+    {índice: resultado no float}) para fusionarlos de una vez en la hoja.
+    """
+    view = view or _worker_state['view']
+    numbers = np.zeros(len(cells))
+    valid = np.zeros(len(cells), dtype=bool)
+    others = {}
+    for i, (row, col, template) in enumerate(cells):
+        try:
+            result = compile_template(template).evaluate(view, row, col)
+        except CellError as e:
+            result = str(e)
+        except Exception as e:
+            result = f"#ERROR: {e}"
+        number = parse_number(result)
+        if number is not None:
+            numbers[i] = number
+            valid[i] = True
+        if type(result) is not float:
+            others[i] = result
+    return numbers, valid, others
+
+def _gil_disabled():
+    return hasattr(sys, '_is_gil_enabled') and not sys._is_gil_enabled()
+
+class ParallelRecalculator:
+    """
+    Recalcula por niveles de dependencia repartiendo cada nivel grande entre
+    varios núcleos. Los valores de la hoja se copian una vez a memoria
+    compartida y cada proceso lee de ahí; solo viajan las plantillas de las
+    fórmulas y los resultados de cada bloque. Con un intérprete sin GIL se
+    usan hilos sobre la propia hoja.
+    """
+    def __init__(self, sheet, workers=None):
+        self.sheet = sheet
+        self.workers = workers or os.cpu_count() or 1
+
+    @profiled('recálculo en paralelo')
+    def run(self, levels):
+        # Importación diferida: el motor arranca sin cargar multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        from multiprocessing import shared_memory
+        if _gil_disabled():
+            with ThreadPoolExecutor(self.workers) as pool:
+                for level in levels:
+                    self._run_level(level, pool, self.sheet)
+            return
+        rows, cols = self.sheet.used_range()
+        shape = (max(rows, 1), max(cols, 1))
+        values_shm = shared_memory.SharedMemory(create=True, size=shape[0] * shape[1] * 8)
+        valid_shm = shared_memory.SharedMemory(create=True, size=shape[0] * shape[1])
+        try:
+            self.values = np.ndarray(shape, np.float64, buffer=values_shm.buf)
+            self.valid = np.ndarray(shape, bool, buffer=valid_shm.buf)
+            self.valid[:] = False
+            for col, (values, valid) in self.sheet.numbers.columns.items():
+                if col < shape[1]:
+                    n = min(shape[0], len(values))
+                    self.values[:n, col] = values[:n]
+                    self.valid[:n, col] = valid[:n]
+            with ProcessPoolExecutor(self.workers, initializer=_init_recalc_worker,
+                                     initargs=(values_shm.name, valid_shm.name, shape)) as pool:
+                for level in levels:
+                    self._run_level(level, pool, None)
+        finally:
+            self.values = self.valid = None
+            values_shm.close()
+            values_shm.unlink()
+            valid_shm.close()
+            valid_shm.unlink()
+
+    def _run_level(self, level, pool, view):
+        sheet = self.sheet
+        compiled = sheet.compiled
+        # Los procesos auxiliares solo ven números: las fórmulas que leen
+        # algún error se evalúan aquí para propagarlo
+        shared = [cell for cell in level if compiled[cell].numeric_only and not sheet.reads_error(cell)]
+        if len(shared) < PARALLEL_CHUNK:
+            shared = []
+        shared_cells = set(shared)
+        local = [cell for cell in level if cell not in shared_cells] if shared else level
+        chunks = [[(row, col, compiled[(row, col)].template) for row, col in shared[i:i + PARALLEL_CHUNK]]
+                  for i in range(0, len(shared), PARALLEL_CHUNK)]
+        if view is None:
+            results = pool.map(_evaluate_chunk, chunks)
+        else:
+            results = pool.map(_evaluate_chunk, chunks, [view] * len(chunks))
+        for start, (numbers, valid, others) in zip(range(0, len(shared), PARALLEL_CHUNK), results):
+            cells = shared[start:start + len(numbers)]
+            self._merge(cells, numbers, valid, others)
+        for cell in local:
+            result = sheet.evaluate_cell(*cell)
+            number = parse_number(result)
+            self._merge([cell], np.array([number or 0.0]), np.array([number is not None]),
+                        {} if type(result) is float else {0: result})
+
+    def _merge(self, cells, numbers, valid, others):
+        """
+        Guarda en la hoja (y en la copia compartida) los resultados de un bloque.
+        """
+        sheet = self.sheet
+        for i, (row, col) in enumerate(cells):
+            result = others[i] if i in others else float(numbers[i])
+            if sheet.lookups and sheet.values.get((row, col)) != result:
+                sheet._invalidate_lookups(row, col)
+            sheet.values[(row, col)] = result
+            sheet._note_error(row, col, result)
+            sheet.numbers.set(row, col, float(numbers[i]) if valid[i] else None)
+        if self.values is not None and cells:
+            rows = np.fromiter((row for row, col in cells), dtype=np.intp, count=len(cells))
+            cols = np.fromiter((col for row, col in cells), dtype=np.intp, count=len(cells))
+            self.values[rows, cols] = numbers
+            self.valid[rows, cols] = valid
+
+# --- Recálculo en segundo plano ---
+# Intervalo (s) entre dos entregas de resultados de un recálculo en segundo plano
+RECALC_REPORT_INTERVAL = 0.05
+
+class Recalculation:
+    """
+    Recálculo interrumpible de las celdas pendientes de una hoja diferida
+    (Sheet.deferred), pensado para ejecutarse en otro hilo. Cada celda sale
+    de sheet.pending al guardarse su resultado, así que al cancelarlo lo que
+    falta sigue pendiente y basta con lanzar otro para continuar. Mientras
+    se ejecuta, nadie más debe modificar la hoja.
+    """
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.cancelled = False
+        self.total = 0  # celdas a evaluar en esta pasada
+        self.done = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    @profiled('recálculo en segundo plano')
+    def run(self, report=None, interval=RECALC_REPORT_INTERVAL):
+        """
+        Evalúa las celdas pendientes en orden topológico. report(celdas) recibe
+        por lotes, cada 'interval' segundos como mucho, las celdas ya
+        calculadas (y, al principio, las que dependen de las editadas, que
+        pasan a estar pendientes). Devuelve False si se canceló antes de terminar.
+        """
+        sheet = self.sheet
+        stop = lambda: self.cancelled
+        if sheet.changed:
+            changed = set(sheet.changed)
+            affected = sheet.graph.affected(changed, stop)
+            if affected is None:
+                return False
+            sheet.pending |= affected
+            sheet.changed -= changed
+            if report is not None:
+                report(list(affected))
+        # Las celdas que dejaron de ser fórmulas mientras esperaban no se evalúan
+        sheet.pending.intersection_update(sheet.formulas)
+        order = sheet.graph.topological_levels(set(sheet.pending), stop)
+        if order is None:
+            return False
+        levels, cyclic = order
+        self.total = len(cyclic) + sum(map(len, levels))
+        evaluate = sheet._profile_cell if PROFILER.enabled else sheet.evaluate_cell
+        batch = []
+        deadline = time.perf_counter() + interval
+        sheet.criteria_cache = {}
+        try:
+            for level in levels:
+                for row, col in level:
+                    if self.cancelled:
+                        return False
+                    sheet._set_result(row, col, evaluate(row, col))
+                    sheet.pending.discard((row, col))
+                    batch.append((row, col))
+                    if report is not None and time.perf_counter() >= deadline:
+                        self.done += len(batch)
+                        report(batch)
+                        batch = []
+                        deadline = time.perf_counter() + interval
+        finally:
+            sheet.criteria_cache = None
+            if batch and report is not None:
+                self.done += len(batch)
+                report(batch)
+        for row, col in cyclic:
+            sheet._set_result(row, col, "#CICLO")
+            sheet.pending.discard((row, col))
+        self.done += len(cyclic)
+        if cyclic and report is not None:
+            report(cyclic)
+        return True
+
+# --- Importación de CSV por bloques ---
+# Primer carácter de los textos que pueden ser números; evita lanzar
+# excepciones con float() en las columnas de texto.
+_NUMBER_START = frozenset('0123456789+-. ')
+
+def format_numbers(values):
+    """
+    Versión vectorizada de format_number: devuelve un array de objetos str.
+    """
+    is_int = (values == np.floor(values)) & (np.abs(values) < 1e16)
+    canon = np.empty(len(values), dtype=object)
+    if is_int.any():
+        canon[is_int] = values[is_int].astype(np.int64).astype(str)
+    if not is_int.all():
+        canon[~is_int] = list(map(repr, values[~is_int].tolist()))
+    return canon
+
+def _non_canonical(texts, values):
+    """
+    Devuelve {fila: texto} de los números cuyo texto no coincide con su forma
+    canónica. La comparación se hace vectorizada y solo se confirman con
+    format_number() los candidatos.
+    """
+    canon = format_numbers(values)
+    extra = {}
+    for i in np.flatnonzero(np.array(texts, dtype=object) != canon).tolist():
+        if format_number(float(values[i])) != texts[i]:
+            extra[i] = texts[i]
+    return extra
+
+def _convert_column(texts, try_numeric=True):
+    """
+    Convierte los textos de una columna de un bloque en (valores, máscara,
+    textos, fórmulas). Si la columna parece numérica se intenta primero la
+    conversión vectorizada de NumPy.
+    """
+    height = len(texts)
+    if try_numeric:
+        try:
+            values = np.array(texts, dtype=np.float64)
+        except ValueError:
+            pass
+        else:
+            return values, np.ones(height, dtype=bool), _non_canonical(texts, values), {}
+    values = np.zeros(height, dtype=np.float64)
+    valid = np.zeros(height, dtype=bool)
+    extra = {}
+    formulas = {}
+    for i, text in enumerate(texts):
+        if not text:
+            continue
+        if text[0] == '=':
+            formulas[i] = text
+            continue
+        if text[0] in _NUMBER_START:
+            number = parse_number(text)
+            if number is not None:
+                values[i] = number
+                valid[i] = True
+                if format_number(number) == text:
+                    continue
+        extra[i] = text
+    return values, valid, extra, formulas
+
+class SheetBlock:
+    """
+    Bloque de filas consecutivas ya convertido a columnas: por columna,
+    (valores, máscara, textos, fórmulas) con filas relativas al bloque.
+    'numeric' indica qué columnas eran enteramente numéricas.
+    """
+    __slots__ = ('start', 'height', 'width', 'columns', 'numeric')
+
+    def __init__(self, start, rows, text_columns=()):
+        self.start = start
+        self.height = len(rows)
+        self.columns = [_convert_column(texts, j not in text_columns)
+                        for j, texts in enumerate(zip_longest(*rows, fillvalue=''))]
+        self.width = len(self.columns)
+        self.numeric = [bool(valid.all()) for values, valid, extra, formulas in self.columns]
+
+# --- Portapapeles ---
+class ClipBlock:
+    """
+    Rectángulo de celdas copiado, guardado por columnas igual que un
+    SheetBlock: (valores, máscara, textos, fórmulas) con filas relativas.
+    'origin' es la celda de origen de la copia: las fórmulas se desplazan al
+    pegarlas en otra posición. Los bloques leídos de otra aplicación (TSV)
+    no tienen origen y sus fórmulas se pegan tal cual.
+    """
+    __slots__ = ('height', 'width', 'columns', 'origin')
+
+    def __init__(self, height, width, columns, origin=None):
+        self.height = height
+        self.width = width
+        self.columns = columns
+        self.origin = origin
+
+    @classmethod
+    def from_tsv(cls, text):
+        """
+        Lee texto separado por tabuladores (el formato del portapapeles de las
+        hojas de cálculo). Las celdas entre comillas pueden contener saltos de línea.
+        """
+        text = text.replace('\r\n', '\n').rstrip('\n')
+        if not text:
+            return cls(0, 0, [])
+        if '"' in text:
+            rows = list(csv.reader(text.split('\n'), delimiter='\t'))
+        else:
+            rows = [line.split('\t') for line in text.split('\n')]
+        block = SheetBlock(0, rows)
+        return cls(block.height, block.width, block.columns)
+
+    def cell_count(self):
+        return self.height * self.width
+
+def iter_csv_rows(path, use_mmap=True, encoding='utf-8', delimiter=','):
+    """
+    Recorre un CSV fila a fila sin cargarlo entero en memoria, opcionalmente
+    sobre un mmap del archivo. Devuelve (fila, bytes_leídos).
+    """
+    with open(path, 'rb') as f:
+        source = f
+        if use_mmap:
+            try:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                source = f  # archivo vacío o sin soporte de mmap
+        try:
+            lines = (line.decode(encoding) for line in iter(source.readline, b''))
+            for row in csv.reader(lines, delimiter=delimiter):
+                yield row, source.tell()
+        finally:
+            if source is not f:
+                source.close()
+
+def read_csv_blocks(path, first_rows=500, block_rows=20000, use_mmap=True, delimiter=','):
+    """
+    Lee un CSV en bloques de filas. El primer bloque es pequeño para poder
+    mostrar enseguida el principio del archivo. Devuelve (SheetBlock, progreso 0..1).
+    """
+    size = os.path.getsize(path) or 1
+    rows = []
+    start = 0
+    limit = first_rows
+    # Columnas que ya han mostrado texto: no se intenta la conversión vectorizada
+    text_columns = set()
+    with PROFILER.span('csv.importar', archivo=os.path.basename(path)):
+        for row, pos in iter_csv_rows(path, use_mmap, delimiter=delimiter):
+            rows.append(row)
+            if len(rows) >= limit:
+                block = SheetBlock(start, rows, text_columns)
+                text_columns.update(j for j, numeric in enumerate(block.numeric) if not numeric)
+                yield block, pos / size
+                start += len(rows)
+                rows = []
+                limit = block_rows
+        if rows:
+            yield SheetBlock(start, rows, text_columns), 1.0
+
+def load_csv(path, delimiter=',', recalculate=True):
+    """
+    Carga un CSV completo en una hoja nueva y evalúa sus fórmulas.
+    """
+    sheet = Sheet(0, 0)
+    for block, _ in read_csv_blocks(path, delimiter=delimiter):
+        sheet.append_block(block)
+    if recalculate:
+        sheet.recalculate(set(sheet.formulas))
+    return sheet
+
+# --- Estilos ---
+# Un estilo es un registro inmutable; cada combinación distinta se guarda una
+# sola vez en la tabla y las celdas solo guardan su número. None en un campo
+# significa "predeterminado".
+STYLE_FIELDS = ('font', 'bold', 'italic', 'underline', 'background', 'foreground', 'alignment')
+Style = namedtuple('Style', STYLE_FIELDS, defaults=(None,) * len(STYLE_FIELDS))
+DEFAULT_STYLE = Style()
+# Por encima de este número de celdas un formato se guarda como un tramo en
+# lugar de celda a celda
+STYLE_RUN_MIN_CELLS = 1024
+
+class StyleTable:
+    """
+    Tabla de estilos internados: el estilo 0 es el predeterminado.
+    """
+    def __init__(self):
+        self.styles = [DEFAULT_STYLE]
+        self.ids = {DEFAULT_STYLE: 0}
+
+    def intern(self, style):
+        sid = self.ids.get(style)
+        if sid is None:
+            sid = self.ids[style] = len(self.styles)
+            self.styles.append(style)
+        return sid
+
+    def changed(self, sid, changes):
+        """
+        Número del estilo resultante de aplicar los cambios {campo: valor} al estilo 'sid'.
+        """
+        style = self.styles[sid]._replace(**changes)
+        return self.intern(style)
+
+def _span_shift(first, last, start, delta):
+    # Desplaza el intervalo [first, last] (last None = hasta el final) al
+    # insertar (delta > 0) o eliminar (delta < 0) líneas en 'start'.
+    # Devuelve None si el intervalo desaparece entero.
+    if delta > 0:
+        if first >= start:
+            first += delta
+        if last is not None and last >= start:
+            last += delta
+        return first, last
+    end = start - delta
+    if first >= end:
+        first += delta
+    elif first > start:
+        first = start
+    if last is not None:
+        if last >= end:
+            last += delta
+        elif last >= start:
+            last = start - 1
+        if last < first:
+            return None
+    return first, last
+
+def _contains(first, last, inner_first, inner_last):
+    # ¿Contiene [first, last] a [inner_first, inner_last]? (None = hasta el final)
+    return first <= inner_first and (last is None or (inner_last is not None and inner_last <= last))
+
+class SheetStyles:
+    """
+    Formato de una hoja: estilos por celda y tramos de estilo para filas,
+    columnas o rangos completos.
+
+    Un tramo (fila1, col1, fila2, col2, cambios) guarda un formato aplicado a
+    todo un rectángulo (fila2/col2 None = hasta el final) sin tocar sus celdas:
+    formatear una columna entera cuesta lo mismo con 10 filas que con un millón.
+    El estilo de una celda sin estilo propio es el resultado de aplicar, en
+    orden, los tramos que la cubren; una celda con estilo propio ya lo tiene
+    resuelto (al aplicar un tramo se actualizan las celdas propias que cubre).
+    """
+    def __init__(self):
+        self.table = StyleTable()
+        self.cells = {}  # columna -> {fila: número de estilo}
+        self.runs = []   # tramos en orden de aplicación
+        self._resolved = {}  # tramos que cubren una celda -> número de estilo
+
+    def clear(self):
+        self.cells = {}
+        self.runs = []
+        self._resolved = {}
+
+    def cell_count(self):
+        return sum(len(rows) for rows in self.cells.values())
+
+    def style_id(self, row, col):
+        """
+        Número del estilo efectivo de la celda.
+        """
+        rows = self.cells.get(col)
+        if rows:
+            sid = rows.get(row)
+            if sid is not None:
+                return sid
+        if not self.runs:
+            return 0
+        covering = tuple(i for i, (r1, c1, r2, c2, changes) in enumerate(self.runs)
+                         if r1 <= row and (r2 is None or row <= r2)
+                         and c1 <= col and (c2 is None or col <= c2))
+        sid = self._resolved.get(covering)
+        if sid is None:
+            sid = 0
+            for i in covering:
+                sid = self.table.changed(sid, self.runs[i][4])
+            self._resolved[covering] = sid
+        return sid
+
+    def style(self, row, col):
+        return self.table.styles[self.style_id(row, col)]
+
+    def _set_cell(self, row, col, sid):
+        if sid is None:
+            rows = self.cells.get(col)
+            if rows:
+                rows.pop(row, None)
+                if not rows:
+                    del self.cells[col]
+        else:
+            self.cells.setdefault(col, {})[row] = sid
+
+    def _own_cells(self, r1, c1, r2, c2):
+        # Celdas con estilo propio dentro del rectángulo
+        for col, rows in self.cells.items():
+            if col < c1 or (c2 is not None and col > c2):
+                continue
+            for row in rows:
+                if row >= r1 and (r2 is None or row <= r2):
+                    yield row, col
+
+    def state(self, cells):
+        """
+        Estado de los tramos y del estilo propio de las celdas dadas, para deshacer.
+        """
+        return {(row, col): self.cells.get(col, {}).get(row) for row, col in cells}, tuple(self.runs)
+
+    def restore(self, cells, runs):
+        """
+        Deja los tramos y las celdas dadas ({celda: número o None}) como en 'state'.
+        """
+        self.runs = list(runs)
+        self._resolved = {}
+        for (row, col), sid in cells.items():
+            self._set_cell(row, col, sid)
+
+    def apply(self, ranges, changes):
+        """
+        Aplica los cambios {campo: valor} a los rangos (fila1, col1, fila2, col2).
+        Los rangos pequeños se guardan celda a celda; los grandes, como un tramo.
+        Devuelve las celdas cuyo estilo propio ha cambiado.
+        """
+        changes = dict(changes)
+        touched = []
+        for r1, c1, r2, c2 in ranges:
+            if r2 is not None and c2 is not None and (r2 - r1 + 1) * (c2 - c1 + 1) < STYLE_RUN_MIN_CELLS:
+                cells = [(row, col) for row in range(r1, r2 + 1) for col in range(c1, c2 + 1)]
+                sids = [self.table.changed(self.style_id(row, col), changes) for row, col in cells]
+                for (row, col), sid in zip(cells, sids):
+                    self._set_cell(row, col, sid)
+            else:
+                cells = list(self._own_cells(r1, c1, r2, c2))
+                for row, col in cells:
+                    self._set_cell(row, col, self.table.changed(self.cells[col][row], changes))
+                # Los tramos anteriores que este tapa del todo ya no cuentan
+                self.runs = [run for run in self.runs
+                             if not (_contains(r1, r2, run[0], run[2]) and _contains(c1, c2, run[1], run[3])
+                                     and run[4].keys() <= changes.keys())]
+                self.runs.append((r1, c1, r2, c2, changes))
+                self._resolved = {}
+            touched.extend(cells)
+        return touched
+
+    def affected(self, ranges):
+        """
+        Celdas con estilo propio que cambiarían al aplicar un formato a los rangos.
+        """
+        cells = []
+        for r1, c1, r2, c2 in ranges:
+            if r2 is not None and c2 is not None and (r2 - r1 + 1) * (c2 - c1 + 1) < STYLE_RUN_MIN_CELLS:
+                cells.extend((row, col) for row in range(r1, r2 + 1) for col in range(c1, c2 + 1))
+            else:
+                cells.extend(self._own_cells(r1, c1, r2, c2))
+        return cells
+
+    def lines_state(self, axis, index, count):
+        """
+        Estado de las líneas que se van a eliminar, para deshacer.
+        """
+        end = index + count
+        if axis == 0:
+            return self.state(list(self._own_cells(index, 0, end - 1, None)))
+        return self.state(list(self._own_cells(0, index, None, end - 1)))
+
+    def shift(self, axis, start, delta):
+        """
+        Desplaza estilos y tramos al insertar (delta > 0) o eliminar (delta < 0)
+        filas (axis=0) o columnas (axis=1). Los tramos que contienen el punto
+        de inserción crecen.
+        """
+        cells = {}
+        for col, rows in self.cells.items():
+            for row, sid in rows.items():
+                pos = [row, col]
+                pos[axis] = move_index(pos[axis], start, delta)
+                if pos[axis] is not None:
+                    cells.setdefault(pos[1], {})[pos[0]] = sid
+        self.cells = cells
+        runs = []
+        for r1, c1, r2, c2, changes in self.runs:
+            if axis == 0:
+                span = _span_shift(r1, r2, start, delta)
+                if span:
+                    runs.append((span[0], c1, span[1], c2, changes))
+            else:
+                span = _span_shift(c1, c2, start, delta)
+                if span:
+                    runs.append((r1, span[0], r2, span[1], changes))
+        self.runs = runs
+        self._resolved = {}
+
+    def permute_rows(self, order, col_count):
+        """
+        Mueve los estilos con sus filas (orden[fila_nueva] = fila_antigua).
+        Los tramos que cubren todas las filas movidas no cambian; los que solo
+        cubren parte se convierten en estilos por celda dentro de esas filas.
+        Devuelve el estado anterior de lo convertido (ver state), o None.
+        """
+        order = np.asarray(order)
+        moved = np.flatnonzero(order != np.arange(len(order)))
+        if not len(moved):
+            return None
+        first, last = int(moved[0]), int(moved[-1])
+        runs = []
+        cells = []
+        for run in self.runs:
+            r1, c1, r2, c2, changes = run
+            inside = r1 <= first and (r2 is None or r2 >= last)
+            if inside or r1 > last or (r2 is not None and r2 < first):
+                runs.append(run)
+                continue
+            # El tramo corta las filas movidas: sus celdas pasan a estilo propio
+            lo, hi = max(r1, first), last if r2 is None else min(r2, last)
+            cells.extend((row, col) for col in range(c1, col_count if c2 is None else c2 + 1)
+                         for row in range(lo, hi + 1))
+            if r1 < lo:
+                runs.append((r1, c1, lo - 1, c2, changes))
+            if r2 is None or r2 > hi:
+                runs.append((hi + 1, c1, r2, c2, changes))
+        old = None
+        if cells:
+            old = self.state(cells)
+            sids = [self.style_id(row, col) for row, col in cells]
+            for (row, col), sid in zip(cells, sids):
+                self._set_cell(row, col, sid)
+        self.runs = runs
+        self._resolved = {}
+        new_row = {old: new for new, old in enumerate(order.tolist())}
+        self.cells = {col: {new_row.get(row, row): sid for row, sid in rows.items()}
+                      for col, rows in self.cells.items()}
+        return old
+
+# --- Reducción de series para gráficos ---
+class MinMaxDecimator:
+    """
+    Reduce una serie a dos puntos (mínimo y máximo) por grupo de filas, de
+    modo que el trazo conserva los picos aunque se dibujen pocos puntos.
+    Guarda el mínimo y el máximo de cada grupo para poder actualizar solo los
+    grupos afectados cuando cambian unas pocas celdas.
+    """
+    def __init__(self, y, buckets=2000):
+        self.y = np.asarray(y, dtype=float)
+        self.size = max(1, -(-len(self.y) // buckets))  # división hacia arriba
+        count = -(-len(self.y) // self.size)
+        self.lo = np.empty(count, dtype=np.intp)
+        self.hi = np.empty(count, dtype=np.intp)
+        self._recompute(0, count)
+
+    def _recompute(self, first, last):
+        """
+        Recalcula las posiciones del mínimo y el máximo de los grupos [first, last).
+        """
+        size = self.size
+        start, stop = first * size, min(last * size, len(self.y))
+        if stop <= start:
+            return
+        block = self.y[start:stop]
+        full = (stop - start) // size
+        if full:
+            groups = block[:full * size].reshape(full, size)
+            self._store(first, groups, start)
+        if full * size < len(block):
+            self._store(first + full, block[full * size:].reshape(1, -1), start + full * size)
+
+    def _store(self, first, groups, offset):
+        # Los grupos sin ningún número se marcan con su primera posición (NaN)
+        empty = np.isnan(groups).all(axis=1)
+        filled = np.where(np.isnan(groups), 0, groups)
+        lo = np.where(np.isnan(groups), np.inf, filled).argmin(axis=1)
+        hi = np.where(np.isnan(groups), -np.inf, filled).argmax(axis=1)
+        lo[empty] = hi[empty] = 0
+        base = offset + np.arange(len(groups)) * groups.shape[1]
+        self.lo[first:first + len(groups)] = base + lo
+        self.hi[first:first + len(groups)] = base + hi
+
+    def update(self, start, values):
+        """
+        Sustituye y[start:start + len(values)] y recalcula solo sus grupos.
+        """
+        values = np.asarray(values, dtype=float)
+        self.y[start:start + len(values)] = values
+        self._recompute(start // self.size, (start + len(values) - 1) // self.size + 1)
+
+    def points(self):
+        """
+        Devuelve (x, y) reducidos, en orden de x.
+        """
+        if self.size == 1:
+            idx = self.lo
+        else:
+            idx = np.sort(np.stack([self.lo, self.hi], axis=1), axis=1).ravel()
+        return idx, self.y[idx]
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: elige 'threshold' puntos de la serie que
+    conservan su forma visual. Los NaN se descartan antes de reducir.
+    Devuelve (x, y) reducidos.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keep = ~np.isnan(y)
+    x, y = x[keep], y[keep]
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return x, y
+    # Límites de los grupos interiores (el primer y el último punto se conservan)
+    edges = (np.arange(threshold - 1) * (n - 2) / (threshold - 2)).astype(np.intp) + 1
+    edges[-1] = n - 1
+    chosen = np.empty(threshold, dtype=np.intp)
+    chosen[0], chosen[-1] = 0, n - 1
+    # Punto medio de cada grupo, calculado de una vez; el del último es el punto final
+    counts = np.diff(np.append(edges, n))
+    avg_x = np.add.reduceat(x, edges) / counts
+    avg_y = np.add.reduceat(y, edges) / counts
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        xs, ys = x[start:stop], y[start:stop]
+        area = np.abs((x[a] - avg_x[i + 1]) * (ys - y[a]) - (x[a] - xs) * (avg_y[i + 1] - y[a]))
+        a = start + int(area.argmax())
+        chosen[i + 1] = a
+    return x[chosen], y[chosen]
+
+# --- Exportación de CSV ---
+def _column_block(sheet, col, r1, r2, formulas, text_rows, formula_rows):
+    """
+    Valores de las filas r1..r2-1 de una columna para escribirlos en CSV:
+    números como int/float y el resto como texto. 'text_rows' y
+    'formula_rows' son las filas ordenadas con texto o fórmula de la columna.
+    """
+    out = [''] * (r2 - r1)
+    column = sheet.numbers.columns.get(col)
+    if column is not None:
+        rows = np.flatnonzero(column[1][r1:r2])
+        for i, number in zip(rows.tolist(), column[0][r1:r2][rows].tolist()):
+            out[i] = int(number) if number.is_integer() and abs(number) < 1e16 else number
+    if text_rows:
+        texts = sheet.texts[col]
+        for row in text_rows[bisect_left(text_rows, r1):bisect_left(text_rows, r2)]:
+            out[row - r1] = texts[row]
+    if formula_rows:
+        for row in formula_rows[bisect_left(formula_rows, r1):bisect_left(formula_rows, r2)]:
+            if formulas:
+                out[row - r1] = sheet.formulas[(row, col)]
+            elif out[row - r1] == '':
+                out[row - r1] = str(sheet.values.get((row, col), ''))
+    return out
+
+def write_csv(sheet, path, delimiter=',', quoting=csv.QUOTE_MINIMAL, encoding='utf-8',
+              formulas=False, block_rows=20000):
+    """
+    Escribe el rango ocupado de la hoja en un CSV con un búfer grande.
+    Se escribe en un archivo temporal que sustituye al destino solo al
+    terminar. Es un generador que devuelve el progreso (0..1); si se cierra
+    antes de tiempo, el archivo temporal se descarta y el destino no cambia.
+    """
+    rows, cols = sheet.used_range()
+    path = os.path.abspath(path)
+    fd, tmp = tempfile.mkstemp(prefix='.pycalc-', suffix='.tmp', dir=os.path.dirname(path))
+    done = False
+    try:
+        with PROFILER.span('csv.exportar', archivo=os.path.basename(path)), \
+                open(fd, 'w', newline='', encoding=encoding, buffering=1 << 20) as f:
+            writer = csv.writer(f, delimiter=delimiter, quoting=quoting)
+            text_rows = {col: sorted(column) for col, column in sheet.texts.items() if column}
+            formula_rows = {}
+            for row, col in sheet.formulas:
+                formula_rows.setdefault(col, []).append(row)
+            for col_rows in formula_rows.values():
+                col_rows.sort()
+            for start in range(0, rows, block_rows):
+                end = min(start + block_rows, rows)
+                columns = [_column_block(sheet, col, start, end, formulas,
+                                         text_rows.get(col), formula_rows.get(col))
+                           for col in range(cols)]
+                writer.writerows(zip(*columns))
+                yield end / rows
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        else:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+        done = True
+    finally:
+        if not done:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+# --- Búsqueda ---
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]|()\\')
+
+# Cuantificador {m,n}, banderas en línea (?aiLmsux) o (?flags:...) y
+# argumentos de los escapes con letra (\x41, \u00e9, \N{...}, \12)
+_QUANTIFIER_RE = re.compile(r'\{\d*(?:,\d*)?\}')
+_INLINE_FLAGS_RE = re.compile(r'\(\?([aiLmsux]*(?:-[imsx]*)?)([:)])')
+_ESCAPE_ARG_RE = {'x': re.compile(r'[0-9a-fA-F]{0,2}'), 'u': re.compile(r'[0-9a-fA-F]{0,4}'),
+                  'U': re.compile(r'[0-9a-fA-F]{0,8}'), 'N': re.compile(r'(?:\{[^}]*\})?')}
+_ESCAPE_DIGITS_RE = re.compile(r'\d{0,2}')
+
+def _class_end(pattern, i):
+    """
+    Posición siguiente al ']' que cierra la clase de caracteres abierta en i.
+    """
+    i += 1
+    if i < len(pattern) and pattern[i] == '^':
+        i += 1
+    if i < len(pattern) and pattern[i] == ']':
+        i += 1  # un ']' al principio es literal
+    while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    return i + 1
+
+def _regex_literal(pattern):
+    """
+    Devuelve el trozo literal más largo que toda coincidencia de la expresión
+    regular debe contener ('' si no se puede asegurar ninguno). Solo se miran
+    los caracteres fuera de grupos; con alternativas '|' o en modo verboso
+    (?x) no se usa el índice.
+    """
+    if '|' in pattern:
+        return ''
+    runs, current, depth, i = [], [], 0, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        literal = None
+        if ch == '\\' and i + 1 < len(pattern):
+            nxt = pattern[i + 1]
+            i += 2
+            if not nxt.isalnum():
+                literal = nxt
+            elif nxt in _ESCAPE_ARG_RE:
+                i = _ESCAPE_ARG_RE[nxt].match(pattern, i).end()
+            elif nxt.isdigit():
+                i = _ESCAPE_DIGITS_RE.match(pattern, i).end()
+        elif ch == '[':
+            i = _class_end(pattern, i)
+        elif ch == '(':
+            flags = _INLINE_FLAGS_RE.match(pattern, i)
+            if flags and 'x' in flags.group(1).partition('-')[0]:
+                return ''  # los espacios y '#' dejan de ser literales
+            if flags and flags.group(2) == ')':
+                # (?i) no es un grupo ni corta el trozo literal
+                i = flags.end()
+                continue
+            depth += 1
+            i += 1
+        elif ch == ')':
+            depth -= 1
+            i += 1
+        elif ch == '{' and _QUANTIFIER_RE.match(pattern, i):
+            if current:
+                current.pop()  # el carácter anterior puede repetirse 0 veces
+            i = _QUANTIFIER_RE.match(pattern, i).end()
+        elif ch in _REGEX_SPECIAL:
+            if ch in '*?' and current:
+                current.pop()  # el carácter anterior es opcional
+            i += 1
+        else:
+            literal = ch
+            i += 1
+        if literal is not None and depth == 0:
+            current.append(literal)
+            continue
+        runs.append(''.join(current))
+        current = []
+    runs.append(''.join(current))
+    return max(runs, key=len)
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def _plain_number(text):
+    """
+    Indica si el texto es un número en forma canónica (se guarda solo en el
+    almacén numérico, sin texto).
+    """
+    if text[0] not in _NUMBER_START:
+        return False
+    number = parse_number(text)
+    return number is not None and format_number(number) == text
+
+_NUMBER_CHARS = frozenset('0123456789.-+e')
+
+class SearchIndex:
+    """
+    Índice de búsqueda de la hoja, construido la primera vez que se busca y
+    mantenido después al escribir cada celda:
+      - textos y fórmulas: texto en minúsculas -> celdas, más un índice de
+        trigramas sobre los textos distintos (muchas celdas repiten texto);
+      - números sin texto propio: se buscan vectorizados sobre su forma
+        canónica, generada por columna solo cuando hace falta.
+    """
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.exact = {}     # texto en minúsculas -> {celdas}
+        self.trigrams = {}  # trigrama -> {textos en minúsculas}
+        self.number_columns = {}  # columna -> (filas, textos) de los números
+
+    @classmethod
+    def build(cls, sheet):
+        index = cls(sheet)
+        for col, column in sheet.texts.items():
+            for row, text in column.items():
+                index._add_text((row, col), text)
+        for cell, formula in sheet.formulas.items():
+            index._add_text(cell, formula)
+        return index
+
+    def _add_text(self, cell, text):
+        lower = text.lower()
+        cells = self.exact.get(lower)
+        if cells is None:
+            cells = self.exact[lower] = set()
+            for tri in _trigrams(lower):
+                self.trigrams.setdefault(tri, set()).add(lower)
+        cells.add(cell)
+
+    def _remove_text(self, cell, text):
+        lower = text.lower()
+        cells = self.exact.get(lower)
+        if cells is None:
+            return
+        cells.discard(cell)
+        if not cells:
+            del self.exact[lower]
+            for tri in _trigrams(lower):
+                texts = self.trigrams.get(tri)
+                if texts is not None:
+                    texts.discard(lower)
+                    if not texts:
+                        del self.trigrams[tri]
+
+    def update(self, cell, old, new):
+        """
+        Actualiza el índice al cambiar el texto de una celda de 'old' a 'new'.
+        """
+        for text, change in ((old, self._remove_text), (new, self._add_text)):
+            if not text:
+                continue
+            if not text.startswith('=') and _plain_number(text):
+                self.number_columns.pop(cell[1], None)
+            else:
+                change(cell, text)
+
+    def _numbers(self, col):
+        """
+        Devuelve (filas, textos) de los números de una columna que no tienen
+        texto propio ni fórmula.
+        """
+        cached = self.number_columns.get(col)
+        if cached is None:
+            values, valid = self.sheet.numbers.columns[col]
+            valid = valid.copy()
+            skip = list(self.sheet.texts.get(col, ()))
+            skip += [row for row, c in self.sheet.formulas if c == col]
+            skip = np.array([row for row in skip if row < len(valid)], dtype=np.intp)
+            valid[skip] = False
+            rows = np.flatnonzero(valid)
+            texts = format_numbers(values[rows]).astype(str) if len(rows) else np.empty(0, dtype=str)
+            cached = self.number_columns[col] = (rows, texts)
+        return cached
+
+    def find(self, pattern, literal, case=False, whole=False, regex=False):
+        """
+        Devuelve las celdas cuyo texto coincide con el patrón compilado.
+        'literal' es un trozo que toda coincidencia contiene ('' si no se sabe).
+        """
+        lower = literal.lower()
+        check = pattern.search
+        if whole and not regex:
+            keys = [lower] if lower in self.exact else []
+        elif len(lower) >= 3:
+            postings = sorted((self.trigrams.get(tri, set()) for tri in _trigrams(lower)), key=len)
+            keys = postings[0].intersection(*postings[1:]) if postings[0] else ()
+        else:
+            keys = self.exact
+        found = []
+        for key in keys:
+            if not case:
+                # Sin distinguir mayúsculas basta con comprobar el texto en minúsculas
+                if check(key):
+                    found.extend(self.exact[key])
+                continue
+            for cell in self.exact[key]:
+                if check(self.sheet.text(*cell)):
+                    found.append(cell)
+        # Números: solo si la búsqueda puede coincidir con la forma de un número
+        if regex and not literal or set(lower) <= _NUMBER_CHARS:
+            for col in list(self.sheet.numbers.columns):
+                rows, texts = self._numbers(col)
+                if not len(rows):
+                    continue
+                if regex or whole:
+                    hits = [i for i, text in enumerate(texts.tolist()) if check(text)]
+                else:
+                    hits = np.flatnonzero(np.char.find(texts, literal if case else lower) >= 0)
+                found.extend((int(row), col) for row in rows[hits].tolist())
+        return found
+
+def search_pattern(text, regex=False, case=False, whole=False):
+    """
+    Compila el patrón de búsqueda con las opciones del diálogo.
+    Lanza re.error si la expresión regular no es válida.
+    """
+    pattern = text if regex else re.escape(text)
+    if whole:
+        pattern = f"\\A(?:{pattern})\\Z"
+    return re.compile(pattern, 0 if case else re.IGNORECASE)
+
+# --- Autoajuste de anchos ---
+# Textos más largos que se recuerdan por columna y números de muestra por bloque importado
+WIDTH_CANDIDATES = 8
+WIDTH_NUMBER_SAMPLE = 32
+
+class WidthCandidates:
+    """
+    Textos más largos (en caracteres) vistos en cada columna al importar y al
+    editar: candidatos a marcar el ancho de la columna al autoajustarla sin
+    recorrerla entera. Se guardan con su fila y se comprueban al usarlos; si
+    la celda ha cambiado, el candidato se descarta.
+    """
+    def __init__(self, size=WIDTH_CANDIDATES):
+        self.size = size
+        self.columns = {}  # columna -> [(longitud, fila, texto)], de más largo a más corto
+
+    def clear(self):
+        self.columns.clear()
+
+    def offer(self, col, row, text):
+        """
+        Propone el texto de una celda como candidato de su columna.
+        """
+        entries = self.columns.setdefault(col, [])
+        if len(entries) >= self.size and len(text) <= entries[-1][0]:
+            return
+        entries[:] = [entry for entry in entries if entry[1] != row]
+        entries.append((len(text), row, text))
+        entries.sort(reverse=True)
+        del entries[self.size:]
+
+    def offer_block(self, col, start, values, valid, texts):
+        """
+        Propone los textos más largos de un bloque de una columna y una
+        muestra de sus números (los extremos y unos cuantos repartidos).
+        """
+        for row, text in heapq.nlargest(self.size, texts.items(), key=lambda item: len(item[1])):
+            self.offer(col, start + row, text)
+        rows = np.flatnonzero(valid)
+        if not rows.size:
+            return
+        numbers = values[rows]
+        picks = {int(rows[np.argmax(numbers)]), int(rows[np.argmin(numbers)])}
+        picks.update(rows[::max(1, rows.size // WIDTH_NUMBER_SAMPLE)].tolist())
+        for row in picks:
+            if row not in texts:
+                self.offer(col, start + row, format_number(float(values[row])))
+
+    def candidates(self, sheet, col):
+        """
+        Candidatos [(fila, texto)] de la columna que siguen en la hoja.
+        """
+        entries = self.columns.get(col)
+        if not entries:
+            return []
+        entries[:] = [entry for entry in entries if sheet.display(entry[1], col) == entry[2]]
+        return [(row, text) for length, row, text in entries]
+
+    def shift(self, axis, start, delta):
+        """
+        Sigue a las celdas al insertar o eliminar filas (axis=0) o columnas (axis=1).
+        """
+        if axis == 1:
+            self.columns = {move_index(col, start, delta): entries for col, entries in self.columns.items()
+                            if move_index(col, start, delta) is not None}
+            return
+        for col, entries in self.columns.items():
+            entries[:] = [(length, move_index(row, start, delta), text) for length, row, text in entries
+                          if move_index(row, start, delta) is not None]
+
+    def permute_rows(self, new_row):
+        """
+        Sigue a las celdas al reordenar filas (new_row[fila_antigua] = fila_nueva).
+        """
+        limit = len(new_row)
+        for entries in self.columns.values():
+            entries[:] = [(length, int(new_row[row]) if row < limit else row, text)
+                          for length, row, text in entries]
+
+def longest_texts(sheet, col, count):
+    """
+    Los 'count' textos más largos que muestra una columna, recorriéndola
+    entera: [(fila, texto)]. Es la versión exacta de WidthCandidates; se
+    usa en segundo plano sobre una copia de la hoja.
+    """
+    found = [(row, text) for row, text in (sheet.texts.get(col) or {}).items()]
+    column = sheet.numbers.columns.get(col)
+    if column is not None:
+        values, valid = column
+        rows = np.flatnonzero(valid)
+        if rows.size:
+            # Se formatean todos de una vez; solo se conservan los más largos
+            lengths = np.fromiter(map(len, format_numbers(values[rows])), dtype=np.intp, count=rows.size)
+            best = np.argsort(lengths, kind='stable')[-count:]
+            found.extend((int(rows[i]), format_number(float(values[rows[i]]))) for i in best.tolist())
+    found.extend((row, str(value)) for (row, c), value in sheet.values.items() if c == col)
+    return heapq.nlargest(count, found, key=lambda item: len(item[1]))
+
+def line_counts(sheet):
+    """
+    Filas con algún texto de varias líneas: {fila: líneas}. Para el ajuste
+    exacto de los altos de fila.
+    """
+    lines = {}
+    texts = [(row, text) for column in sheet.texts.values() for row, text in column.items()]
+    texts.extend((row, value) for (row, col), value in sheet.values.items() if isinstance(value, str))
+    for row, text in texts:
+        if '\n' in text:
+            lines[row] = max(lines.get(row, 1), text.count('\n') + 1)
+    return lines
+
+# --- Ordenación ---
+_DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%d/%m/%Y %H:%M', '%d/%m/%Y')
+_DATE_EPOCH = datetime.datetime(1899, 12, 30)
+
+def parse_date(text):
+    """
+    Convierte una fecha de texto en número de serie (días desde 1899-12-30,
+    como las hojas de cálculo habituales), o None si no es una fecha.
+    """
+    if not text[:1].isdigit() or ('-' not in text and '/' not in text):
+        return None
+    for fmt in _DATE_FORMATS:
+        try:
+            delta = datetime.datetime.strptime(text.strip(), fmt) - _DATE_EPOCH
+        except ValueError:
+            continue
+        return delta.days + delta.seconds / 86400
+    return None
+
+def sort_key(sheet, col, rows, descending=False):
+    """
+    Clave de ordenación tipada de las primeras 'rows' filas de una columna:
+    devuelve (grupo, valor) para numpy.lexsort. Grupos: 0 números y fechas,
+    1 texto (según la colación del locale, sin distinguir mayúsculas),
+    2 errores y 3 vacías. Las vacías quedan al final en ambos sentidos.
+    """
+    group = np.full(rows, 3, dtype=np.int8)
+    value = np.zeros(rows)
+    column = sheet.numbers.columns.get(col)
+    if column is not None:
+        n = min(rows, len(column[1]))
+        numeric = column[1][:n]
+        group[:n][numeric] = 0
+        value[:n] = np.where(numeric, column[0][:n], 0)
+    texts = {}
+    for row, text in sheet.texts.get(col, {}).items():
+        if row < rows and group[row] != 0:
+            date = parse_date(text)
+            if date is None:
+                texts[row] = text
+            else:
+                group[row], value[row] = 0, date
+    for row, c in sheet.formulas:
+        if c == col and row < rows and group[row] != 0:
+            result = sheet.values.get((row, c), "")
+            if isinstance(result, str) and result.startswith('#'):
+                group[row] = 2
+            elif result != "":
+                texts[row] = str(result)
+    if texts:
+        distinct = sorted(set(texts.values()), key=lambda t: locale.strxfrm(t.casefold()))
+        rank = {text: i for i, text in enumerate(distinct)}
+        text_rows = np.fromiter(texts, dtype=np.intp, count=len(texts))
+        group[text_rows] = 1
+        value[text_rows] = np.fromiter((rank[t] for t in texts.values()), dtype=float, count=len(texts))
+    if descending:
+        filled = group < 3
+        group[filled] = 2 - group[filled]
+        value = -value
+    return group, value
+
+def sort_permutation(sheet, keys, start, stop):
+    """
+    Permutación estable de las filas [start, stop) según varias claves
+    [(columna, descendente)], la primera la principal. Devuelve orden[i] =
+    fila antigua (relativa a start) que pasa a la posición i.
+    """
+    arrays = []
+    for col, descending in reversed(keys):
+        group, value = sort_key(sheet, col, stop, descending)
+        arrays += [value[start:], group[start:]]
+    return np.lexsort(arrays)
+
+# --- Índices de búsqueda ---
+class LookupIndex:
+    """
+    Índice de una fila o columna de la hoja para BUSCARV, BUSCARH y
+    COINCIDIR: un diccionario valor -> primera posición para la coincidencia
+    exacta y arrays ordenados para la aproximada. Cada parte se construye la
+    primera vez que se usa; todas las fórmulas que buscan en el mismo rango
+    comparten el índice y la hoja lo descarta cuando cambia alguna de sus celdas.
+    """
+    def __init__(self, positions, numbers, text_positions, texts):
+        self.positions = positions        # posiciones (desde 0) con número
+        self.numbers = numbers
+        self.text_positions = text_positions
+        self.texts = [text.casefold() for text in texts]
+        self._exact = None
+        self._sorted_numbers = None
+        self._sorted_texts = None
+
+    def exact(self, key):
+        if self._exact is None:
+            # Recorridos al revés: ante valores repetidos gana la primera posición
+            exact = dict(zip(self.texts[::-1], self.text_positions[::-1]))
+            exact.update(zip(self.numbers[::-1].tolist(), self.positions[::-1].tolist()))
+            self._exact = exact
+        return self._exact.get(key)
+
+    def approximate(self, key, descending=False):
+        """
+        Posición del mayor valor <= clave o, con descending, del menor >= clave.
+        Los números solo se comparan con números y los textos con textos.
+        """
+        if isinstance(key, str):
+            if self._sorted_texts is None:
+                order = sorted(range(len(self.texts)), key=self.texts.__getitem__)
+                self._sorted_texts = ([self.texts[i] for i in order],
+                                      [self.text_positions[i] for i in order])
+            keys, positions = self._sorted_texts
+            i = bisect_left(keys, key) if descending else bisect_right(keys, key) - 1
+        else:
+            if self._sorted_numbers is None:
+                order = np.argsort(self.numbers, kind='stable')
+                self._sorted_numbers = (self.numbers[order], self.positions[order])
+            keys, positions = self._sorted_numbers
+            side = 'left' if descending else 'right'
+            i = int(np.searchsorted(keys, key, side)) - (0 if descending else 1)
+        if 0 <= i < len(keys):
+            return int(positions[i])
+        return None
+
+# --- Tablas dinámicas ---
+# Agrupación sobre los datos en columnas: cada columna clave se factoriza
+# (números con np.unique, textos con un diccionario), las claves se combinan
+# en un código por fila y los agregados de cada grupo se acumulan con
+# bincount. Se guarda el grupo y los valores de cada fila para que, tras
+# editar unas pocas filas, baste con moverlas de grupo y volver a sumar los
+# grupos afectados, sin factorizar de nuevo las claves.
+PIVOT_FUNCTIONS = ['SUMA', 'CONTAR', 'PROMEDIO', 'MIN', 'MAX']
+PIVOT_EMPTY = "(vacío)"
+# Por encima de estas filas editadas se reconstruye la tabla entera
+PIVOT_INCREMENTAL_ROWS = 20000
+
+def _pivot_order(key):
+    # Números, después textos (colación del locale) y al final las vacías
+    if key is None:
+        return (2, 0, "")
+    if isinstance(key, str):
+        return (1, 0, locale.strxfrm(key))
+    return (0, key, "")
+
+def _factorize(sheet, col, r1, r2, labels):
+    """
+    (códigos por fila, claves) de una columna entre r1 y r2. Los textos se
+    agrupan sin distinguir mayúsculas; 'labels' recibe cómo se muestran.
+    """
+    codes = np.full(r2 - r1 + 1, -1, dtype=np.int64)
+    keys = []
+    column = sheet.numbers.columns.get(col)
+    if column is not None:
+        valid = column[1][r1:r2 + 1]
+        rows = np.flatnonzero(valid)
+        unique, inverse = np.unique(column[0][r1:r2 + 1][rows], return_inverse=True)
+        codes[rows] = inverse
+        keys = unique.tolist()
+    index = {}
+    texts = sheet._texts_in(col, r1, r2)
+    for cell in sheet._formulas_in(r1, col, r2, col):
+        result = sheet.values.get(cell)
+        if isinstance(result, str) and result:
+            texts[cell[0]] = result
+    for row, text in texts.items():
+        i = row - r1
+        if codes[i] < 0:
+            key = text.casefold()
+            code = index.get(key)
+            if code is None:
+                code = index[key] = len(keys)
+                keys.append(key)
+                labels.setdefault(key, text)
+            codes[i] = code
+    empty = codes < 0
+    if empty.any():
+        codes[empty] = len(keys)
+        keys.append(None)
+    return codes, keys
+
+class PivotTable:
+    """
+    Tabla dinámica sobre un rango de la hoja: agrupa sus filas por una o
+    varias columnas (y opcionalmente por otra en columnas) y resume campos
+    con SUMA, CONTAR, PROMEDIO, MIN o MAX. Las columnas se dan como índices
+    absolutos de la hoja; con 'header' la primera fila del rango da los nombres.
+
+    rebuild() agrupa todo el rango (se puede llamar desde otro hilo sobre una
+    copia de la hoja: no toca las anotaciones de cambios); mark() anota las
+    filas editadas y update() aplica solo esas filas, o lo agrupa todo si
+    hace falta. table() devuelve el resultado como filas de texto.
+    """
+    def __init__(self, source, rows, column=None, values=(), header=True):
+        self.source = source      # (fila1, col1, fila2, col2)
+        self.rows = list(rows)    # columnas que agrupan en filas
+        self.column = column      # columna que agrupa en columnas, o None
+        self.values = list(values)  # [(columna, función)]
+        self.header = header
+        self.anchor = None        # (fila, columna) donde se escribe el resultado
+        self.written = (0, 0)     # alto y ancho del último resultado escrito
+        self.pending = True       # el origen ha cambiado desde la última actualización
+        self.dirty_rows = set()
+        self.stale = True         # hay que reconstruir la tabla entera
+        self.groups = {}          # tupla de claves -> número de grupo
+        self.keys = []            # número de grupo -> tupla de claves
+        self.labels = {}          # clave de texto -> texto mostrado
+        self.group_of = None      # grupo de cada fila de datos
+        self.data = None          # (valores, máscara) por campo: arrays campos x filas
+
+    @property
+    def key_columns(self):
+        return self.rows + ([self.column] if self.column is not None else [])
+
+    @property
+    def data_rows(self):
+        r1, _, r2, _ = self.source
+        return r1 + (1 if self.header else 0), r2
+
+    def field_names(self, sheet):
+        """
+        Nombre de cada columna del origen: su encabezado o su letra.
+        """
+        r1, c1, _, c2 = self.source
+        return {col: (sheet.display(r1, col) if self.header else "") or column_name(col)
+                for col in range(c1, c2 + 1)}
+
+    def mark(self, r1, c1, r2, c2):
+        """
+        Anota las filas de datos editadas dentro de (r1, c1)-(r2, c2).
+        Devuelve True si el rectángulo toca el origen.
+        """
+        s1, sc1, s2, sc2 = self.source
+        if r2 < s1 or r1 > s2 or c2 < sc1 or c1 > sc2:
+            return False
+        self.pending = True
+        first, last = self.data_rows
+        first, last = max(r1, first), min(r2, last)
+        if last - first + 1 + len(self.dirty_rows) > PIVOT_INCREMENTAL_ROWS:
+            self.stale = True
+        elif not self.stale and first <= last:
+            self.dirty_rows.update(range(first, last + 1))
+        return True
+
+    def mark_all(self):
+        self.pending = True
+        self.stale = True
+        self.dirty_rows.clear()
+
+    # --- Agrupación completa ---
+    @profiled('tabla dinámica.agrupar')
+    def rebuild(self, sheet):
+        """
+        Agrupa de nuevo todas las filas del origen.
+        """
+        first, last = self.data_rows
+        n = max(last - first + 1, 0)
+        labels = {}
+        combined = np.zeros(n, dtype=np.int64)
+        columns = []
+        for col in self.key_columns:
+            codes, keys = _factorize(sheet, col, first, last, labels)
+            if n and (int(combined.max()) + 1) * len(keys) >= 2 ** 62:
+                # Se renumera el código combinado antes de que se desborde
+                combined = np.unique(combined, return_inverse=True)[1].astype(np.int64)
+            combined = combined * len(keys) + codes
+            columns.append((codes, keys))
+        _, rows, group_of = np.unique(combined, return_index=True, return_inverse=True)
+        # Claves de cada grupo, leídas de su primera fila
+        keys = list(zip(*([keys[code] for code in codes[rows].tolist()] for codes, keys in columns)))
+        values = np.zeros((len(self.values), n))
+        valid = np.zeros((len(self.values), n), dtype=bool)
+        for v, (col, _) in enumerate(self.values):
+            column = sheet.numbers.columns.get(col)
+            if column is not None:
+                mask = column[1][first:last + 1]
+                valid[v, :len(mask)] = mask
+                values[v, :len(mask)] = np.where(mask, column[0][first:last + 1], 0.0)
+        self.data = (values, valid)
+        self.group_of = group_of.astype(np.intp, copy=False)
+        self.keys = keys
+        self.groups = {key: i for i, key in enumerate(keys)}
+        self.labels = labels
+        self._aggregate()
+
+    def _aggregate(self, groups=None):
+        """
+        Calcula los agregados de los grupos dados (None: de todos). Se suman
+        las filas en su orden, así que el resultado no depende de las
+        ediciones anteriores.
+        """
+        values, valid = self.data
+        count = len(self.keys)
+        fields = len(self.values)
+        if groups is None:
+            rows = slice(None)
+            self.sums = np.zeros((fields, count))
+            self.counts = np.zeros((fields, count), dtype=np.int64)
+            self.mins = np.full((fields, count), np.inf)
+            self.maxs = np.full((fields, count), -np.inf)
+        else:
+            groups = np.fromiter(groups, dtype=np.intp)
+            rows = np.isin(self.group_of, groups)
+            grow = count - len(self.size)
+            if grow:
+                self.size = np.append(self.size, np.zeros(grow, dtype=np.int64))
+                self.sums = np.hstack([self.sums, np.zeros((fields, grow))])
+                self.counts = np.hstack([self.counts, np.zeros((fields, grow), dtype=np.int64)])
+                self.mins = np.hstack([self.mins, np.zeros((fields, grow))])
+                self.maxs = np.hstack([self.maxs, np.zeros((fields, grow))])
+            self.mins[:, groups] = np.inf
+            self.maxs[:, groups] = -np.inf
+        group_of = self.group_of[rows]
+        size = np.bincount(group_of, minlength=count)
+        if groups is None:
+            self.size = size
+        else:
+            self.size[groups] = size[groups]
+        for v in range(fields):
+            ok = valid[v][rows]
+            numbers = values[v][rows]
+            sums = np.bincount(group_of, numbers, minlength=count)
+            counts = np.bincount(group_of, ok, minlength=count)
+            if groups is None:
+                self.sums[v], self.counts[v] = sums, counts
+            else:
+                self.sums[v, groups], self.counts[v, groups] = sums[groups], counts[groups]
+            np.minimum.at(self.mins[v], group_of[ok], numbers[ok])
+            np.maximum.at(self.maxs[v], group_of[ok], numbers[ok])
+
+    # --- Actualización incremental ---
+    @profiled('tabla dinámica.actualizar')
+    def update(self, sheet):
+        """
+        Aplica las filas anotadas con mark(): se mueven a su nuevo grupo y
+        solo se recalculan los grupos que cambian. Si hace falta, reconstruye todo.
+        """
+        self.pending = False
+        if self.stale or self.group_of is None:
+            self.stale = False
+            self.dirty_rows.clear()
+            self.rebuild(sheet)
+            return
+        first, _ = self.data_rows
+        values, valid = self.data
+        touched = set()
+        for row in self.dirty_rows:
+            i = row - first
+            key = []
+            for col in self.key_columns:
+                value = sheet.value_at(row, col)
+                if isinstance(value, str):
+                    self.labels.setdefault(value.casefold(), value)
+                    value = value.casefold()
+                key.append(value)
+            key = tuple(key)
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = len(self.keys)
+                self.keys.append(key)
+            touched.add(int(self.group_of[i]))
+            touched.add(group)
+            self.group_of[i] = group
+            for v, (col, _) in enumerate(self.values):
+                number = sheet.numbers.get(row, col)
+                valid[v, i] = number is not None
+                values[v, i] = number or 0.0
+        self.dirty_rows.clear()
+        if touched:
+            self._aggregate(touched)
+
+    # --- Resultado ---
+    def _label(self, key):
+        if key is None:
+            return PIVOT_EMPTY
+        if isinstance(key, str):
+            return self.labels.get(key, key)
+        return format_number(key)
+
+    def _cell(self, function, size, total, count, low, high):
+        total, low, high = float(total), float(low), float(high)
+        if not size:
+            return ""
+        if function == 'SUMA':
+            return format_number(total)
+        if function == 'CONTAR':
+            return str(int(count))
+        if not count:
+            return ""
+        if function == 'PROMEDIO':
+            return format_number(total / count)
+        return format_number(low if function == 'MIN' else high)
+
+    def table(self, sheet):
+        """
+        Resultado como lista de filas de texto: encabezado, una fila por
+        combinación de claves de fila y la fila 'Total general'.
+        """
+        names = self.field_names(sheet)
+        used = np.flatnonzero(self.size > 0)
+        depth = len(self.rows)
+        row_keys = sorted({self.keys[g][:depth] for g in used.tolist()},
+                          key=lambda key: tuple(map(_pivot_order, key)))
+        col_keys = [None]
+        if self.column is not None:
+            col_keys = sorted({self.keys[g][depth] for g in used.tolist()}, key=_pivot_order)
+        row_index = {key: i for i, key in enumerate(row_keys)}
+        col_index = {key: j for j, key in enumerate(col_keys)}
+        # Agregados por (fila, columna) con una fila y una columna más para los totales
+        shape = (len(row_keys) + 1, len(col_keys) + 1)
+        r = np.array([row_index[self.keys[g][:depth]] for g in used.tolist()], dtype=np.intp)
+        c = np.array([col_index[self.keys[g][depth] if self.column is not None else None]
+                      for g in used.tolist()], dtype=np.intp)
+        size = np.zeros(shape, dtype=np.int64)
+        np.add.at(size, (r, c), self.size[used])
+        size[-1, :-1] = size[:-1, :-1].sum(axis=0)
+        size[:, -1] = size[:, :-1].sum(axis=1)
+        cells = []
+        for v in range(len(self.values)):
+            sums, counts = np.zeros(shape), np.zeros(shape, dtype=np.int64)
+            mins, maxs = np.full(shape, np.inf), np.full(shape, -np.inf)
+            np.add.at(sums, (r, c), self.sums[v, used])
+            np.add.at(counts, (r, c), self.counts[v, used])
+            np.minimum.at(mins, (r, c), self.mins[v, used])
+            np.maximum.at(maxs, (r, c), self.maxs[v, used])
+            for array, reduce in ((sums, np.sum), (counts, np.sum), (mins, np.min), (maxs, np.max)):
+                array[-1, :-1] = reduce(array[:-1, :-1], axis=0)
+                array[:, -1] = reduce(array[:, :-1], axis=1)
+            cells.append((sums, counts, mins, maxs))
+        # Encabezado
+        header = [names[col] for col in self.rows]
+        titles = [f"{function} de {names[col]}" for col, function in self.values]
+        columns = []
+        for j, key in enumerate(col_keys):
+            if self.column is not None:
+                label = self._label(key)
+                columns += [(j, v, label if len(titles) == 1 else f"{label} - {title}")
+                            for v, title in enumerate(titles)]
+        columns += [(len(col_keys), v, title if self.column is None else
+                     ("Total" if len(titles) == 1 else f"Total {title}"))
+                    for v, title in enumerate(titles)]
+        rows = [header + [title for _, _, title in columns]]
+        labels = [[self._label(k) for k in key] for key in row_keys] + [["Total general"] + [""] * (depth - 1)]
+        for i, label in enumerate(labels):
+            rows.append(label + [self._cell(self.values[v][1], size[i, j], *(a[i, j] for a in cells[v]))
+                                 for j, v, _ in columns])
+        return rows
+
+    def updates(self, sheet):
+        """
+        Celdas (fila, columna, texto) que hay que escribir para mostrar el
+        resultado en 'anchor', incluidas las que quedan vacías respecto a la
+        última vez. Solo se devuelven las que cambian.
+        """
+        rows = self.table(sheet)
+        top, left = self.anchor
+        height, width = len(rows), max(map(len, rows))
+        old_height, old_width = self.written
+        updates = []
+        for i in range(max(height, old_height)):
+            line = rows[i] if i < height else ()
+            for j in range(max(width, old_width)):
+                text = line[j] if j < len(line) else ""
+                if sheet.text(top + i, left + j) != text:
+                    updates.append((top + i, left + j, text))
+        self.written = (height, width)
+        return updates
+
+class Sheet:
+    """
+    Hoja de cálculo sin dependencias de Qt: texto de las celdas, fórmulas,
+    valores numéricos en columnas y recálculo incremental.
+    Los números se guardan solo en el almacén columnar; el texto se guarda
+    aparte únicamente cuando no coincide con la forma canónica del número.
+    """
+    def __init__(self, rows=100, cols=80):
+        self.row_count = rows
+        self.col_count = cols
+        self.texts = {}      # columna -> {fila: texto}
+        self.formulas = {}   # (fila, columna) -> texto de la fórmula con '='
+        self.compiled = {}   # (fila, columna) -> CompiledFormula (compartida entre fórmulas copiadas)
+        self.values = {}     # (fila, columna) -> último resultado de la fórmula
+        # columna -> filas cuyas fórmulas han dado un error; puede tener filas
+        # que ya no lo son (se comprueba en 'values' al consultarlo)
+        self.errors = {}
+        self.numbers = NumericStore()
+        self._graph = DependencyGraph()
+        # Al abrir un libro .pycalc el grafo se construye la primera vez que se usa
+        self.graph_pending = False
+        self.column_kinds = {}  # columna -> [números, textos] vistos al importar
+        self.search_index = None  # SearchIndex, se construye al buscar por primera vez
+        self.widths = WidthCandidates()  # textos más largos por columna, para autoajustar
+        self.lookups = {}  # (fila1, col1, fila2, col2) -> LookupIndex de BUSCARV/COINCIDIR
+        # Rangos, máscaras y totales de los agregados condicionales; solo
+        # existe durante un recálculo, en el que los rangos no cambian
+        self.criteria_cache = None
+        self.source = None  # WorkbookFile .pycalc del que se cargó (los textos se leen al consultarlos)
+        # Recálculo en paralelo de los conjuntos grandes de fórmulas independientes
+        self.parallel = True
+        self.workers = None
+        # Con deferred, recalculate() no evalúa: deja las celdas en 'pending'
+        # para que las calcule un Recalculation (la interfaz, en otro hilo)
+        self.deferred = False
+        self.pending = set()
+        self.changed = set()  # celdas editadas cuyas dependientes aún no están en 'pending'
+
+    def clear(self):
+        """
+        Vacía la hoja por completo.
+        """
+        self.texts = {}
+        self.source = None
+        self.formulas.clear()
+        self.compiled.clear()
+        self.values.clear()
+        self.errors.clear()
+        self.numbers.clear()
+        self.graph_pending = False
+        self.graph.clear()
+        self.column_kinds.clear()
+        self.search_index = None
+        self.lookups.clear()
+        self.widths.clear()
+        self.pending.clear()
+        self.changed.clear()
+
+    @property
+    def graph(self):
+        """
+        Grafo de dependencias de las fórmulas. Si la hoja se acaba de abrir
+        de un libro .pycalc, se construye aquí desde las fórmulas compiladas.
+        """
+        if self.graph_pending:
+            self.graph_pending = False
+            self._graph.build(self.compiled.items())
+        return self._graph
+
+    def column_kind(self, col):
+        """
+        Tipo inferido de una columna al importar: 'número', 'texto', 'mixto' o 'vacía'.
+        """
+        numbers, texts = self.column_kinds.get(col, (0, 0))
+        if numbers and texts:
+            return 'mixto'
+        return 'número' if numbers else 'texto' if texts else 'vacía'
+
+    # --- Lectura de celdas ---
+    def text(self, row, col):
+        """
+        Devuelve el texto introducido en la celda (la fórmula, si la tiene).
+        """
+        formula = self.formulas.get((row, col))
+        if formula is not None:
+            return formula
+        column = self.texts.get(col)
+        if column:
+            text = column.get(row)
+            if text is not None:
+                return text
+        number = self.numbers.get(row, col)
+        return "" if number is None else format_number(number)
+
+    def display(self, row, col):
+        """
+        Devuelve el texto que se muestra en la celda (el resultado, si es una fórmula).
+        """
+        if (row, col) in self.formulas:
+            return str(self.values.get((row, col), ""))
+        return self.text(row, col)
+
+    def get_cell_value(self, row, col):
+        """
+        Devuelve el valor de una celda. Las fórmulas devuelven su último resultado
+        calculado, sin volver a evaluarse.
+        """
+        if (row, col) in self.formulas:
+            return self.values.get((row, col), "")
+        return self.text(row, col)
+
+    def value_at(self, row, col):
+        """
+        Valor de una celda para las búsquedas: número, texto o None si está vacía.
+        """
+        number = self.numbers.get(row, col)
+        if number is not None:
+            return number
+        if (row, col) in self.formulas:
+            result = self.values.get((row, col))
+            return None if result == "" else result
+        column = self.texts.get(col)
+        return column.get(row) if column else None
+
+    def lookup_index(self, r1, c1, r2, c2):
+        """
+        Índice de búsqueda de una fila o columna; se construye una vez y lo
+        comparten todas las fórmulas que buscan en el mismo rango.
+        """
+        key = (r1, c1, r2, c2)
+        index = self.lookups.get(key)
+        if PROFILER.enabled:
+            PROFILER.count('índice de búsqueda.acierto' if index is not None else 'índice de búsqueda.fallo')
+        if index is None:
+            index = self.lookups[key] = self._build_lookup(r1, c1, r2, c2)
+        return index
+
+    def _build_lookup(self, r1, c1, r2, c2):
+        if c1 != c2:
+            # Una fila: se recorre celda a celda
+            positions, numbers, text_positions, texts = [], [], [], []
+            for j, col in enumerate(range(c1, c2 + 1)):
+                value = self.value_at(r1, col)
+                if isinstance(value, str):
+                    text_positions.append(j)
+                    texts.append(value)
+                elif value is not None:
+                    positions.append(j)
+                    numbers.append(value)
+            return LookupIndex(np.array(positions, dtype=np.intp), np.array(numbers, dtype=np.float64),
+                               text_positions, texts)
+        positions, numbers = np.empty(0, dtype=np.intp), np.empty(0)
+        column = self.numbers.columns.get(c1)
+        if column is not None:
+            positions = np.flatnonzero(column[1][r1:r2 + 1])
+            numbers = column[0][r1:r2 + 1][positions]
+        texts = {row: text for row, text in self._texts_in(c1, r1, r2).items()
+                 if self.numbers.get(row, c1) is None}
+        for cell in self._formulas_in(r1, c1, r2, c1):
+            result = self.values.get(cell)
+            if isinstance(result, str) and result and self.numbers.get(*cell) is None:
+                texts[cell[0]] = result
+        rows = sorted(texts)
+        return LookupIndex(positions, numbers, [row - r1 for row in rows], [texts[row] for row in rows])
+
+    def _cached(self, key, build):
+        cache = self.criteria_cache
+        if cache is None:
+            return build()
+        value = cache.get(key)
+        if PROFILER.enabled:
+            PROFILER.count('criterios.acierto' if value is not None else 'criterios.fallo')
+        if value is None:
+            value = cache[key] = build()
+        return value
+
+    def criteria_data(self, r1, c1, r2, c2):
+        """
+        Contenido tipado de un rango para los agregados condicionales:
+        (valores, máscara numérica, posiciones de los textos en el rango
+        aplanado, textos en minúsculas). Se construye una vez por recálculo.
+        """
+        return self._cached(('data', r1, c1, r2, c2), lambda: self._criteria_data(r1, c1, r2, c2))
+
+    def _criteria_data(self, r1, c1, r2, c2):
+        height, width = r2 - r1 + 1, c2 - c1 + 1
+        values = np.zeros((height, width))
+        valid = np.zeros((height, width), dtype=bool)
+        text_index, texts = [], []
+        for j, col in enumerate(range(c1, c2 + 1)):
+            column = self.numbers.columns.get(col)
+            if column is not None:
+                part = column[0][r1:r2 + 1]
+                values[:len(part), j] = part
+                valid[:len(part), j] = column[1][r1:r2 + 1]
+            for row, text in self._texts_in(col, r1, r2).items():
+                if not valid[row - r1, j]:
+                    text_index.append((row - r1) * width + j)
+                    texts.append(text.casefold())
+        for row, col in self._formulas_in(r1, c1, r2, c2):
+            result = self.values.get((row, col))
+            if isinstance(result, str) and result and not valid[row - r1, col - c1]:
+                text_index.append((row - r1) * width + col - c1)
+                texts.append(result.casefold())
+        return values, valid, np.array(text_index, dtype=np.intp), texts
+
+    def criterion_mask(self, bounds, criterion):
+        """
+        Máscara de las celdas del rango que cumplen el criterio; las fórmulas
+        que repiten criterio y rango comparten la máscara durante el recálculo.
+        """
+        key = ('mask', bounds, criterion if isinstance(criterion, str) else float(criterion))
+        return self._cached(key, lambda: criterion_mask(self.criteria_data(*bounds), criterion))
+
+    def criterion_totals(self, bounds, criterion, target):
+        """
+        (suma, números sumados, celdas que cumplen) de SUMAR.SI y compañía:
+        suma los números de 'target' donde 'bounds' cumple el criterio.
+        Igualdades y comparaciones numéricas se responden con totales por
+        valor y sumas acumuladas del rango ordenado, calculados una vez por
+        recálculo; el resto, con la máscara del criterio.
+        """
+        op, kind, operand = parse_criterion(criterion)
+        if kind in ('num', 'text') and op in ('=', '<>'):
+            groups, everything = self._cached(('groups', bounds, target),
+                                              lambda: self._criteria_groups(bounds, target))
+            found = groups.get(operand, (0.0, 0, 0))
+            if op == '=':
+                return found
+            return tuple(a - b for a, b in zip(everything, found))
+        if kind == 'num':
+            keys, sums, numbers = self._cached(('sorted', bounds, target),
+                                               lambda: self._criteria_sorted(bounds, target))
+            if op in ('<', '<='):
+                lo, hi = 0, int(np.searchsorted(keys, operand, 'left' if op == '<' else 'right'))
+            else:
+                lo, hi = int(np.searchsorted(keys, operand, 'right' if op == '>' else 'left')), len(keys)
+            return float(sums[hi] - sums[lo]), int(numbers[hi] - numbers[lo]), hi - lo
+        key = ('totals', bounds, criterion, target)
+        return self._cached(key, lambda: self._masked_totals(self.criterion_mask(bounds, criterion), target))
+
+    def criteria_set_totals(self, conditions, target):
+        """
+        (suma, números sumados, celdas) de las funciones .CONJUNTO: las
+        celdas que cumplen todas las condiciones ((rango, criterio), ...).
+        El resultado se comparte entre las fórmulas con las mismas condiciones.
+        """
+        def build():
+            mask = None
+            for bounds, criterion in conditions:
+                part = self.criterion_mask(bounds, criterion)
+                mask = part if mask is None else mask & part
+            if target is None:
+                return 0.0, 0, int(np.count_nonzero(mask))
+            return self._masked_totals(mask, target)
+        key = ('set', tuple((bounds, c if isinstance(c, str) else float(c)) for bounds, c in conditions), target)
+        return self._cached(key, build)
+
+    def _masked_totals(self, mask, target):
+        values, valid = self.criteria_data(*target)[:2]
+        selected = mask & valid
+        return float(values[selected].sum()), int(np.count_nonzero(selected)), int(np.count_nonzero(mask))
+
+    def _criteria_weights(self, target):
+        values, valid = self.criteria_data(*target)[:2]
+        return np.where(valid, values, 0.0).ravel(), valid.ravel()
+
+    def _criteria_groups(self, bounds, target):
+        # {valor: (suma, números sumados, celdas)} de cada valor distinto del
+        # rango, y los mismos totales para todo el rango
+        values, valid, text_index, texts = self.criteria_data(*bounds)
+        weights, counted = self._criteria_weights(target)
+        flat = valid.ravel()
+        groups = {}
+        keys = values.ravel()[flat]
+        if keys.size:
+            unique, inverse = np.unique(keys, return_inverse=True)
+            sums = np.bincount(inverse, weights=weights[flat], minlength=len(unique))
+            numbers = np.bincount(inverse, weights=counted[flat], minlength=len(unique)).astype(np.int64)
+            cells = np.bincount(inverse, minlength=len(unique))
+            groups = dict(zip(unique.tolist(), zip(sums.tolist(), numbers.tolist(), cells.tolist())))
+        for text, weight, number in zip(texts, weights[text_index].tolist(), counted[text_index].tolist()):
+            total, n, cells = groups.get(text, (0.0, 0, 0))
+            groups[text] = (total + weight, n + number, cells + 1)
+        return groups, (float(weights.sum()), int(np.count_nonzero(counted)), values.size)
+
+    def _criteria_sorted(self, bounds, target):
+        # Números del rango ordenados con las sumas acumuladas del rango de suma
+        values, valid = self.criteria_data(*bounds)[:2]
+        weights, counted = self._criteria_weights(target)
+        flat = valid.ravel()
+        keys = values.ravel()[flat]
+        order = np.argsort(keys, kind='stable')
+        sums = np.concatenate(([0.0], np.cumsum(weights[flat][order])))
+        numbers = np.concatenate(([0], np.cumsum(counted[flat][order])))
+        return keys[order], sums, numbers
+
+    def _invalidate_lookups(self, row, col):
+        # Descarta los índices de búsqueda que contienen la celda
+        stale = [key for key in self.lookups if key[0] <= row <= key[2] and key[1] <= col <= key[3]]
+        for key in stale:
+            del self.lookups[key]
+
+    def number_at(self, row, col):
+        """
+        Devuelve el valor numérico de la celda (fila, columna), o 0 si no es
+        un número. Si es una fórmula con resultado de error, lo lanza
+        (CellError) para que llegue a las fórmulas que la leen.
+        """
+        value = self.numbers.get(row, col)
+        if value is None:
+            result = self.values.get((row, col))
+            if _is_error(result):
+                raise CellError(result)
+            return 0
+        return value
+
+    def range_array(self, r1, c1, r2, c2):
+        """
+        Devuelve los valores numéricos de un rango como array de NumPy.
+        """
+        return self.numbers.range_array(r1, c1, r2, c2)
+
+    def range_values(self, r1, c1, r2, c2):
+        """
+        Como range_array, para los agregados de las fórmulas: si alguna
+        fórmula del rango tiene un resultado de error, lo lanza (CellError).
+        """
+        self._check_errors(r1, c1, r2, c2)
+        return self.numbers.range_array(r1, c1, r2, c2)
+
+    def _note_error(self, row, col, result):
+        # Apunta en el índice de errores un resultado de error
+        if _is_error(result):
+            self.errors.setdefault(col, set()).add(row)
+
+    def _check_errors(self, r1, c1, r2, c2):
+        # Lanza el primer error de las fórmulas del rango; las filas que ya
+        # no tienen error se quitan del índice
+        for col in [col for col in self.errors if c1 <= col <= c2]:
+            rows = self.errors[col]
+            for row in [row for row in rows if r1 <= row <= r2]:
+                result = self.values.get((row, col))
+                if _is_error(result):
+                    raise CellError(result)
+                rows.discard(row)
+            if not rows:
+                del self.errors[col]
+
+    def reads_error(self, cell):
+        """
+        Indica si la fórmula de la celda lee alguna celda con resultado de error.
+        """
+        if not self.errors:
+            return False
+        cells, ranges = self.graph.precedents.get(cell, ((), ()))
+        try:
+            for row, col in cells:
+                self.number_at(row, col)
+            for bounds in ranges:
+                self._check_errors(*bounds)
+        except CellError:
+            return True
+        return False
+
+    def range_numbers(self, r1, c1, r2, c2):
+        """
+        Devuelve los valores numéricos de un rango ya resuelto, ignorando textos y vacíos.
+        """
+        return self.range_array(r1, c1, r2, c2).tolist()
+
+    def cell_to_pos(self, ref):
+        """
+        Convierte una referencia de celda tipo 'A1' en coordenadas (fila, columna).
+        """
+        return ref_to_pos(ref.strip())
+
+    def parse_range(self, rng):
+        """
+        Convierte un rango tipo 'A1:B5' (o una celda) en (fila1, col1, fila2, col2)
+        ordenados. Devuelve None si la referencia no es válida.
+        """
+        start, _, end = rng.partition(':')
+        first = self.cell_to_pos(start)
+        last = self.cell_to_pos(end) if end else first
+        if first is None or last is None:
+            return None
+        (r1, c1), (r2, c2) = first, last
+        return min(r1, r2), min(c1, c2), max(r1, r2), max(c1, c2)
+
+    def get_range_values(self, rng):
+        """
+        Devuelve una lista de valores numéricos de un rango (ejemplo: 'A1:A5').
+        """
+        if ':' in rng:
+            return self.range_numbers(*self.parse_range(rng))
+        else:
+            r, c = self.cell_to_pos(rng)
+            return [self.number_at(r, c)]
+
+    def range_matrix(self, r1, c1, r2, c2):
+        """
+        Devuelve el rango como array (filas x columnas) de float, con NaN en
+        las celdas sin número. Las columnas vacías no se materializan.
+        """
+        matrix = np.full((r2 - r1 + 1, c2 - c1 + 1), np.nan)
+        for j, col in enumerate(range(c1, c2 + 1)):
+            column = self.numbers.columns.get(col)
+            if column is not None:
+                values, valid = column[0][r1:r2 + 1], column[1][r1:r2 + 1]
+                matrix[:len(values), j] = np.where(valid, values, np.nan)
+        return matrix
+
+    def selection_stats(self, ranges):
+        """
+        Devuelve (recuento, suma, mínimo, máximo) de los números de varios
+        rangos (fila1, col1, fila2, col2), o None si no hay ninguno.
+        """
+        count, total, low, high = 0, 0.0, math.inf, -math.inf
+        for rng in ranges:
+            n, part, part_low, part_high = self.numbers.range_stats(*rng)
+            if n:
+                count += n
+                total += part
+                low = min(low, part_low)
+                high = max(high, part_high)
+        return (count, total, low, high) if count else None
+
+    def get_single_value(self, ref):
+        """
+        Devuelve el valor numérico de una celda referenciada.
+        """
+        pos = self.cell_to_pos(ref)
+        if pos:
+            return self.number_at(*pos)
+        return 0
+
+    def evaluate_formula_direct(self, formula):
+        """
+        Evalúa una fórmula (SUMA, PROMEDIO, RAIZ, operaciones con precedencia y referencias)
+        usando su forma compilada.
+        """
+        return compile_formula(formula).evaluate(self, 0, 0)
+
+    def snapshot(self):
+        """
+        Copia del contenido de la hoja (sin grafo) para leerla desde otro hilo
+        mientras se sigue editando el original.
+        """
+        copy = Sheet(self.row_count, self.col_count)
+        copy.texts = {col: dict(column) for col, column in self.texts.items()}
+        copy.formulas = dict(self.formulas.items())
+        copy.values = dict(self.values)
+        copy.errors = {col: set(rows) for col, rows in self.errors.items()}
+        copy.numbers.columns = {col: (values.copy(), valid.copy())
+                                for col, (values, valid) in self.numbers.columns.items()}
+        return copy
+
+    def used_range(self):
+        """
+        Devuelve (filas, columnas) del rango ocupado, contando desde A1. Como
+        range_stats, admite un Recalculation en marcha en otro hilo.
+        """
+        rows = cols = 0
+        for col, (values, valid) in list(self.numbers.columns.items()):
+            used = np.flatnonzero(valid)
+            if used.size:
+                rows = max(rows, int(used[-1]) + 1)
+                cols = max(cols, col + 1)
+        for col, column in self.texts.items():
+            if column:
+                rows = max(rows, max(column) + 1)
+                cols = max(cols, col + 1)
+        for row, col in self.formulas:
+            rows = max(rows, row + 1)
+            cols = max(cols, col + 1)
+        return rows, cols
+
+    def cells_in_range(self, r1, c1, r2, c2):
+        """
+        Devuelve las celdas no vacías de un rango, ordenadas por filas.
+        """
+        cells = set()
+        for col in range(c1, c2 + 1):
+            cells.update((row, col) for row in self.numbers.occupied_rows(col, r1, r2).tolist())
+            column = self.texts.get(col)
+            if column:
+                cells.update((row, col) for row in column if r1 <= row <= r2)
+        cells.update(cell for cell in self.formulas if r1 <= cell[0] <= r2 and c1 <= cell[1] <= c2)
+        return sorted(cells)
+
+    # --- Escritura y recálculo ---
+    @profiled('buscar')
+    def find(self, text, regex=False, case=False, whole=False):
+        """
+        Devuelve las celdas cuyo texto coincide con la búsqueda, ordenadas por
+        filas. Solo se comprueban las celdas candidatas del índice de trigramas.
+        """
+        if not text:
+            return []
+        pattern = search_pattern(text, regex, case, whole)
+        if PROFILER.enabled:
+            PROFILER.count('índice de texto.acierto' if self.search_index is not None else 'índice de texto.fallo')
+        if self.search_index is None:
+            self.search_index = SearchIndex.build(self)
+        literal = _regex_literal(text) if regex else text
+        return sorted(self.search_index.find(pattern, literal, case, whole, regex))
+
+    @profiled('reemplazar')
+    def replacements(self, text, replacement, regex=False, case=False, whole=False, cells=None):
+        """
+        Calcula los cambios (fila, columna, texto_nuevo) de un reemplazo, en
+        las celdas dadas o en todas las que coinciden. No modifica la hoja:
+        se aplican de una vez con set_cells.
+        """
+        pattern = search_pattern(text, regex, case, whole)
+        if not regex:
+            replacement = replacement.replace('\\', '\\\\')
+        if cells is None:
+            cells = self.find(text, regex, case, whole)
+        updates = []
+        for row, col in cells:
+            old = self.text(row, col)
+            new = pattern.sub(replacement, old, count=1 if whole else 0)
+            if new != old:
+                updates.append((row, col, new))
+        return updates
+
+    def _register(self, cell, formula):
+        """
+        Compila la fórmula de una celda y actualiza sus precedentes en el grafo.
+        """
+        compiled = self.compiled[cell] = compile_formula(formula[1:], *cell)
+        cells, ranges = compiled.references(*cell)
+        self.graph.set_precedents(cell, cells, ranges)
+
+    def _store(self, row, col, text):
+        """
+        Guarda el texto de una celda y actualiza el grafo, sin recalcular.
+        """
+        cell = (row, col)
+        text = "" if text is None else str(text)
+        if self.lookups:
+            self._invalidate_lookups(row, col)
+        if self.search_index is not None:
+            self.search_index.update(cell, self.text(row, col), text)
+        column = self.texts.get(col)
+        if text.startswith("="):
+            self.formulas[cell] = text
+            self._register(cell, text)
+            if column:
+                column.pop(row, None)
+            return
+        if self.formulas.pop(cell, None) is not None:
+            del self.compiled[cell]
+            self.graph.remove(cell)
+            self.values.pop(cell, None)
+        number = parse_number(text)
+        self.numbers.set(row, col, number)
+        if text and (number is None or format_number(number) != text):
+            self.texts.setdefault(col, {})[row] = text
+        elif column:
+            column.pop(row, None)
+        if text:
+            self.widths.offer(col, row, text)
+
+    def set_cell(self, row, col, text):
+        """
+        Escribe una celda y recalcula solo las celdas que dependen de ella.
+        """
+        return self.set_cells([(row, col, text)])
+
+    def set_cells(self, updates):
+        """
+        Escribe varias celdas (fila, columna, texto) y recalcula una sola vez.
+        Devuelve las celdas cuyo valor mostrado puede haber cambiado.
+        """
+        edited = []
+        dirty = set()
+        for row, col, text in updates:
+            self._store(row, col, text)
+            edited.append((row, col))
+            if (row, col) in self.formulas:
+                dirty.add((row, col))
+        if self.deferred:
+            # Buscar las dependientes puede llevar un rato: lo hace el Recalculation
+            self.changed.update(edited)
+        else:
+            dirty |= self.graph.affected(edited)
+        return edited + self.recalculate(dirty)
+
+    @profiled('recalcular')
+    def recalculate(self, dirty):
+        """
+        Evalúa las celdas sucias en orden topológico. Las celdas en un ciclo
+        reciben el error #CICLO. Devuelve las celdas recalculadas. En una
+        hoja diferida solo se añaden a las pendientes (ver Recalculation).
+        """
+        if self.deferred:
+            self.pending |= dirty
+            return list(dirty)
+        levels, cyclic = self.graph.topological_levels(dirty)
+        self.criteria_cache = {}
+        try:
+            if self.parallel and len(dirty) >= PARALLEL_MIN_CELLS and (self.workers or os.cpu_count() or 1) > 1:
+                ParallelRecalculator(self, self.workers).run(levels)
+            else:
+                evaluate = self._profile_cell if PROFILER.enabled else self.evaluate_cell
+                for level in levels:
+                    for row, col in level:
+                        self._set_result(row, col, evaluate(row, col))
+        finally:
+            self.criteria_cache = None
+        for row, col in cyclic:
+            self._set_result(row, col, "#CICLO")
+        return [cell for level in levels for cell in level] + cyclic
+
+    def _set_result(self, row, col, result):
+        # Guarda el resultado de una fórmula (y su número, si lo es)
+        if self.lookups and self.values.get((row, col)) != result:
+            self._invalidate_lookups(row, col)
+        self.values[(row, col)] = result
+        self._note_error(row, col, result)
+        self.numbers.set(row, col, parse_number(result))
+
+    def evaluate_cell(self, row, col):
+        """
+        Evalúa la fórmula de una celda; los errores se devuelven como texto
+        #ERROR, las referencias a celdas eliminadas como #REF! y los errores
+        de las celdas que lee, tal cual.
+        """
+        try:
+            return self.compiled[(row, col)].evaluate(self, row, col)
+        except CellError as e:
+            return str(e)
+        except Exception as e:
+            return f"#ERROR: {e}"
+
+    def _profile_cell(self, row, col):
+        start = time.perf_counter()
+        result = self.evaluate_cell(row, col)
+        PROFILER.cell((row, col), self.compiled[(row, col)].template, start, time.perf_counter() - start)
+        return result
+
+    @profiled('reconstruir dependencias')
+    def rebuild_dependencies(self):
+        """
+        Reconstruye el grafo desde las fórmulas de la hoja y recalcula todas.
+        Sirve tras mover celdas sin actualizar el grafo; insertar y eliminar
+        filas o columnas lo actualizan solo donde hace falta (ver _shift).
+        """
+        self.graph_pending = False
+        self.graph.clear()
+        self.values.clear()
+        self.errors.clear()
+        self.compiled.clear()
+        self.pending.clear()
+        self.changed.clear()
+        self.search_index = None
+        self.lookups.clear()
+        for cell, formula in self.formulas.items():
+            self._register(cell, formula)
+            self.numbers.set(cell[0], cell[1], None)
+        return self.recalculate(set(self.formulas))
+
+    def load_rows(self, rows):
+        """
+        Sustituye el contenido de la hoja por una lista de filas de texto.
+        """
+        self.clear()
+        self.row_count = len(rows)
+        self.col_count = max((len(row) for row in rows), default=0)
+        for i, row in enumerate(rows):
+            for j, text in enumerate(row):
+                if text:
+                    self._store(i, j, text)
+        self.recalculate(set(self.formulas))
+
+    @profiled('csv.añadir bloque')
+    def append_block(self, block):
+        """
+        Añade un bloque de filas importadas sin recalcular; las fórmulas se
+        registran en el grafo y se evalúan al terminar la importación.
+        """
+        self.row_count = max(self.row_count, block.start + block.height)
+        self.col_count = max(self.col_count, block.width)
+        self.search_index = None
+        self.lookups.clear()
+        for col, (values, valid, texts, formulas) in enumerate(block.columns):
+            numbers = int(np.count_nonzero(valid))
+            if numbers:
+                self.numbers.set_block(col, block.start, values, valid)
+            if texts:
+                column = self.texts.setdefault(col, {})
+                for i, text in texts.items():
+                    column[block.start + i] = text
+            self.widths.offer_block(col, block.start, values, valid, texts)
+            for i, formula in formulas.items():
+                self._store(block.start + i, col, formula)
+            kinds = self.column_kinds.setdefault(col, [0, 0])
+            kinds[0] += numbers
+            kinds[1] += sum(1 for i in texts if not valid[i])
+
+    # --- Bloques (portapapeles) ---
+    def _formulas_in(self, r1, c1, r2, c2):
+        """
+        Celdas con fórmula dentro de un rango.
+        """
+        if (r2 - r1 + 1) * (c2 - c1 + 1) < len(self.formulas):
+            return [(row, col) for row in range(r1, r2 + 1) for col in range(c1, c2 + 1)
+                    if (row, col) in self.formulas]
+        return [cell for cell in self.formulas if r1 <= cell[0] <= r2 and c1 <= cell[1] <= c2]
+
+    def _texts_in(self, col, r1, r2):
+        """
+        {fila: texto} de una columna dentro de [r1, r2].
+        """
+        column = self.texts.get(col)
+        if not column:
+            return {}
+        if r2 - r1 + 1 < len(column):
+            return {row: column[row] for row in range(r1, r2 + 1) if row in column}
+        return {row: text for row, text in column.items() if r1 <= row <= r2}
+
+    def copy_block(self, r1, c1, r2, c2):
+        """
+        Copia un rango como ClipBlock (todas sus celdas, también las vacías).
+        """
+        height = r2 - r1 + 1
+        formulas = self._formulas_in(r1, c1, r2, c2)
+        columns = []
+        for col in range(c1, c2 + 1):
+            values = np.zeros(height)
+            valid = np.zeros(height, dtype=bool)
+            column = self.numbers.columns.get(col)
+            if column is not None:
+                part = column[0][r1:r2 + 1]
+                values[:len(part)] = part
+                valid[:len(part)] = column[1][r1:r2 + 1]
+            texts = {row - r1: text for row, text in self._texts_in(col, r1, r2).items()}
+            cell_formulas = {row - r1: self.formulas[(row, c)] for row, c in formulas if c == col}
+            if cell_formulas:
+                # El resultado de una fórmula no se copia como número
+                valid[list(cell_formulas)] = False
+            columns.append((values, valid, texts, cell_formulas))
+        return ClipBlock(height, c2 - c1 + 1, columns, (r1, c1))
+
+    def range_tsv(self, r1, c1, r2, c2):
+        """
+        Texto del rango separado por tabuladores, con los valores mostrados
+        (para el portapapeles del sistema).
+        """
+        height = r2 - r1 + 1
+        columns = []
+        for col in range(c1, c2 + 1):
+            cells = np.full(height, '', dtype=object)
+            column = self.numbers.columns.get(col)
+            if column is not None:
+                valid = np.zeros(height, dtype=bool)
+                part = column[1][r1:r2 + 1]
+                valid[:len(part)] = part
+                rows = np.flatnonzero(valid)
+                if len(rows):
+                    cells[rows] = format_numbers(column[0][r1 + rows])
+            for row, text in self._texts_in(col, r1, r2).items():
+                if any(ch in text for ch in '\t\n"'):
+                    text = '"' + text.replace('"', '""') + '"'
+                cells[row - r1] = text
+            for row, c in self._formulas_in(r1, col, r2, col):
+                cells[row - r1] = self.display(row, c)
+            columns.append(cells.tolist())
+        return '\n'.join('\t'.join(row) for row in zip(*columns)) + '\n'
+
+    @profiled('pegar')
+    def paste_block(self, row, col, block):
+        """
+        Escribe un ClipBlock con su esquina en (fila, columna), sustituyendo
+        todo el rectángulo, y recalcula una sola vez lo que depende de él.
+        Las fórmulas copiadas de la hoja mantienen el desplazamiento de sus
+        referencias relativas. Devuelve las celdas cuyo valor puede haber cambiado.
+        """
+        if not block.cell_count():
+            return []
+        r2, c2 = row + block.height - 1, col + block.width - 1
+        self.row_count = max(self.row_count, r2 + 1)
+        self.col_count = max(self.col_count, c2 + 1)
+        self.search_index = None
+        self.lookups.clear()
+        for cell in self._formulas_in(row, col, r2, c2):
+            del self.formulas[cell]
+            del self.compiled[cell]
+            self.graph.remove(cell)
+            self.values.pop(cell, None)
+        dirty = set()
+        for j, (values, valid, texts, formulas) in enumerate(block.columns):
+            target = col + j
+            column = self.texts.get(target)
+            if column:
+                for r in self._texts_in(target, row, r2):
+                    del column[r]
+            self.numbers.set_block(target, row, values, valid)
+            if texts:
+                column = self.texts.setdefault(target, {})
+                for i, text in texts.items():
+                    column[row + i] = text
+            self.widths.offer_block(target, row, values, valid, texts)
+            for i, formula in formulas.items():
+                if block.origin is not None:
+                    template = formula_template(formula[1:], block.origin[0] + i, block.origin[1] + j)
+                    formula = "=" + template_to_formula(template, row + i, target)
+                self.formulas[(row + i, target)] = formula
+                self._register((row + i, target), formula)
+                dirty.add((row + i, target))
+        dirty |= self.graph.range_affected(row, col, r2, c2)
+        return [(row, col), (r2, c2)] + self.recalculate(dirty)
+
+    # --- Cambios de estructura ---
+    def _shift(self, axis, start, delta):
+        """
+        Desplaza filas (axis=0) o columnas (axis=1) desde 'start'; delta > 0
+        inserta y delta < 0 elimina. Las referencias de las fórmulas se
+        reescriben como en Excel (ver shift_references), pero solo se tocan
+        las fórmulas que se mueven y las que leen celdas desde 'start' (el
+        índice inverso del grafo dice cuáles). Se recalculan únicamente las
+        que pasan a leer otras celdas (rangos recortados o alargados, #REF!)
+        y sus dependientes. Devuelve esas fórmulas como {celda anterior: texto
+        anterior}, para poder deshacer el cambio.
+        """
+        if axis == 0:
+            if delta > 0:
+                self.numbers.insert_rows(start, delta)
+            else:
+                self.numbers.remove_rows(start, -delta)
+            for col, column in self.texts.items():
+                if column:
+                    rows = np.fromiter(column, dtype=np.intp, count=len(column))
+                    keep = (rows < start) | (rows >= start - delta) if delta < 0 else slice(None)
+                    moved = np.where(rows >= start, rows + delta, rows)[keep]
+                    values = list(column.values())
+                    if delta < 0:
+                        values = [values[i] for i in np.flatnonzero(keep).tolist()]
+                    self.texts[col] = dict(zip(moved.tolist(), values))
+        else:
+            self.numbers.shift_cols(start, delta)
+            moved = {}
+            for col, column in self.texts.items():
+                new_col = move_index(col, start, delta)
+                if new_col is not None:
+                    moved[new_col] = column
+            self.texts = moved
+        self.widths.shift(axis, start, delta)
+        self.search_index = None
+        self.lookups.clear()
+        referencing = self.graph.referencing(axis, start)
+        touched = referencing.union(cell for cell in self.formulas if cell[axis] >= start)
+        # Primera posición que se desplaza sin eliminarse
+        bound = start if delta > 0 else start - delta
+        old = []
+        for cell in touched:
+            compiled = self.compiled.pop(cell)
+            cells, ranges = self.graph.precedents.get(cell, ((), ()))
+            # Las fórmulas relativas que se mueven junto con todo lo que leen
+            # (lo habitual al copiarlas hacia abajo) conservan su plantilla
+            follows = ('$' not in compiled.template and cell[axis] >= bound and
+                       all(ref[axis] >= bound for ref in cells) and
+                       all(bounds[axis] >= bound for bounds in ranges))
+            self.graph.remove(cell)
+            old.append((cell, self.formulas.pop(cell), compiled, self.values.pop(cell, None), follows))
+        dirty = set()
+        rewritten = {}
+        for cell, formula, compiled, value, follows in old:
+            target = list(cell)
+            target[axis] = move_index(cell[axis], start, delta)
+            if target[axis] is None:
+                continue
+            target = tuple(target)
+            changed = False
+            if follows:
+                formula = "=" + template_to_formula(compiled.template, *target)
+            else:
+                if cell in referencing:
+                    text = formula
+                    formula, changed = shift_references(formula, axis, start, delta)
+                    if changed:
+                        rewritten[cell] = text
+                template = formula_template(formula[1:], *target)
+                if template != compiled.template:
+                    compiled = compile_template(template)
+            self.formulas[target] = formula
+            self.compiled[target] = compiled
+            self.graph.set_precedents(target, *compiled.references(*target))
+            if changed or value is None:
+                dirty.add(target)
+            else:
+                self.values[target] = value
+                self._note_error(*target, value)
+        # Las celdas pendientes de recalcular cambian de sitio con las demás
+        for cells in (self.pending, self.changed):
+            kept = set()
+            for cell in cells:
+                target = list(cell)
+                target[axis] = move_index(cell[axis], start, delta)
+                if target[axis] is not None:
+                    kept.add(tuple(target))
+            cells.clear()
+            cells.update(kept)
+        if self.deferred:
+            self.changed |= dirty
+        else:
+            dirty |= self.graph.affected(dirty)
+        self.recalculate(dirty)
+        return rewritten
+
+    @profiled('insertar filas')
+    def insert_rows(self, row, count=1):
+        self.row_count += count
+        return self._shift(0, row, count)
+
+    @profiled('eliminar filas')
+    def remove_rows(self, row, count=1):
+        self.row_count -= count
+        return self._shift(0, row, -count)
+
+    def insert_cols(self, col, count=1):
+        self.col_count += count
+        return self._shift(1, col, count)
+
+    def remove_cols(self, col, count=1):
+        self.col_count -= count
+        return self._shift(1, col, -count)
+
+    @profiled('ordenar')
+    def sort_rows(self, keys, start=0):
+        """
+        Ordena las filas ocupadas desde 'start' por varias claves
+        [(columna, descendente)] con tipos (números y fechas, texto, errores,
+        vacías). Devuelve el orden aplicado (orden[fila_nueva] = fila_antigua).
+        """
+        rows = self.used_range()[0]
+        if rows <= start:
+            return list(range(rows))
+        order = np.concatenate([np.arange(start), start + sort_permutation(self, keys, start, rows)])
+        self.permute_rows(order)
+        return order.tolist()
+
+    def permute_rows(self, order):
+        """
+        Reordena las primeras len(order) filas: la fila nueva i toma la antigua
+        order[i]. Las fórmulas se mueven con su fila y sus referencias relativas
+        se reescriben para mantener el desplazamiento (como al copiarlas).
+        """
+        order = np.asarray(order, dtype=np.intp)
+        new_row = np.empty(len(order), dtype=np.intp)
+        new_row[order] = np.arange(len(order))
+        self.numbers.permute_rows(order)
+        self.widths.permute_rows(new_row)
+        limit = len(order)
+        for col, column in self.texts.items():
+            if column:
+                rows = np.fromiter(column, dtype=np.intp, count=len(column))
+                moved = np.where(rows < limit, new_row[np.minimum(rows, limit - 1)], rows)
+                self.texts[col] = dict(zip(moved.tolist(), column.values()))
+        formulas, compiled, values = {}, {}, {}
+        for cell in self.formulas:
+            row, col = cell
+            target = (int(new_row[row]), col) if row < limit else cell
+            compiled[target] = template = self.compiled[cell]
+            if target != cell:
+                formula = formulas[target] = "=" + template_to_formula(template.template, *target)
+                if formula.count("#REF!") > template.template.count("#REF!"):
+                    # Alguna referencia relativa queda fuera de la hoja: la
+                    # plantilla ya no sirve y la celda pasa a dar #REF!
+                    compiled[target] = compile_formula(formula[1:], *target)
+            else:
+                formulas[target] = self.formulas[cell]
+            if cell in self.values:
+                values[target] = self.values[cell]
+        self.formulas, self.compiled, self.values = formulas, compiled, values
+        self.errors = {}
+        # Las plantillas no cambian: se reutilizan las fórmulas compiladas y
+        # solo se reconstruye el grafo con las nuevas posiciones
+        self.graph_pending = False
+        self.graph.clear()
+        self.search_index = None
+        self.lookups.clear()
+        self.pending.clear()
+        self.changed.clear()
+        for (row, col), formula in self.compiled.items():
+            self.graph.set_precedents((row, col), *formula.references(row, col))
+        return self.recalculate(set(self.formulas))
+
+# --- Formato nativo .pycalc ---
+# Contenedor binario: una cabecera fija, segmentos de datos y un directorio
+# JSON al final. Cada columna se guarda en trozos de CHUNK_ROWS filas con sus
+# segmentos de números (float64 y máscara en bits), textos, fórmulas (como
+# plantillas sin repetir, con su último resultado) y estilos. Los segmentos
+# se identifican por su hash: al volver a guardar en el mismo archivo solo se
+# añaden los que han cambiado y se reescribe la cabecera para que apunte al
+# nuevo directorio.
+PYCALC_MAGIC = b'PYCALC\x00\x01'
+_WORKBOOK_HEADER = struct.Struct('<8sQQ')  # firma, posición y longitud del directorio
+CHUNK_ROWS = 65536
+# Se compacta el archivo al guardar si el espacio sin usar supera al ocupado
+COMPACT_MIN_BYTES = 4 * 1024 * 1024
+
+class WorkbookFile:
+    """
+    Archivo .pycalc abierto en modo de solo lectura sobre un mmap: los
+    segmentos se leen del mapa al pedirlos, sin cargar el archivo entero.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.file = open(self.path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, offset, length = _WORKBOOK_HEADER.unpack_from(self.map, 0)
+            if magic != PYCALC_MAGIC:
+                raise ValueError("no es un archivo .pycalc")
+            self.directory = json.loads(bytes(self.map[offset:offset + length]))
+            self.size = len(self.map)
+        except Exception:
+            self.file.close()
+            raise
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def raw(self, entry):
+        """
+        Bytes del segmento tal como están en el archivo (comprimidos o no).
+        """
+        offset, length = entry[0], entry[1]
+        return self.map[offset:offset + length]
+
+    def read(self, entry):
+        data = self.raw(entry)
+        return zlib.decompress(data) if entry[2] else data
+
+    def numbers(self, entry, height):
+        """
+        (valores, máscara) de un trozo de números.
+        """
+        data = self.read(entry)
+        values = np.frombuffer(data, dtype=np.float64, count=height)
+        valid = np.unpackbits(np.frombuffer(data, dtype=np.uint8, offset=8 * height),
+                              count=height).astype(bool)
+        return values, valid
+
+    def rows(self, entry, start):
+        """
+        {fila: valor} de un segmento guardado como [filas relativas, valores].
+        """
+        rows, items = json.loads(self.read(entry))
+        return dict(zip((start + row for row in rows), items))
+
+    def templates(self, entry, start):
+        """
+        (filas, índices, resultados, plantillas distintas) de un trozo de
+        fórmulas: la fila i tiene la plantilla templates[índices[i]].
+        """
+        rows, indices, results, templates = json.loads(self.read(entry))
+        return [start + row for row in rows], indices, results, templates
+
+class LazyColumns(dict):
+    """
+    Columnas de la hoja (columna -> contenido) que se leen del archivo
+    .pycalc la primera vez que se consulta cada una: al desplazarse por la
+    hoja solo se decodifican las columnas que llegan a verse.
+    Las operaciones que recorren todas las columnas las cargan todas.
+    'read(source, trozos, columna)' decodifica los trozos pendientes de una
+    columna (None si aún no tenía nada) y devuelve la columna completa.
+    """
+    def __init__(self, source, read):
+        super().__init__()
+        self.source = source
+        self.read = read
+        self.pending = {}  # columna -> [(fila inicial, segmento, ...)]
+        # El recálculo en segundo plano y la interfaz pueden pedir a la vez
+        # la misma columna: ninguno debe verla vacía mientras el otro la lee
+        self.lock = threading.Lock()
+
+    def _load(self, col):
+        with self.lock:
+            chunks = self.pending.pop(col, None)
+            if chunks:
+                super().__setitem__(col, self.read(self.source, chunks, super().get(col)))
+
+    def load_all(self):
+        for col in list(self.pending):
+            self._load(col)
+
+    def get(self, col, default=None):
+        if col in self.pending:
+            self._load(col)
+        return super().get(col, default)
+
+    def __getitem__(self, col):
+        if col in self.pending:
+            self._load(col)
+        return super().__getitem__(col)
+
+    def __contains__(self, col):
+        return col in self.pending or super().__contains__(col)
+
+    def __setitem__(self, col, column):
+        self.pending.pop(col, None)
+        super().__setitem__(col, column)
+
+    def setdefault(self, col, default=None):
+        if col in self.pending:
+            self._load(col)
+        return super().setdefault(col, default)
+
+    def pop(self, col, *default):
+        if col in self.pending:
+            self._load(col)
+        return super().pop(col, *default)
+
+    def __len__(self):
+        return len(set(self.pending) | set(super().keys()))
+
+    def __iter__(self):
+        self.load_all()
+        return super().__iter__()
+
+    def keys(self):
+        self.load_all()
+        return super().keys()
+
+    def values(self):
+        self.load_all()
+        return super().values()
+
+    def items(self):
+        self.load_all()
+        return super().items()
+
+    def clear(self):
+        self.pending.clear()
+        super().clear()
+
+def _read_texts(source, chunks, column):
+    # Trozos (fila inicial, segmento) de textos -> {fila: texto}
+    column = {} if column is None else column
+    for start, entry in chunks:
+        column.update(source.rows(entry, start))
+    return column
+
+def _read_numbers(source, chunks, column):
+    # Trozos (fila inicial, segmento, alto) de números -> (valores, máscara)
+    size = max(start + height for start, entry, height in chunks)
+    values = np.zeros(max(size, 64), dtype=np.float64)
+    valid = np.zeros(len(values), dtype=bool)
+    for start, entry, height in chunks:
+        values[start:start + height], valid[start:start + height] = source.numbers(entry, height)
+    return values, valid
+
+class LazyFormulas(dict):
+    """
+    Fórmulas de la hoja ((fila, columna) -> texto con '=') abiertas de un
+    archivo .pycalc: se guardan como su plantilla, compartida entre las
+    fórmulas copiadas, y el texto A1 se escribe la primera vez que se pide.
+    Recorrer las celdas no escribe ningún texto.
+    """
+    @staticmethod
+    def _text(cell, value):
+        # Las plantillas no empiezan por '=' (los textos de fórmula, siempre)
+        return value if value.startswith('=') else "=" + template_to_formula(value, *cell)
+
+    def __getitem__(self, cell):
+        text = self._text(cell, super().__getitem__(cell))
+        super().__setitem__(cell, text)
+        return text
+
+    def get(self, cell, default=None):
+        return self[cell] if super().__contains__(cell) else default
+
+    def pop(self, cell, *default):
+        if super().__contains__(cell):
+            return self._text(cell, super().pop(cell))
+        return super().pop(cell, *default)
+
+    def values(self):
+        return [self[cell] for cell in self]
+
+    def items(self):
+        return [(cell, self[cell]) for cell in self]
+
+def _rows_segment(rows, start):
+    # [filas relativas, valores] de un trozo, en JSON
+    keys = sorted(rows)
+    return json.dumps([[row - start for row in keys], [rows[row] for row in keys]],
+                      ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+
+def _templates_segment(rows, start):
+    # [filas relativas, índices, resultados, plantillas distintas] de un
+    # trozo de fórmulas {fila: (plantilla, resultado)}, en JSON
+    keys = sorted(rows)
+    index = {}
+    indices = [index.setdefault(rows[row][0], len(index)) for row in keys]
+    return json.dumps([[row - start for row in keys], indices, [rows[row][1] for row in keys], list(index)],
+                      ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+
+def _json_default(value):
+    # Escalares de NumPy (resultados de fórmulas, anchos)
+    return value.item()
+
+class _SegmentWriter:
+    """
+    Escribe segmentos al final de un archivo .pycalc. Un segmento con el mismo
+    hash que otro ya presente en el archivo no se vuelve a escribir.
+    """
+    def __init__(self, file, known, compress):
+        self.file = file
+        self.known = known  # hash -> segmento ya escrito en el archivo
+        self.compress = compress
+        self.used = {}  # posición -> longitud de los segmentos referenciados
+
+    def _append(self, payload, packed, digest):
+        self.file.seek(0, os.SEEK_END)
+        # Los números quedan alineados a 8 bytes
+        padding = -self.file.tell() % 8
+        if padding:
+            self.file.write(b'\x00' * padding)
+        offset = self.file.tell()
+        self.file.write(payload)
+        entry = self.known[digest] = [offset, len(payload), int(packed), digest]
+        return entry
+
+    def put(self, data):
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        entry = self.known.get(digest)
+        if entry is None:
+            payload = zlib.compress(data, 1) if self.compress else data
+            packed = len(payload) < len(data)
+            entry = self._append(payload if packed else data, packed, digest)
+        self.used[entry[0]] = entry[1]
+        return entry
+
+    def copy(self, source, entry):
+        """
+        Segmento de otro archivo (o del mismo) que no se ha llegado a leer.
+        """
+        known = self.known.get(entry[3])
+        if known is None:
+            known = self._append(source.raw(entry), entry[2], entry[3])
+        self.used[known[0]] = known[1]
+        return known
+
+def _known_segments(directory):
+    known = {}
+    for chunks in directory['columns'].values():
+        for chunk in chunks.values():
+            for name, entry in chunk.items():
+                if name != 'height':
+                    known[entry[3]] = entry
+    return known
+
+@profiled('libro.guardar')
+def save_workbook(path, sheet, styles=None, widths=None, compress=True):
+    """
+    Guarda la hoja (y sus estilos y anchos de columna) en formato .pycalc.
+    Si la hoja se abrió de ese mismo archivo solo se añaden los trozos que
+    han cambiado; si el espacio sin usar crece demasiado se reescribe entero.
+    """
+    path = os.path.abspath(path)
+    source = sheet.source
+    incremental = source is not None and source.path == path and os.path.exists(path)
+    if incremental:
+        used = sum(e[1] for e in _known_segments(source.directory).values())
+        waste = source.size - used
+        incremental = waste < max(used, COMPACT_MIN_BYTES)
+    if incremental:
+        target = path
+        file = open(path, 'r+b')
+        known = _known_segments(source.directory)
+    else:
+        fd, target = tempfile.mkstemp(suffix='.pycalc', dir=os.path.dirname(path))
+        file = os.fdopen(fd, 'w+b')
+        file.write(_WORKBOOK_HEADER.pack(PYCALC_MAGIC, 0, 0))
+        known = {}
+    try:
+        writer = _SegmentWriter(file, known, compress)
+        pending = sheet.texts.pending if isinstance(sheet.texts, LazyColumns) else {}
+        number_columns = sheet.numbers.columns
+        pending_numbers = number_columns.pending if isinstance(number_columns, LazyColumns) else {}
+        cells = styles.cells if styles is not None else {}
+        # Las fórmulas se guardan como su plantilla: las copiadas comparten una
+        formulas = {}
+        for (row, col), compiled in sheet.compiled.items():
+            formulas.setdefault(col, {})[row] = (compiled.template, sheet.values.get((row, col), ""))
+        columns = {}
+        moved = {}  # segmento pendiente de leer -> segmento en el archivo guardado
+        for col in sorted(set(dict.keys(number_columns)) | set(pending_numbers) | set(dict.keys(sheet.texts))
+                          | set(pending) | set(formulas) | set(cells)):
+            chunks = {}
+            numbers = dict.get(number_columns, col)
+            texts = dict.get(sheet.texts, col, {})
+            col_formulas = formulas.get(col, {})
+            col_styles = cells.get(col, {})
+            number_rows = max([start + height for start, entry, height in pending_numbers.get(col, ())],
+                              default=0)
+            if numbers is not None:
+                occupied = np.flatnonzero(numbers[1])
+                number_rows = int(occupied[-1]) + 1 if len(occupied) else 0
+            height = max([number_rows] + [max(rows) + 1 for rows in (texts, col_formulas, col_styles) if rows]
+                         + [start + 1 for start, entry in pending.get(col, ())])
+            by_block = {}
+            for name, rows in (('texts', texts), ('templates', col_formulas), ('styles', col_styles)):
+                for row, item in rows.items():
+                    by_block.setdefault((row // CHUNK_ROWS, name), {})[row] = item
+            for start in range(0, height, CHUNK_ROWS):
+                block = start // CHUNK_ROWS
+                end = min(start + CHUNK_ROWS, number_rows)
+                chunk = {}
+                if numbers is not None and start < end and numbers[1][start:end].any():
+                    values, valid = numbers[0][start:end], numbers[1][start:end]
+                    chunk['height'] = end - start
+                    chunk['numbers'] = writer.put(np.where(valid, values, 0.0).tobytes()
+                                                  + np.packbits(valid).tobytes())
+                for name in ('texts', 'styles'):
+                    rows = by_block.get((block, name))
+                    if rows:
+                        chunk[name] = writer.put(_rows_segment(rows, start))
+                rows = by_block.get((block, 'templates'))
+                if rows:
+                    chunk['templates'] = writer.put(_templates_segment(rows, start))
+                # Los trozos aún sin leer se copian tal cual del archivo de origen
+                for chunk_start, entry in pending.get(col, ()):
+                    if chunk_start == start:
+                        chunk['texts'] = moved[entry[3]] = writer.copy(source, entry)
+                for chunk_start, entry, chunk_height in pending_numbers.get(col, ()):
+                    if chunk_start == start:
+                        chunk['height'] = chunk_height
+                        chunk['numbers'] = moved[entry[3]] = writer.copy(source, entry)
+                if chunk:
+                    columns.setdefault(str(col), {})[str(block)] = chunk
+        directory = {
+            'rows': sheet.row_count,
+            'cols': sheet.col_count,
+            'chunk_rows': CHUNK_ROWS,
+            'kinds': {str(col): kinds for col, kinds in sheet.column_kinds.items()},
+            'columns': columns,
+            'styles': [list(style) for style in styles.table.styles] if styles is not None else [],
+            'runs': [list(run) for run in styles.runs] if styles is not None else [],
+            'widths': {str(col): width for col, width in (widths or {}).items()},
+        }
+        data = json.dumps(directory, separators=(',', ':'), default=_json_default).encode('utf-8')
+        file.seek(0, os.SEEK_END)
+        offset = file.tell()
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+        # La cabecera se escribe al final: si algo falla antes, el archivo
+        # sigue apuntando al directorio anterior
+        file.seek(0)
+        file.write(_WORKBOOK_HEADER.pack(PYCALC_MAGIC, offset, len(data)))
+        file.flush()
+        os.fsync(file.fileno())
+    except BaseException:
+        file.close()
+        if not incremental:
+            os.unlink(target)
+        raise
+    file.close()
+    if not incremental:
+        os.replace(target, path)
+    # La hoja pasa a leer del archivo recién guardado
+    sheet.source = WorkbookFile(path)
+    for lazy in (sheet.texts, number_columns):
+        if isinstance(lazy, LazyColumns):
+            lazy.source = sheet.source
+            for col, chunks in lazy.pending.items():
+                lazy.pending[col] = [(start, moved[entry[3]], *rest) for start, entry, *rest in chunks]
+    if source is not None:
+        source.close()
+    return path
+
+@profiled('libro.abrir')
+def load_workbook(path, sheet, styles=None):
+    """
+    Carga un archivo .pycalc en la hoja (y en 'styles', si se da). Los
+    números y los textos se leen por columnas al consultarlas. Las fórmulas
+    se cargan enseguida, sin recalcular (el archivo guarda el último
+    resultado de cada una): cada plantilla distinta se compila una vez, el
+    texto A1 se escribe al pedirlo y el grafo de dependencias se construye
+    al editar o recalcular por primera vez. Devuelve los anchos de columna
+    {columna: ancho}.
+    """
+    source = WorkbookFile(path)
+    directory = source.directory
+    sheet.clear()
+    sheet.row_count = directory['rows']
+    sheet.col_count = directory['cols']
+    sheet.texts = texts = LazyColumns(source, _read_texts)
+    sheet.numbers.columns = numbers = LazyColumns(source, _read_numbers)
+    sheet.formulas = formulas = LazyFormulas()
+    sheet.source = source
+    chunk_rows = directory['chunk_rows']
+    for col, chunks in directory['columns'].items():
+        col = int(col)
+        for block, chunk in chunks.items():
+            start = int(block) * chunk_rows
+            if 'numbers' in chunk:
+                numbers.pending.setdefault(col, []).append((start, chunk['numbers'], chunk['height']))
+            if 'texts' in chunk:
+                texts.pending.setdefault(col, []).append((start, chunk['texts']))
+            if 'templates' in chunk:
+                rows, indices, results, templates = source.templates(chunk['templates'], start)
+                compiled = [compile_template(template) for template in templates]
+                cells = [(row, col) for row in rows]
+                formulas.update(zip(cells, [templates[i] for i in indices]))
+                sheet.compiled.update(zip(cells, [compiled[i] for i in indices]))
+                sheet.values.update(zip(cells, results))
+                for row, result in zip(rows, results):
+                    sheet._note_error(row, col, result)
+            if styles is not None and 'styles' in chunk:
+                styles.cells.setdefault(col, {}).update(source.rows(chunk['styles'], start))
+    sheet.graph_pending = bool(sheet.compiled)
+    sheet.column_kinds = {int(col): kinds for col, kinds in directory['kinds'].items()}
+    if styles is not None:
+        styles.table = StyleTable()
+        for style in directory['styles'][1:]:
+            styles.table.intern(Style(*style))
+        styles.runs = [tuple(run) for run in directory['runs']]
+        styles._resolved = {}
+    return {int(col): width for col, width in directory['widths'].items()}
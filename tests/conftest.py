@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# Los módulos de pycalc están en la raíz del repositorio, sin instalar
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pycalc_engine import Sheet
+
+
+@pytest.fixture
+def make_sheet():
+    """
+    Crea una hoja con las filas dadas (listas de textos, como al importar un CSV).
+    """
+    def make(rows):
+        sheet = Sheet()
+        sheet.parallel = False
+        sheet.load_rows(rows)
+        return sheet
+    return make
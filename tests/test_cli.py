@@ -0,0 +1,47 @@
+import pytest
+
+import pycalc_cli
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / "hoja.csv"
+    path.write_text("1,=A1*2\n3,=A2+B1\n", encoding='utf-8')
+    return path
+
+
+def test_recalc(csv_file, tmp_path, capsys):
+    target = tmp_path / "valores.csv"
+    assert pycalc_cli.main(['recalc', str(csv_file), '-o', str(target)]) == 0
+    assert target.read_text(encoding='utf-8').splitlines() == ["1,2", "3,5"]
+    # La entrada conserva sus fórmulas
+    assert csv_file.read_text(encoding='utf-8') == "1,=A1*2\n3,=A2+B1\n"
+    assert "valores.csv" in capsys.readouterr().out
+
+
+def test_recalc_folder(csv_file, tmp_path):
+    (tmp_path / "otra.tsv").write_text("2\t=A1*10\n", encoding='utf-8')
+    out = tmp_path / "salida"
+    assert pycalc_cli.main(['recalc', str(tmp_path), '-o', str(out), '-j', '1', '-q']) == 0
+    assert (out / "hoja.csv").read_text(encoding='utf-8').splitlines() == ["1,2", "3,5"]
+    assert (out / "otra.tsv").read_text(encoding='utf-8').splitlines() == ["2\t20"]
+
+
+def test_recalc_never_overwrites_input(csv_file, capsys):
+    with pytest.raises(SystemExit):
+        pycalc_cli.main(['recalc', str(csv_file)])
+    assert pycalc_cli.main(['recalc', str(csv_file), '-o', str(csv_file)]) == 2
+    assert pycalc_cli.main(['recalc', str(csv_file.parent), '-o', str(csv_file.parent)]) == 2
+    assert csv_file.read_text(encoding='utf-8') == "1,=A1*2\n3,=A2+B1\n"
+
+
+def test_eval(csv_file, capsys):
+    assert pycalc_cli.main(['eval', str(csv_file), "SUMA(B1:B2)"]) == 0
+    assert capsys.readouterr().out.strip() == "7.0"
+    assert pycalc_cli.main(['eval', str(csv_file), "=1/0"]) == 1
+    assert capsys.readouterr().out.strip().startswith("#ERROR")
+
+
+def test_missing_input(tmp_path, capsys):
+    assert pycalc_cli.main(['eval', str(tmp_path / "no.csv"), "1"]) == 2
+    assert "No existe" in capsys.readouterr().err
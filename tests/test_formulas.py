@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from pycalc_engine import FormulaError, Recalculation, compile_formula
+
+
+@pytest.mark.parametrize('formula, expected', [
+    ("=2+3*4", 14.0),
+    ("=(2+3)*4", 20.0),
+    ("=10-4-3", 3.0),
+    ("=8/2/2", 2.0),
+    ("=-2*3", -6.0),
+    ("=2*-3", -6.0),
+    ("=--4", 4.0),
+    ("=VERDADERO+1", 2.0),
+])
+def test_precedence(make_sheet, formula, expected):
+    sheet = make_sheet([[formula]])
+    assert sheet.get_cell_value(0, 0) == expected
+
+
+@pytest.mark.parametrize('formula, message', [
+    ("=1/0", "#ERROR: división por cero"),
+    ("=2+", "#ERROR: fórmula incompleta"),
+    ("=(1+2", "#ERROR: se esperaba ')'"),
+    ("=FOO(1)", "#ERROR: función desconocida: FOO"),
+    ("=1 2", "#ERROR: token inesperado: 2"),
+    ("=A1:A2", "#ERROR: token inesperado: :"),
+])
+def test_errors(make_sheet, formula, message):
+    sheet = make_sheet([[formula]])
+    assert sheet.display(0, 0) == message
+
+
+def test_syntax_error_is_raised_on_evaluation():
+    compiled = compile_formula("1+", 0, 0)
+    with pytest.raises(FormulaError):
+        compiled.evaluate(None, 0, 0)
+
+
+def test_references_and_ranges(make_sheet):
+    sheet = make_sheet([["1", "2", "3"], ["4", "5", "6"], ["=SUMA(A1:C2)", "=PROMEDIO(A1:A2)", "=B2-A1*2"]])
+    assert [sheet.get_cell_value(2, c) for c in range(3)] == [21.0, 2.5, 3.0]
+
+
+def test_dependents_are_recalculated(make_sheet):
+    sheet = make_sheet([["1"], ["=A1*2"], ["=A2+A1"], ["=SUMA(A1:A3)"]])
+    sheet.set_cell(0, 0, "10")
+    assert [sheet.get_cell_value(r, 0) for r in range(1, 4)] == [20.0, 30.0, 60.0]
+
+
+def test_cycle(make_sheet):
+    sheet = make_sheet([["=A1"], ["=A3+1"], ["=A2+1"], ["=A2*2"]])
+    assert sheet.display(0, 0) == "#CICLO"
+    assert sheet.display(1, 0) == sheet.display(2, 0) == "#CICLO"
+    # Quien lee una celda del ciclo recibe el error
+    assert sheet.display(3, 0) == "#CICLO"
+    sheet.set_cell(2, 0, "3")
+    assert sheet.get_cell_value(1, 0) == 4.0
+    assert sheet.get_cell_value(3, 0) == 8.0
+
+
+def test_errors_propagate_to_dependents(make_sheet):
+    sheet = make_sheet([["=1/0", "1"], ["=A1+1", "=SUMA(A1:B1)"], ["=CONTAR(A1:B1)"]])
+    assert sheet.display(1, 0) == "#ERROR: división por cero"
+    assert sheet.display(1, 1) == "#ERROR: división por cero"
+    # CONTAR solo cuenta los números y no se ve afectada
+    assert sheet.display(2, 0) == "1"
+    sheet.set_cell(0, 0, "5")
+    assert sheet.get_cell_value(1, 0) == 6.0
+    assert sheet.get_cell_value(1, 1) == 6.0
+
+
+def test_reads_during_background_recalculation(make_sheet):
+    # La interfaz pide estadísticas y el rango ocupado mientras el recálculo
+    # en segundo plano crea columnas nuevas
+    n = 3000
+    sheet = make_sheet([["1"] + [""] * (n - 1)])
+    sheet.deferred = True
+    sheet.set_cells([(1, col, "=A1+1") for col in range(n)])
+    job = Recalculation(sheet)
+    thread = threading.Thread(target=job.run)
+    thread.start()
+    try:
+        while thread.is_alive():
+            sheet.selection_stats([(0, 0, 5, n)])
+            sheet.used_range()
+    finally:
+        thread.join()
+    assert sheet.selection_stats([(0, 0, 5, n)]) == (n + 1, 2 * n + 1.0, 1.0, 2.0)
+    assert sheet.used_range() == (2, n)
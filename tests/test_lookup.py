@@ -0,0 +1,26 @@
+import pytest
+
+ROWS = [["fruta", "kilos", "precio"], ["manzana", "10", "1.5"], ["pera", "20", "2"],
+        ["manzana", "5", "1.5"], ["uva", "8", "3"]]
+
+
+@pytest.mark.parametrize('formula, expected', [
+    ('=SUMAR.SI(A2:A5,"manzana",B2:B5)', "15.0"),
+    ('=SUMAR.SI(B2:B5,">8")', "30.0"),
+    ('=SUMAR.SI(A2:A5,"p*",B2:B5)', "20.0"),
+    ('=CONTAR.SI(A2:A5,"manzana")', "2.0"),
+    ('=PROMEDIO.SI(A2:A5,"manzana",B2:B5)', "7.5"),
+    ('=BUSCARV("pera",A2:C5,2,FALSO)', "20.0"),
+    ('=BUSCARV("uva",A2:C5,3,FALSO)', "3.0"),
+    ('=BUSCARV("kiwi",A2:C5,2,FALSO)', "#N/A"),
+])
+def test_conditional_and_lookup(make_sheet, formula, expected):
+    sheet = make_sheet(ROWS + [[formula]])
+    assert sheet.display(5, 0) == expected
+
+
+def test_lookup_follows_edits(make_sheet):
+    sheet = make_sheet(ROWS + [['=BUSCARV("kiwi",A2:C5,2,FALSO)', '=SUMAR.SI(A2:A5,"manzana",B2:B5)']])
+    sheet.set_cells([(4, 0, "kiwi"), (1, 1, "100")])
+    assert sheet.display(5, 0) == "8.0"
+    assert sheet.display(5, 1) == "105.0"
@@ -0,0 +1,56 @@
+import pytest
+
+
+def test_find_options(make_sheet):
+    sheet = make_sheet([["hola mundo", "Hola"], ["adiós", "hola"], ["x12", "y345"]])
+    assert sheet.find("hola") == [(0, 0), (0, 1), (1, 1)]
+    assert sheet.find("hola", case=True) == [(0, 0), (1, 1)]
+    assert sheet.find("hola", whole=True) == [(0, 1), (1, 1)]
+    assert sheet.find(r"[a-z]\d+", regex=True) == [(2, 0), (2, 1)]
+    assert sheet.find("") == []
+
+
+def test_find_numbers_and_formulas(make_sheet):
+    sheet = make_sheet([["125", "=A1*2"], ["3.5"]])
+    assert sheet.find("12") == [(0, 0)]
+    assert sheet.find("A1") == [(0, 1)]
+
+
+def test_replace(make_sheet):
+    sheet = make_sheet([["hola mundo", "Hola"], ["adiós", "hola"]])
+    updates = sheet.replacements("hola", "chao")
+    assert updates == [(0, 0, "chao mundo"), (0, 1, "chao"), (1, 1, "chao")]
+    sheet.set_cells(updates)
+    # El índice de búsqueda sigue a los cambios
+    assert sheet.find("hola") == []
+    assert sheet.find("chao") == [(0, 0), (0, 1), (1, 1)]
+
+
+def test_replace_regex_groups(make_sheet):
+    sheet = make_sheet([["x12", "y345", "z"]])
+    assert sheet.replacements(r"(\w)(\d+)", r"\2\1", regex=True) == [(0, 0, "12x"), (0, 1, "345y")]
+    # Sin regex la sustitución es literal
+    assert sheet.replacements("x", r"\1") == [(0, 0, r"\112")]
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    ('ab{0,3}c', [(0, 0), (1, 0), (2, 0)]),
+    ('hel{1,2}o', [(3, 0)]),
+    ('ab{2,}c', [(0, 0)]),
+    ('b{,2}c', [(0, 0), (1, 0), (2, 0)]),
+    ('(?i)HELLO', [(3, 0)]),
+    ('(?x) hel  lo ', [(3, 0)]),
+    ('[^]x]bc', [(0, 0), (1, 0)]),
+    (r'\x61b+c', [(0, 0), (1, 0)]),
+    (r'hello', [(3, 0)]),
+])
+def test_regex_quantifiers_and_escapes(make_sheet, pattern, expected):
+    # El trozo literal que se busca en el índice no puede descartar coincidencias
+    sheet = make_sheet([["abbc"], ["abc"], ["ac"], ["hello world"], ["xyz"]])
+    assert sheet.find(pattern, regex=True) == expected
+
+
+def test_replace_regex_quantifier(make_sheet):
+    sheet = make_sheet([["abbc"], ["ac"], ["hello world"]])
+    assert sheet.replacements('ab{0,3}c', 'X', regex=True) == [(0, 0, "X"), (1, 0, "X")]
+    assert sheet.replacements('hel{1,2}o', 'hola', regex=True) == [(2, 0, "hola world")]
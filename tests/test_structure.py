@@ -0,0 +1,81 @@
+def texts(sheet, row, cols=3):
+    return [sheet.text(row, col) for col in range(cols)]
+
+
+def test_insert_rows_moves_references(make_sheet):
+    sheet = make_sheet([["1"], ["2"], ["3"], ["=SUMA(A1:A3)", "=A2*10", "=$A$3"]])
+    sheet.insert_rows(1, 2)
+    assert texts(sheet, 5) == ["=SUMA(A1:A5)", "=A4*10", "=$A$5"]
+    assert [sheet.get_cell_value(5, c) for c in range(3)] == [6.0, 20.0, 3.0]
+    sheet.set_cell(1, 0, "10")
+    assert sheet.get_cell_value(5, 0) == 16.0
+
+
+def test_delete_rows_gives_ref_error(make_sheet):
+    sheet = make_sheet([["1"], ["2"], ["3"], ["=SUMA(A1:A3)", "=A2*10", "=A1"]])
+    sheet.remove_rows(1, 1)
+    assert texts(sheet, 2) == ["=SUMA(A1:A2)", "=#REF!*10", "=A1"]
+    assert sheet.get_cell_value(2, 0) == 4.0
+    assert sheet.display(2, 1) == "#REF!"
+    sheet.remove_rows(0, 1)
+    assert texts(sheet, 1) == ["=SUMA(A1:A1)", "=#REF!*10", "=#REF!"]
+    assert sheet.display(1, 2) == "#REF!"
+
+
+def test_ref_error_propagates(make_sheet):
+    sheet = make_sheet([["1", "=A1*2"], ["", "=B1+1"]])
+    sheet.remove_cols(0, 1)
+    assert sheet.text(0, 0) == "=#REF!*2"
+    assert sheet.display(0, 0) == sheet.display(1, 0) == "#REF!"
+
+
+def test_insert_and_delete_columns(make_sheet):
+    sheet = make_sheet([["1", "2", "=A1+B1"]])
+    sheet.insert_cols(1)
+    assert sheet.text(0, 3) == "=A1+C1"
+    sheet.remove_cols(1)
+    assert sheet.text(0, 2) == "=A1+B1"
+    assert sheet.get_cell_value(0, 2) == 3.0
+
+
+def test_sort_moves_formulas_with_rows(make_sheet):
+    sheet = make_sheet([["3", "=A1*2"], ["1", "=A2*2"], ["2", "=A3*2"], ["b"], ["a"]])
+    order = sheet.sort_rows([(0, False)])
+    assert order == [1, 2, 0, 4, 3]
+    assert [sheet.text(r, 0) for r in range(5)] == ["1", "2", "3", "a", "b"]
+    assert [sheet.text(r, 1) for r in range(3)] == ["=A1*2", "=A2*2", "=A3*2"]
+    assert [sheet.get_cell_value(r, 1) for r in range(3)] == [2.0, 4.0, 6.0]
+    # El grafo sigue las nuevas posiciones
+    sheet.set_cell(0, 0, "7")
+    assert sheet.get_cell_value(0, 1) == 14.0
+
+
+def test_sort_descending_by_several_keys(make_sheet):
+    sheet = make_sheet([["x", "1"], ["y", "2"], ["x", "3"], ["y", "0"]])
+    sheet.sort_rows([(0, True), (1, False)])
+    assert [texts(sheet, r, 2) for r in range(4)] == [["y", "0"], ["y", "2"], ["x", "1"], ["x", "3"]]
+
+
+def test_sort_out_of_sheet_reference_gives_ref_error(make_sheet):
+    sheet = make_sheet([["head"], ["2", "=SUMA(A1:A2)"], ["1", "=A1"]])
+    sheet.sort_rows([(0, False)], start=1)
+    # =A1 sube una fila y =SUMA(A1:A2) baja una
+    assert [sheet.text(r, 1) for r in range(1, 3)] == ["=#REF!", "=SUMA(A2:A3)"]
+    assert sheet.display(1, 1) == "#REF!"
+    assert sheet.get_cell_value(2, 1) == 3.0
+    sheet.sort_rows([(0, True)], start=1)
+    assert [sheet.text(r, 1) for r in range(1, 3)] == ["=SUMA(A1:A2)", "=#REF!"]
+    assert sheet.display(2, 1) == "#REF!"
+    # El texto se puede volver a escribir y da lo mismo
+    sheet.set_cell(2, 1, sheet.text(2, 1))
+    assert sheet.display(2, 1) == "#REF!"
+
+
+def test_sort_out_of_sheet_range_collapses(make_sheet):
+    sheet = make_sheet([["3", ""], ["1", "=SUMA(A1:A2)*2"], ["2", "=SUMA(A1:A2)"]])
+    sheet.sort_rows([(0, False)])
+    # La fila 2 pasa a la 1: su rango empezaría por encima de la hoja
+    assert sheet.text(0, 1) == "=SUMA(#REF!)*2"
+    assert sheet.display(0, 1) == "#REF!"
+    sheet.set_cell(0, 1, sheet.text(0, 1))
+    assert sheet.display(0, 1) == "#REF!"
@@ -0,0 +1,91 @@
+import pytest
+
+import pycalc_engine
+from pycalc_engine import Sheet, SheetStyles, WorkbookFile, load_workbook, save_workbook
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # Trozos pequeños para que unas pocas filas ocupen varios
+    monkeypatch.setattr(pycalc_engine, 'CHUNK_ROWS', 4)
+
+
+ROWS = [[str(i), f"=A{i + 1}*2", f"t{i}" if i % 3 else "", "=SUMA(A1:A10)" if i == 0 else ""]
+        for i in range(10)]
+
+
+def cells(sheet):
+    return [(sheet.text(r, c), sheet.display(r, c))
+            for r in range(sheet.row_count) for c in range(sheet.col_count)]
+
+
+def directory(path):
+    source = WorkbookFile(path)
+    try:
+        return source.directory['columns']
+    finally:
+        source.close()
+
+
+def reopen(path):
+    sheet = Sheet()
+    sheet.parallel = False
+    load_workbook(path, sheet)
+    return sheet
+
+
+def test_round_trip(make_sheet, tmp_path):
+    sheet = make_sheet(ROWS + [["=1/0", "=A11+1", "ñ\"x,\ty"]])
+    styles = SheetStyles()
+    styles.apply([(2, 1, 2, 1)], {'bold': True})
+    path = str(tmp_path / "libro.pycalc")
+    save_workbook(path, sheet, styles, widths={1: 140})
+    other = Sheet()
+    other_styles = SheetStyles()
+    assert load_workbook(path, other, other_styles) == {1: 140}
+    assert (other.row_count, other.col_count) == (sheet.row_count, sheet.col_count)
+    assert cells(other) == cells(sheet)
+    assert other.display(10, 1) == "#ERROR: división por cero"
+    assert other_styles.style(2, 1).bold
+
+
+def test_reopened_sheet_recalculates(make_sheet, tmp_path):
+    path = str(tmp_path / "libro.pycalc")
+    save_workbook(path, make_sheet(ROWS))
+    sheet = reopen(path)
+    sheet.set_cell(9, 0, "100")
+    assert sheet.get_cell_value(9, 1) == 200.0
+    assert sheet.get_cell_value(0, 3) == 136.0
+    sheet.insert_rows(0)
+    assert sheet.text(10, 1) == "=A11*2"
+    assert sheet.get_cell_value(1, 3) == 136.0
+
+
+def test_incremental_save(make_sheet, tmp_path):
+    path = str(tmp_path / "libro.pycalc")
+    save_workbook(path, make_sheet(ROWS))
+    sheet = reopen(path)
+    before = directory(path)
+    sheet.set_cell(9, 2, "nuevo")
+    save_workbook(path, sheet)
+    after = directory(path)
+    # Los trozos que no cambian siguen en el mismo sitio del archivo
+    assert after['0'] == before['0']
+    assert after['2']['0'] == before['2']['0']
+    assert after['2']['2'] != before['2']['2']
+    again = reopen(path)
+    assert again.text(9, 2) == "nuevo"
+    assert cells(again) == cells(sheet)
+
+
+def test_unread_chunks_are_kept(make_sheet, tmp_path):
+    path = str(tmp_path / "libro.pycalc")
+    original = make_sheet(ROWS)
+    save_workbook(path, original)
+    sheet = reopen(path)
+    # Sin leer ninguna columna, ni en el mismo archivo ni en otro
+    save_workbook(path, sheet)
+    copy = str(tmp_path / "copia.pycalc")
+    save_workbook(copy, sheet)
+    assert cells(reopen(path)) == cells(original)
+    assert cells(reopen(copy)) == cells(original)